@@ -1,4 +1,7 @@
 from .server import Server
 from .client_thread import ClientThread
+from .client_process import ClientProcess
+from .scheduler import ClientScheduler, LogicalClient
 from .runtime_model import RuntimeModel
-from .strategies import Strategy
\ No newline at end of file
+from .strategies import Strategy
+from .simulation import Simulation
@@ -0,0 +1,373 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+from afl_bench.agents.compiled import CompiledFunction
+from afl_bench.compression import CompressedDelta
+from afl_bench.params import SKIPPED, FlatParams, ParamLayout
+from afl_bench.types import ClientUpdate, ModelParams
+from afl_bench.updates import DeltaUpdate, get_update_delta
+
+# Smallest number of elements worth handing to another aggregation thread.
+MIN_SHARD_NUMEL = 1 << 16
+
+_pool: Optional[ThreadPoolExecutor] = None
+_num_threads = 1
+_pool_lock = Lock()
+
+
+def set_num_threads(num_threads: int):
+    """
+    Set the number of threads aggregation shards the flat parameter space over.
+    Torch kernels release the GIL, so shards are aggregated concurrently.
+
+    Args:
+        num_threads (int): number of aggregation threads, 1 to not shard.
+    """
+    global _pool, _num_threads
+    assert num_threads >= 1
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = (
+            ThreadPoolExecutor(num_threads, thread_name_prefix="aggregation")
+            if num_threads > 1
+            else None
+        )
+        _num_threads = num_threads
+
+
+def _weighted_sum_(
+    out: torch.Tensor,
+    base: torch.Tensor,
+    stacked: torch.Tensor,
+    weights: torch.Tensor,
+):
+    """
+    Write base plus the weighted sum of the rows of a stacked delta matrix into
+    out. Compiled, this reads every input once in a single fused kernel.
+    """
+    out.copy_(base + (weights.unsqueeze(1) * stacked).sum(0))
+
+
+_compiled_weighted_sum = None
+
+
+def set_compiled(enabled: bool):
+    """
+    Set whether aggregation runs a kernel compiled with torch.compile over the
+    stacked deltas. Falls back to eager kernels if compilation fails.
+
+    The kernel is compiled for dynamic shapes, since the number of updates in
+    each aggregation and the size of each shard vary.
+    """
+    global _compiled_weighted_sum
+    _compiled_weighted_sum = (
+        CompiledFunction(_weighted_sum_, "aggregation kernel", dynamic=True)
+        if enabled
+        else None
+    )
+
+
+def _shards(
+    layout: ParamLayout, param_aligned: bool
+) -> List[Tuple[slice, Optional[slice]]]:
+    """
+    Split the flat parameter space into contiguous shards of roughly equal size,
+    one per aggregation thread, unless the model is too small to be worth it.
+
+    Returns:
+        List of (range of the flat buffer, range of parameter indices) pairs. If
+        param_aligned, shards only split the buffer between parameters, so each
+        covers whole parameters. Otherwise the parameter ranges are None.
+    """
+    num_shards = max(1, min(_num_threads, layout.numel // MIN_SHARD_NUMEL))
+    if num_shards == 1:
+        return [(slice(0, layout.numel), slice(0, len(layout)))]
+
+    if not param_aligned:
+        bounds = [layout.numel * i // num_shards for i in range(num_shards + 1)]
+        return [(slice(a, b), None) for a, b in zip(bounds, bounds[1:])]
+
+    # Cut before the first parameter reaching each equal-size boundary.
+    shards, start = [], 0
+    for i in range(1, num_shards + 1):
+        target = layout.numel * i // num_shards
+        stop = start
+        while stop < len(layout) and (
+            layout.offsets[stop] + layout.numels[stop] <= target or stop == start
+        ):
+            stop += 1
+        if i == num_shards:
+            stop = len(layout)
+        if stop > start:
+            offset_start = layout.offsets[start]
+            offset_stop = layout.offsets[stop] if stop < len(layout) else layout.numel
+            shards.append((slice(offset_start, offset_stop), slice(start, stop)))
+        start = stop
+    return shards
+
+
+def _run_sharded(kernel: Callable, shards: List):
+    """
+    Run a kernel over each shard, on the aggregation threads if there are several.
+    """
+    with _pool_lock:
+        pool = _pool
+    if len(shards) == 1 or pool is None:
+        for shard in shards:
+            kernel(shard)
+        return
+
+    # Gradient mode is thread local, so kernels must disable it themselves.
+    for future in [pool.submit(kernel, shard) for shard in shards]:
+        future.result()
+
+
+def stack_deltas(
+    client_updates: List[ClientUpdate], layout: ParamLayout, device=None
+) -> torch.Tensor:
+    """
+    Gather the deltas of several client updates into one (num updates, numel)
+    matrix, with each row laid out like a flat model.
+
+    Args:
+        client_updates: client updates in either form.
+        layout: layout of the model the updates were trained on.
+        device (torch.device, optional): device of the matrix. Defaults to the
+            device of the first delta.
+    """
+    deltas = [get_update_delta(update) for update in client_updates]
+    first = deltas[0].flat if isinstance(deltas[0], FlatParams) else deltas[0][0][1]
+    stacked = torch.empty(
+        (len(deltas), layout.numel),
+        device=device if device is not None else first.device,
+        dtype=first.dtype,
+    )
+
+    with torch.no_grad():
+        for row, delta in zip(stacked, deltas):
+            if isinstance(delta, FlatParams):
+                row.copy_(delta.flat)
+            else:
+                torch.cat([tensor.reshape(-1) for _, tensor in delta], out=row)
+    return stacked
+
+
+class ParamMask:
+    def __init__(self, include_param: Optional[Callable[[str], bool]] = None) -> None:
+        """
+        Which parameters an aggregated update is applied to, resolved once per
+        model layout into the ranges of the flat buffer that must keep their
+        global value, so aggregation never re-checks parameter names.
+
+        Tensors the layout marks as skipped are always excluded.
+
+        Args:
+            include_param (callable, optional): whether the update is applied to
+                the named parameter. Defaults to every tensor that is not skipped.
+        """
+        self.include_param = include_param
+        self._excluded: Dict[ParamLayout, List[slice]] = {}
+        self._lock = Lock()
+
+    def __call__(self, name: str) -> bool:
+        return self.include_param is None or self.include_param(name)
+
+    def excluded(self, layout: ParamLayout) -> List[slice]:
+        """
+        Get the ranges of the flat buffer holding excluded parameters, merging
+        adjacent parameters into one range.
+        """
+        with self._lock:
+            if layout not in self._excluded:
+                if self.include_param is None:
+                    self._excluded[layout] = list(layout.role_ranges[SKIPPED])
+                    return self._excluded[layout]
+
+                ranges = []
+                for name, role in zip(layout.names, layout.roles):
+                    if role != SKIPPED and self.include_param(name):
+                        continue
+                    param_slice = layout.slice(name)
+                    if len(ranges) > 0 and ranges[-1].stop == param_slice.start:
+                        ranges[-1] = slice(ranges[-1].start, param_slice.stop)
+                    else:
+                        ranges.append(param_slice)
+                self._excluded[layout] = ranges
+            return self._excluded[layout]
+
+    def restore(self, new_model: FlatParams, global_model: FlatParams):
+        """
+        Copy the excluded parameters of the global model back into a new one.
+        """
+        with torch.no_grad():
+            for param_slice in self.excluded(global_model.layout):
+                new_model.flat[param_slice] = global_model.flat[param_slice]
+
+
+# Mask excluding only the tensors each layout marks as skipped.
+_skipped_mask = ParamMask()
+
+
+def as_param_mask(
+    include_param: Optional[Union[Callable[[str], bool], ParamMask]],
+) -> ParamMask:
+    """
+    Wrap a parameter predicate in a ParamMask, unless it already is one. Without
+    a predicate, the mask only excludes tensors the layout marks as skipped.
+    """
+    if include_param is None:
+        return _skipped_mask
+    if isinstance(include_param, ParamMask):
+        return include_param
+    return ParamMask(include_param)
+
+
+def apply_weighted_stacked(
+    global_model: FlatParams,
+    stacked: torch.Tensor,
+    weights: Sequence[float],
+    include_param: Optional[Union[Callable[[str], bool], ParamMask]] = None,
+) -> FlatParams:
+    """
+    Compute the global model plus the weighted sum of the rows of a stacked
+    (num updates, numel) delta matrix, as one fused matrix-vector product per
+    shard of the flat buffer, or one compiled kernel per shard if enabled with
+    set_compiled.
+
+    Args:
+        global_model: current global model parameters.
+        stacked: update deltas, one per row, e.g. from stack_deltas.
+        weights: weight of each row.
+        include_param (callable or ParamMask, optional): whether the weighted
+            update is applied to the named parameter. Parameters for which this
+            returns False keep their global value, as do tensors the layout of
+            the global model marks as skipped. Pass a ParamMask to reuse the
+            resolved parameter ranges across calls. Defaults to all parameters.
+
+    Returns:
+        FlatParams: the new global model, in a newly allocated buffer.
+    """
+    weights = torch.as_tensor(weights, dtype=stacked.dtype, device=stacked.device)
+    new_model = FlatParams(torch.empty_like(global_model.flat), global_model.layout)
+    compiled_weighted_sum = _compiled_weighted_sum
+
+    def kernel(shard):
+        flat_slice, _ = shard
+        with torch.no_grad():
+            if compiled_weighted_sum is not None:
+                compiled_weighted_sum(
+                    new_model.flat[flat_slice],
+                    global_model.flat[flat_slice],
+                    stacked[:, flat_slice],
+                    weights,
+                )
+                return
+
+            torch.addmv(
+                global_model.flat[flat_slice],
+                stacked[:, flat_slice].t(),
+                weights,
+                out=new_model.flat[flat_slice],
+            )
+
+    _run_sharded(kernel, _shards(global_model.layout, param_aligned=False))
+    as_param_mask(include_param).restore(new_model, global_model)
+    return new_model
+
+
+def apply_weighted_deltas(
+    global_model: ModelParams,
+    client_updates: List[ClientUpdate],
+    weights: Sequence[float],
+    include_param: Optional[Union[Callable[[str], bool], ParamMask]] = None,
+) -> FlatParams:
+    """
+    Compute the global model plus the weighted sum of the client update deltas.
+
+    Each delta is accumulated straight into the new global model with one fused
+    multiply-add, over the whole flat buffer for flat deltas or over every
+    parameter at once otherwise, rather than stacking the deltas first (which
+    costs an extra copy of every update). Weights are used as given, so
+    strategies that average should normalize them.
+
+    Compressed deltas are added without being decompressed first.
+
+    Large models are split into contiguous shards of the flat buffer which are
+    aggregated concurrently, see set_num_threads. If enabled with set_compiled,
+    uncompressed deltas are instead stacked, at the cost of a copy, and summed
+    by a single compiled kernel per shard, see apply_weighted_stacked.
+
+    Args:
+        global_model: current global model parameters.
+        client_updates: client updates to aggregate.
+        weights: weight of each client update.
+        include_param (callable or ParamMask, optional): whether the weighted
+            update is applied to the named parameter. Parameters for which this
+            returns False keep their global value, as do tensors the layout of
+            the global model marks as skipped. Pass a ParamMask to reuse the
+            resolved parameter ranges across calls. Defaults to all parameters.
+
+    Returns:
+        FlatParams: the new global model, in a newly allocated buffer.
+    """
+    assert len(weights) == len(client_updates)
+    if not isinstance(global_model, FlatParams):
+        global_model = FlatParams.from_params(global_model)
+
+    uncompressed, deltas, compressed = [], [], []
+    for update, weight in zip(client_updates, weights):
+        if weight == 0:
+            continue
+        if isinstance(update, DeltaUpdate) and isinstance(
+            update.delta, CompressedDelta
+        ):
+            compressed.append((update.delta, weight))
+        else:
+            uncompressed.append(update)
+            deltas.append((get_update_delta(update), weight))
+
+    if _compiled_weighted_sum is not None and len(deltas) > 0:
+        new_model = apply_weighted_stacked(
+            global_model,
+            stack_deltas(
+                uncompressed, global_model.layout, device=global_model.flat.device
+            ),
+            [weight for _, weight in deltas],
+        )
+    else:
+        new_model = FlatParams(torch.empty_like(global_model.flat), global_model.layout)
+        new_views = [view for _, view in new_model]
+        delta_tensors = [
+            None if isinstance(delta, FlatParams) else [tensor for _, tensor in delta]
+            for delta, _ in deltas
+        ]
+
+        def kernel(shard):
+            flat_slice, param_slice = shard
+            with torch.no_grad():
+                new_model.flat[flat_slice].copy_(global_model.flat[flat_slice])
+                for (delta, weight), tensors in zip(deltas, delta_tensors):
+                    if tensors is None:
+                        new_model.flat[flat_slice].add_(
+                            delta.flat[flat_slice], alpha=weight
+                        )
+                    else:
+                        torch._foreach_add_(
+                            new_views[param_slice], tensors[param_slice], alpha=weight
+                        )
+
+        param_aligned = any(tensors is not None for tensors in delta_tensors)
+        _run_sharded(kernel, _shards(global_model.layout, param_aligned))
+
+    # Compressed deltas are added straight from their compressed form.
+    with torch.no_grad():
+        for delta, weight in compressed:
+            delta.to(new_model.flat.device).add_to(new_model.flat, alpha=weight)
+
+    as_param_mask(include_param).restore(new_model, global_model)
+    return new_model
@@ -1,26 +1,43 @@
+import heapq
+import math
 import time
+from collections import deque
+from itertools import count
 from threading import Condition, Lock
-from typing import List
+from typing import Callable, List, Literal, Optional
 
+import torch
+
+from afl_bench.params import FlatParams
 from afl_bench.types import ClientUpdate
+from afl_bench.updates import StreamedUpdate, coalesce_updates, get_update_delta
 
 
 class Buffer:
-    def __init__(self, wait_for_full=True, n=None, ms_to_wait=None) -> None:
+    def __init__(
+        self,
+        wait_for_full=True,
+        n=None,
+        ms_to_wait=None,
+        on_discard: Optional[Callable[[ClientUpdate], None]] = None,
+    ) -> None:
         """
         Initializes a thread safe buffer which receives updates in thread safe manner
         and retrieves n-length windows of items.
 
         Args:
             wait_for_full (bool, optional): whether we should wait for all n or
-                just return current state. Defaults to True.
+                just return current state. Without ms_to_wait either, get_items
+                waits until at least one item is buffered. Defaults to True.
             n (int, optional): number of items that buffer is considered full. Defaults to None.
             ms_to_wait (int, optional): number of milliseconds to wait for buffer to be full.
-                Defaults to None.
+                Combined with wait_for_full, items are returned as soon as the buffer
+                is full or once this many milliseconds have passed, whichever is
+                first. Defaults to None.
+            on_discard (callable, optional): called with each update the buffer
+                consumes or drops itself instead of dispensing it from get_items,
+                e.g. to release the global model snapshot it references.
         """
-        assert wait_for_full != (
-            ms_to_wait is not None
-        ), "Must specify one of wait_for_full or ms_to_wait."
         assert not (
             wait_for_full and n is None
         ), "Must specify length if waiting for full buffer."
@@ -28,12 +45,30 @@ class Buffer:
         self.wait_for_full = wait_for_full
         self.n = n
         self.ms_to_wait = ms_to_wait
+        self.on_discard = on_discard
 
-        self.buffer = []
+        self.buffer = deque()
+        self.closed = False
 
         self.mutex = Lock()
         self.full_cv = Condition(self.mutex)
 
+    # Storage hooks, which subclasses override to change how updates are held.
+    # All are called with self.mutex held.
+
+    def _append(self, item: ClientUpdate):
+        self.buffer.append(item)
+
+    def _size(self) -> int:
+        return len(self.buffer)
+
+    def _take(self, k: int) -> List[ClientUpdate]:
+        return [self.buffer.popleft() for _ in range(k)]
+
+    def _discard(self, item: ClientUpdate):
+        if self.on_discard is not None:
+            self.on_discard(item)
+
     def add(self, item: ClientUpdate):
         """
         Add an item to the buffer, signalling if adding the item makes the
@@ -43,38 +78,62 @@ class Buffer:
             item: item to be added to the buffer.
         """
         with self.mutex:
-            self.buffer.append(item)
-            if len(self.buffer) == self.n:
+            self._append(item)
+            # Also wake a consumer waiting for any item at all.
+            if self._size() == self.n or self._size() == 1:
                 self.full_cv.notify_all()
 
-    def get_items(self) -> List[ClientUpdate]:
+    def close(self):
+        """
+        Signal that no more items will be taken from the buffer, waking any
+        producers blocked waiting for space and any consumer waiting for items.
+        """
+        with self.mutex:
+            self.closed = True
+            self.full_cv.notify_all()
+
+    def get_items(self, block=True) -> List[ClientUpdate]:
         """
         Get relevant buffer items given length of buffer requested.
 
+        Args:
+            block (bool, optional): whether to wait according to the buffer's
+                flush policy. If False, return whatever is currently buffered
+                (up to n items) immediately. Defaults to True.
+
         Returns:
             list: relevant buffer items given length of buffer requested and
             whether to wait for buffer to be full.
         """
         with self.mutex:
-            if self.wait_for_full:
+            if block and self.ms_to_wait is not None:
+                # Wait a number of ms for the buffer, or until it is full if also
+                # waiting for full. Waiting on the condition releases the mutex, so
+                # clients can keep adding in the meantime.
+                deadline = time.monotonic() + self.ms_to_wait / 1000
+                while not self.closed and not (
+                    self.wait_for_full and self._size() >= self.n
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.full_cv.wait(remaining)
+            elif block and self.wait_for_full:
                 # Wait for the buffer to be full
-                while len(self.buffer) < self.n:
+                while self._size() < self.n and not self.closed:
+                    self.full_cv.wait()
+            elif block:
+                # Return the current state, but never an empty one, so a consumer
+                # looping on get_items does not spin while nothing arrives.
+                while self._size() == 0 and not self.closed:
                     self.full_cv.wait()
-            else:
-                # Otherwise wait a number of ms for the buffer.
-                time.sleep(self.ms_to_wait / 1000)
 
             # Slice out first length elements (or all elements if buffer is not full)
             slice_length = (
-                min(self.n, len(self.buffer))
-                if self.n is not None
-                else len(self.buffer)
+                min(self.n, self._size()) if self.n is not None else self._size()
             )
 
-            relevant_slice = self.buffer[:slice_length]
-            self.buffer = self.buffer[slice_length:]
-
-            return relevant_slice
+            return self._take(slice_length)
 
     def __len__(self) -> int:
         """
@@ -84,4 +143,344 @@ class Buffer:
             int: length of the buffer.
         """
         with self.mutex:
-            return len(self.buffer)
+            return self._size()
+
+
+class StreamingBuffer(Buffer):
+    def __init__(
+        self,
+        log_weight: Callable[[ClientUpdate], float],
+        wait_for_full=True,
+        n=None,
+        ms_to_wait=None,
+        on_discard: Optional[Callable[[ClientUpdate], None]] = None,
+    ) -> None:
+        """
+        Buffer for weighted-sum strategies which folds each update's delta into a
+        running weighted sum as it arrives instead of storing it, so memory is
+        one model regardless of buffer size and a flush only has to normalize.
+
+        Weights are accumulated in log space relative to the largest log weight
+        seen so far, rescaling the sum whenever a larger one arrives, so that
+        e.g. staleness exponentials of large version numbers cannot overflow.
+        Normalizing at flush time cancels any factor common to all weights, such
+        as one depending only on the version at flush time.
+
+        Folded updates are passed to on_discard straight away since the buffer
+        no longer needs them. A flush dispenses everything folded so far (which
+        may be more than n) as a single StreamedUpdate, or nothing if empty.
+
+        Args:
+            log_weight (callable): maps an update to the log of its unnormalized
+                weight. Updates with weight -inf count towards n but are ignored.
+            wait_for_full, n, ms_to_wait, on_discard: as for Buffer.
+        """
+        super().__init__(
+            wait_for_full=wait_for_full,
+            n=n,
+            ms_to_wait=ms_to_wait,
+            on_discard=on_discard,
+        )
+        self.log_weight = log_weight
+        self._reset()
+
+    def _reset(self):
+        self.accumulator: Optional[List[torch.Tensor]] = None
+        self.template = None
+        self.max_log_weight = -math.inf
+        self.total_weight = 0.0
+        self.client_ids = []
+        self.version_numbers = []
+
+    def _append(self, item: ClientUpdate):
+        log_weight = self.log_weight(item)
+        self.client_ids.append(item[0])
+        self.version_numbers.append(item[3])
+
+        if log_weight != -math.inf:
+            delta = get_update_delta(item)
+            tensors = (
+                [delta.flat]
+                if isinstance(delta, FlatParams)
+                else [tensor for _, tensor in delta]
+            )
+
+            with torch.no_grad():
+                if self.accumulator is None:
+                    self.accumulator = [tensor.detach().clone() for tensor in tensors]
+                    self.template = delta
+                    self.max_log_weight = log_weight
+                    self.total_weight = 1.0
+                elif log_weight > self.max_log_weight:
+                    # Rescale the running sum so the new update has weight 1.
+                    scale = math.exp(self.max_log_weight - log_weight)
+                    for acc, tensor in zip(self.accumulator, tensors):
+                        acc.mul_(scale).add_(tensor)
+                    self.max_log_weight = log_weight
+                    self.total_weight = self.total_weight * scale + 1.0
+                else:
+                    weight = math.exp(log_weight - self.max_log_weight)
+                    for acc, tensor in zip(self.accumulator, tensors):
+                        acc.add_(tensor, alpha=weight)
+                    self.total_weight += weight
+
+        self._discard(item)
+
+    def _size(self) -> int:
+        return len(self.version_numbers)
+
+    def _take(self, k: int) -> List[StreamedUpdate]:
+        if self._size() == 0:
+            return []
+
+        delta = None
+        if self.accumulator is not None:
+            with torch.no_grad():
+                for acc in self.accumulator:
+                    acc.div_(self.total_weight)
+
+            if isinstance(self.template, FlatParams):
+                delta = FlatParams(self.accumulator[0], self.template.layout)
+            else:
+                delta = [
+                    (name, acc)
+                    for (name, _), acc in zip(self.template, self.accumulator)
+                ]
+
+        update = StreamedUpdate(delta, self.client_ids, self.version_numbers)
+        self._reset()
+        return [update]
+
+
+OverflowPolicy = Literal["block", "drop_oldest", "drop_stalest", "coalesce"]
+
+
+class RingBuffer(Buffer):
+    def __init__(
+        self,
+        capacity: int,
+        overflow_policy: OverflowPolicy = "block",
+        wait_for_full=True,
+        n=None,
+        ms_to_wait=None,
+        on_discard: Optional[Callable[[ClientUpdate], None]] = None,
+    ) -> None:
+        """
+        Buffer holding at most capacity updates in a fixed ring of slots, which
+        bounds the number of client models held when clients outpace the server.
+
+        When an update arrives at a full buffer, the overflow policy decides
+        what happens:
+            - block: the producer waits until the server takes items.
+            - drop_oldest: the earliest buffered update is dropped.
+            - drop_stalest: the update trained on the oldest global version is
+                dropped, which may be the arriving update itself.
+            - coalesce: the arriving update is averaged into the most recently
+                buffered one, weighted by how many updates each already holds.
+                The merged update keeps the older base model and version.
+
+        Dropped updates, and the newer side of a coalesced pair, are passed to
+        on_discard.
+
+        Args:
+            capacity (int): maximum number of buffered updates. Must be at least n.
+            overflow_policy (str, optional): one of block, drop_oldest,
+                drop_stalest or coalesce. Defaults to block.
+            wait_for_full, n, ms_to_wait, on_discard: as for Buffer.
+        """
+        super().__init__(
+            wait_for_full=wait_for_full,
+            n=n,
+            ms_to_wait=ms_to_wait,
+            on_discard=on_discard,
+        )
+        assert n is None or capacity >= n, "Capacity must be at least n."
+        assert overflow_policy in (
+            "block",
+            "drop_oldest",
+            "drop_stalest",
+            "coalesce",
+        ), f"Unknown overflow policy {overflow_policy}."
+
+        self.capacity = capacity
+        self.overflow_policy = overflow_policy
+
+        # Slots of the ring, with the number of client updates merged into each.
+        self.slots: List[Optional[ClientUpdate]] = [None] * capacity
+        self.counts = [0] * capacity
+        self.head = 0
+        self.count = 0
+        self.num_dropped = 0
+
+        self.not_full_cv = Condition(self.mutex)
+
+    def _slot(self, i: int) -> int:
+        return (self.head + i) % self.capacity
+
+    def _pop(self, i: int) -> ClientUpdate:
+        # Remove the i-th oldest item, shifting the older items up one slot.
+        item = self.slots[self._slot(i)]
+        for j in range(i, 0, -1):
+            self.slots[self._slot(j)] = self.slots[self._slot(j - 1)]
+            self.counts[self._slot(j)] = self.counts[self._slot(j - 1)]
+        self.slots[self.head] = None
+        self.head = self._slot(1)
+        self.count -= 1
+        return item
+
+    def _drop(self, item: ClientUpdate):
+        self.num_dropped += 1
+        self._discard(item)
+
+    def _append(self, item: ClientUpdate):
+        while self.count == self.capacity and self.overflow_policy == "block":
+            if self.closed:
+                self._drop(item)
+                return
+            self.not_full_cv.wait()
+
+        if self.count == self.capacity:
+            if self.overflow_policy == "drop_oldest":
+                self._drop(self._pop(0))
+            elif self.overflow_policy == "drop_stalest":
+                stalest = min(
+                    range(self.count), key=lambda i: self.slots[self._slot(i)][3]
+                )
+                if item[3] < self.slots[self._slot(stalest)][3]:
+                    self._drop(item)
+                    return
+                self._drop(self._pop(stalest))
+            else:
+                newest = self._slot(self.count - 1)
+                merged, discarded = coalesce_updates(
+                    self.slots[newest], item, self.counts[newest], 1
+                )
+                self.slots[newest] = merged
+                self.counts[newest] += 1
+                self._discard(discarded)
+                return
+
+        tail = self._slot(self.count)
+        self.slots[tail] = item
+        self.counts[tail] = 1
+        self.count += 1
+
+    def _size(self) -> int:
+        return self.count
+
+    def _take(self, k: int) -> List[ClientUpdate]:
+        items = [self._pop(0) for _ in range(k)]
+        if k > 0:
+            self.not_full_cv.notify_all()
+        return items
+
+    def close(self):
+        super().close()
+        with self.mutex:
+            self.not_full_cv.notify_all()
+
+    @property
+    def occupancy(self) -> float:
+        """
+        Fraction of the buffer's capacity currently in use.
+        """
+        with self.mutex:
+            return self.count / self.capacity
+
+
+class PriorityBuffer(Buffer):
+    def __init__(
+        self,
+        order: Literal["freshest", "stalest"] = "freshest",
+        key: Optional[Callable[[ClientUpdate], float]] = None,
+        weight_fn: Optional[Callable[[ClientUpdate, int], float]] = None,
+        min_weight: Optional[float] = None,
+        version_fn: Optional[Callable[[], int]] = None,
+        wait_for_full=True,
+        n=None,
+        ms_to_wait=None,
+        on_discard: Optional[Callable[[ClientUpdate], None]] = None,
+    ) -> None:
+        """
+        Buffer backed by a heap which dispenses the highest (freshest first) or
+        lowest (stalest first) priority updates rather than the earliest, so a
+        flush of n items picks the n most useful of everything buffered.
+
+        If weight_fn and min_weight are given, updates whose weight at the
+        current global version is below min_weight are passed to on_discard
+        instead of being aggregated, both on arrival and at every flush. A flush
+        may therefore dispense fewer than n updates even when waiting for full.
+
+        Args:
+            order (str, optional): freshest or stalest. Defaults to freshest.
+            key (callable, optional): priority of an update, where larger is
+                fresher. Defaults to the global version it was trained on.
+            weight_fn (callable, optional): unnormalized weight of an update given
+                the current global version.
+            min_weight (float, optional): threshold below which updates are
+                discarded.
+            version_fn (callable, optional): returns the current global version.
+                Required with weight_fn.
+            wait_for_full, n, ms_to_wait, on_discard: as for Buffer.
+        """
+        super().__init__(
+            wait_for_full=wait_for_full,
+            n=n,
+            ms_to_wait=ms_to_wait,
+            on_discard=on_discard,
+        )
+        assert order in ("freshest", "stalest"), f"Unknown order {order}."
+        assert (weight_fn is None) == (
+            min_weight is None
+        ), "Must specify both weight_fn and min_weight or neither."
+        assert not (
+            weight_fn is not None and version_fn is None
+        ), "Must specify version_fn to compute update weights."
+
+        self.order = order
+        self.key = key if key is not None else (lambda update: update[3])
+        self.weight_fn = weight_fn
+        self.min_weight = min_weight
+        self.version_fn = version_fn
+
+        # Heap of (priority, sequence number, update), where sequence numbers keep
+        # updates of equal priority in arrival order.
+        self.heap = []
+        self.sequence = count()
+        self.num_discarded = 0
+
+    def _is_useful(self, item: ClientUpdate, version: int) -> bool:
+        return (
+            self.weight_fn is None or self.weight_fn(item, version) >= self.min_weight
+        )
+
+    def _append(self, item: ClientUpdate):
+        if not self._is_useful(item, self.version_fn() if self.version_fn else None):
+            self.num_discarded += 1
+            self._discard(item)
+            return
+
+        priority = self.key(item)
+        if self.order == "freshest":
+            priority = -priority
+        heapq.heappush(self.heap, (priority, next(self.sequence), item))
+
+    def _size(self) -> int:
+        return len(self.heap)
+
+    def _take(self, k: int) -> List[ClientUpdate]:
+        if self.weight_fn is not None:
+            # Weights only change with the global version, so sweep once per flush.
+            version = self.version_fn()
+            kept = []
+            for entry in self.heap:
+                if self._is_useful(entry[2], version):
+                    kept.append(entry)
+                else:
+                    self.num_discarded += 1
+                    self._discard(entry[2])
+            if len(kept) < len(self.heap):
+                heapq.heapify(kept)
+                self.heap = kept
+
+        return [heapq.heappop(self.heap)[2] for _ in range(min(k, len(self.heap)))]
@@ -0,0 +1,262 @@
+import logging
+import random
+from threading import Thread
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import wandb
+from afl_bench.agents.client_thread import run_client_loop
+from afl_bench.agents.clients import Client
+from afl_bench.agents.common import get_parameters
+from afl_bench.agents.runtime_model import RuntimeModel
+from afl_bench.agents.server import ServerInterface, StaleUpdateError
+from afl_bench.compression import Codec, CompressedDelta
+from afl_bench.types import ModelParams
+
+logger = logging.getLogger(__name__)
+
+
+class _ServerConnection(ServerInterface):
+    """
+    Worker-side stand-in for the server which forwards calls over a pipe to the
+    owning ClientProcess. Model parameters are exchanged through shared-memory
+    tensors, so only version numbers and flags are pickled. Compressed deltas
+    are small and sized per update, so they are sent over the pipe instead.
+    """
+
+    def __init__(self, conn, shared_global: ModelParams, shared_update: ModelParams):
+        self.conn = conn
+        self.shared_global = shared_global
+        self.shared_update = shared_update
+
+    def get_current_model(
+        self, prev_version: Optional[int] = None
+    ) -> Tuple[ModelParams, int]:
+        self.conn.send(("pull", prev_version))
+        version = self.conn.recv()
+        return self.shared_global, version
+
+    def broadcast_updated_model(
+        self,
+        client_id: int,
+        old_params: ModelParams,
+        new_params: ModelParams,
+        version_number: int,
+    ):
+        with torch.no_grad():
+            for (_, shared_p), (_, new_p) in zip(self.shared_update, new_params):
+                shared_p.copy_(new_p)
+        self.conn.send(("push", version_number))
+        return self._recv_push_reply()
+
+    def broadcast_update_delta(
+        self,
+        client_id: int,
+        delta: ModelParams,
+        version_number: int,
+    ):
+        if isinstance(delta, CompressedDelta):
+            self.conn.send(("push_compressed", (version_number, delta)))
+            return self._recv_push_reply()
+
+        with torch.no_grad():
+            for (_, shared_p), (_, delta_p) in zip(self.shared_update, delta):
+                shared_p.copy_(delta_p)
+        self.conn.send(("push_delta", version_number))
+        return self._recv_push_reply()
+
+    def _recv_push_reply(self):
+        reply = self.conn.recv()
+        if isinstance(reply, StaleUpdateError):
+            raise reply
+        return reply
+
+    def log(self, data):
+        self.conn.send(("log", data))
+
+
+def _run_worker(
+    client: Client,
+    runtime_model: RuntimeModel,
+    client_id: int,
+    seed: int,
+    num_threads: int,
+    stop_event,
+    conn,
+    shared_global: ModelParams,
+    shared_update: ModelParams,
+    train_config,
+    eval_config,
+    codec,
+):
+    # Limit intra-op threads so that worker processes do not oversubscribe cores.
+    torch.set_num_threads(num_threads)
+
+    random.seed(seed)
+    torch.random.manual_seed(seed)
+    np.random.seed(seed)
+
+    server = _ServerConnection(conn, shared_global, shared_update)
+    run_client_loop(
+        client,
+        server,
+        runtime_model,
+        client_id,
+        lambda: not stop_event.is_set(),
+        train_config,
+        eval_config,
+        log=server.log,
+        codec=codec,
+    )
+    conn.close()
+
+
+class ClientProcess:
+    def __init__(
+        self,
+        client: Client,
+        server: ServerInterface,
+        runtime_model: RuntimeModel,
+        client_id: int,
+        start_seed=42,
+        num_threads=1,
+        start_method=None,
+        codec: Optional[Codec] = None,
+    ) -> None:
+        """
+        Runs a client in its own worker process rather than a thread, so that
+        local training is not serialized behind the GIL. The server stays in the
+        parent process and a proxy thread serves the worker's requests against it,
+        so the ServerInterface contract is unchanged.
+
+        Args:
+            client: client to train in the worker process.
+            server: server to pull global models from and push updates to.
+            runtime_model: runtime model used to simulate slow clients.
+            client_id: id of the client.
+            start_seed (int, optional): seed offset, the worker is seeded with
+                start_seed + client_id. Defaults to 42.
+            num_threads (int, optional): torch intra-op threads in the worker.
+                Defaults to 1.
+            start_method (str, optional): multiprocessing start method. Defaults
+                to the platform default.
+            codec (Codec, optional): codec used to compress deltas in the worker
+                before they are sent. Defaults to sending them uncompressed.
+        """
+        self.client = client
+        self.server = server
+        self.client_id = client_id
+        self.runtime_model = runtime_model
+        self.start_seed = start_seed
+        self.num_threads = num_threads
+        self.context = mp.get_context(start_method)
+        self.codec = codec
+
+        self.process = None
+        self.proxy_thread = None
+        self.stop_event = None
+
+    def run(self, train_config={}, eval_config={}):
+        # Initialize process once only
+        if self.process is not None:
+            raise RuntimeError("Client process already running!")
+
+        # Shared-memory buffers used to pull global models and push updates.
+        shared_global = [
+            (name, p.detach().cpu().clone().share_memory_())
+            for name, p in get_parameters(self.client.net)
+        ]
+        shared_update = [
+            (name, p.detach().cpu().clone().share_memory_())
+            for name, p in get_parameters(self.client.net)
+        ]
+
+        parent_conn, child_conn = self.context.Pipe()
+        self.stop_event = self.context.Event()
+
+        def serve():
+            # Global model last pulled by the worker, sent back as old_params.
+            pulled_params = None
+
+            while True:
+                try:
+                    message, payload = parent_conn.recv()
+                except EOFError:
+                    break
+
+                if message == "pull":
+                    pulled_params, version = self.server.get_current_model(
+                        prev_version=payload
+                    )
+                    with torch.no_grad():
+                        for (_, shared_p), (_, p) in zip(shared_global, pulled_params):
+                            shared_p.copy_(p)
+                    parent_conn.send(version)
+                elif message in ("push", "push_delta", "push_compressed"):
+                    if message == "push_compressed":
+                        payload, params = payload
+                    else:
+                        # Copy the update out of shared memory since the worker
+                        # reuses it.
+                        params = [
+                            (name, shared_p.to(p.device, copy=True))
+                            for (name, shared_p), (_, p) in zip(
+                                shared_update, pulled_params
+                            )
+                        ]
+                    try:
+                        if message == "push":
+                            server_running = self.server.broadcast_updated_model(
+                                self.client_id, pulled_params, params, payload
+                            )
+                        else:
+                            server_running = self.server.broadcast_update_delta(
+                                self.client_id, params, payload
+                            )
+                    except StaleUpdateError as e:
+                        # Re-raised in the worker.
+                        parent_conn.send(e)
+                        continue
+                    parent_conn.send(server_running)
+                    if not server_running:
+                        break
+                elif message == "log":
+                    wandb.log(payload)
+
+        self.process = self.context.Process(
+            target=_run_worker,
+            args=(
+                self.client,
+                self.runtime_model,
+                self.client_id,
+                self.start_seed + self.client_id,
+                self.num_threads,
+                self.stop_event,
+                child_conn,
+                shared_global,
+                shared_update,
+                train_config,
+                eval_config,
+                self.codec,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.proxy_thread = Thread(target=serve, daemon=True)
+        self.proxy_thread.start()
+
+    def stop(self):
+        """
+        Stop the client process.
+        """
+        if self.process is not None:
+            self.stop_event.set()
+            self.process.join()
+            self.proxy_thread.join()
+            self.process = None
+            self.proxy_thread = None
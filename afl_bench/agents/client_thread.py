@@ -2,6 +2,7 @@ import logging
 import random
 import time
 from threading import Thread
+from typing import Callable, Optional
 
 import numpy as np
 import torch
@@ -9,11 +10,154 @@ import torch
 import wandb
 from afl_bench.agents.clients import Client
 from afl_bench.agents.runtime_model import RuntimeModel
-from afl_bench.agents.server import ServerInterface
+from afl_bench.agents.server import ServerInterface, StaleUpdateError
+from afl_bench.compression import Codec
+from afl_bench.types import ModelParams
+from afl_bench.updates import compute_delta
 
 logger = logging.getLogger(__name__)
 
 
+def run_local_round(
+    client: Client,
+    client_id: int,
+    global_params: ModelParams,
+    version: int,
+    train_config={},
+    eval_config={},
+    log=None,
+) -> ModelParams:
+    """
+    Fit a client to its local data starting from the given global model, then
+    evaluate the result and log train and eval metrics.
+
+    Args:
+        client: client to train.
+        client_id: id of the client, used to namespace logged metrics.
+        global_params: global model parameters to start local training from.
+        version: version number of the global model being trained on.
+        train_config: config passed to client.fit.
+        eval_config: config passed to client.evaluate.
+        log: function used to log metrics. Defaults to wandb.log.
+
+    Returns:
+        ModelParams: parameters of the client model after local training.
+    """
+    log = log if log is not None else wandb.log
+    new_parameters, _, new_metrics = client.fit(global_params, train_config)
+
+    log(
+        {
+            f"client.{client_id}": {
+                **new_metrics,
+                "global_version": version,
+            }
+        },
+    )
+
+    _, _, metrics = client.evaluate(new_parameters, eval_config)
+    logger.info("Client thread %d metrics: %s", client_id, metrics)
+
+    log(
+        {
+            f"client.{client_id}": {
+                **metrics,
+                "global_version": version,
+            }
+        },
+    )
+
+    return new_parameters
+
+
+def run_client_loop(
+    client: Client,
+    server: ServerInterface,
+    runtime_model: RuntimeModel,
+    client_id: int,
+    is_running: Callable[[], bool],
+    train_config={},
+    eval_config={},
+    log=None,
+    send_delta=True,
+    codec: Optional[Codec] = None,
+):
+    """
+    Repeatedly pull the global model, simulate the client runtime, train and push
+    the update back to the server, until is_running returns False or the server
+    indicates it has stopped.
+
+    Args:
+        client: client to train.
+        server: server to pull global models from and push updates to.
+        runtime_model: runtime model used to simulate slow clients.
+        client_id: id of the client.
+        is_running: callable returning whether the loop should keep running.
+        train_config: config passed to client.fit.
+        eval_config: config passed to client.evaluate.
+        log: function used to log metrics. Defaults to wandb.log.
+        send_delta: whether to send only the change made by local training rather
+            than both the old and new models. Defaults to True.
+        codec: codec used to compress deltas before they are sent, which
+            requires send_delta. Defaults to sending them uncompressed.
+    """
+    assert codec is None or send_delta, "Compression requires sending deltas."
+    prev_version = None
+
+    while is_running():
+        # Get latest global model and simulate client runtime.
+        init_global_params, version = server.get_current_model(
+            prev_version=prev_version
+        )
+
+        logger.info(
+            "Client thread running local training on model version %d",
+            version,
+        )
+
+        # Simulate slow client runtime and fit model to local data.
+        time.sleep(runtime_model.sample_runtime())
+        new_parameters = run_local_round(
+            client,
+            client_id,
+            init_global_params,
+            version,
+            train_config,
+            eval_config,
+            log=log,
+        )
+
+        # Broadcast updated model to server. If server indicates not running, stop.
+        try:
+            if send_delta:
+                delta = compute_delta(init_global_params, new_parameters)
+                if codec is not None:
+                    delta = codec(delta)
+                server_running = server.broadcast_update_delta(
+                    client_id, delta, version
+                )
+            else:
+                server_running = server.broadcast_updated_model(
+                    client_id, init_global_params, new_parameters, version
+                )
+        except StaleUpdateError as e:
+            # The global model has moved on, so the next pull returns immediately.
+            logger.info("Client thread %d update rejected: %s", client_id, e)
+            (log if log is not None else wandb.log)(
+                {
+                    f"client.{client_id}": {
+                        "rejected_staleness": e.current_version - e.version_number,
+                        "global_version": version,
+                    }
+                },
+            )
+            server_running = True
+        prev_version = version
+
+        if not server_running:
+            return
+
+
 class ClientThread:
     def __init__(
         self,
@@ -22,6 +166,8 @@ class ClientThread:
         runtime_model: RuntimeModel,
         client_id: int,
         start_seed=42,
+        send_delta=True,
+        codec: Optional[Codec] = None,
     ) -> None:
         self.client = client
         self.server = server
@@ -30,62 +176,28 @@ class ClientThread:
         self.thread = None
         self.is_running = False
         self.start_seed = start_seed
+        self.send_delta = send_delta
+        self.codec = codec
 
     def run(self, train_config={}, eval_config={}):
         def run_impl():
-            prev_version = None
-
             # Set seed based on client id (otherwise all threads will have same seed).
             random.seed(self.start_seed + self.client_id)
             torch.random.manual_seed(self.start_seed + self.client_id)
             np.random.seed(self.start_seed + self.client_id)
 
-            while self.is_running:
-                # Get latest global model and simulate client runtime.
-                init_global_params, version = self.server.get_current_model(
-                    prev_version=prev_version
-                )
-
-                logger.info(
-                    "Client thread running local training on model version %d",
-                    version,
-                )
-
-                # Simulate slow client runtime and fit model to local data.
-                time.sleep(self.runtime_model.sample_runtime())
-                new_parameters, _, new_metrics = self.client.fit(
-                    init_global_params, train_config
-                )
-
-                wandb.log(
-                    {
-                        f"client.{self.client_id}": {
-                            **new_metrics,
-                            "global_version": version,
-                        }
-                    },
-                )
-
-                _, _, metrics = self.client.evaluate(new_parameters, eval_config)
-                logger.info("Client thread %d metrics: %s", self.client_id, metrics)
-
-                wandb.log(
-                    {
-                        f"client.{self.client_id}": {
-                            **metrics,
-                            "global_version": version,
-                        }
-                    },
-                )
-
-                # Broadcast updated model to server. If server indicates not running, stop.
-                server_running = self.server.broadcast_updated_model(
-                    self.client_id, init_global_params, new_parameters, version
-                )
-                prev_version = version
-
-                if not server_running:
-                    self.is_running = False
+            run_client_loop(
+                self.client,
+                self.server,
+                self.runtime_model,
+                self.client_id,
+                lambda: self.is_running,
+                train_config,
+                eval_config,
+                send_delta=self.send_delta,
+                codec=self.codec,
+            )
+            self.is_running = False
 
         # Initialize thread once only
         if self.thread is None:
@@ -0,0 +1,133 @@
+import copy
+from typing import Dict, List, Tuple
+
+import torch
+from torch.func import functional_call, grad, replace_all_batch_norm_modules_, vmap
+
+from afl_bench.agents.clients.simple import Client
+from afl_bench.types import ModelParams
+
+
+def _cycle(loader):
+    """Iterate over a dataloader indefinitely, starting a new epoch when exhausted."""
+    while True:
+        for batch in loader:
+            yield batch
+
+
+class BatchedClient:
+    def __init__(self, clients: List[Client]):
+        """
+        Trains several clients together by stacking their parameters and running
+        their local SGD steps as one vectorized computation with torch.func, rather
+        than one Python training loop per client.
+
+        All clients must share a model architecture, number of local steps and
+        learning rate. Each client still trains on its own data loader, but batches
+        are truncated to the smallest batch in each step so they can be stacked.
+
+        Args:
+            clients (List[Client]): clients to train, indexed by client id.
+        """
+        assert len(clients) > 0, "Must specify at least one client."
+        assert all(
+            client.num_steps == clients[0].num_steps and client.lr == clients[0].lr
+            for client in clients
+        ), "Batched clients must share num_steps and lr."
+
+        self.clients = clients
+        self.num_steps = clients[0].num_steps
+        self.lr = clients[0].lr
+        self.device = clients[0].device
+
+        # Stateless template model, batch norm running stats can't be vmapped.
+        self.net = copy.deepcopy(clients[0].net)
+        replace_all_batch_norm_modules_(self.net)
+        self.param_names = {name for name, _ in self.net.named_parameters()}
+
+        criterion = torch.nn.CrossEntropyLoss()
+
+        def compute_loss(params, buffers, images, labels):
+            outputs = functional_call(self.net, (params, buffers), (images,))
+            loss = criterion(outputs, labels)
+            return loss, (loss.detach(), outputs.detach())
+
+        # Per-client gradients over stacked parameters and stacked batches.
+        self._grad_fn = vmap(
+            grad(compute_loss, has_aux=True),
+            in_dims=(0, None, 0, 0),
+            randomness="different",
+        )
+
+    def fit(
+        self, client_ids: List[int], parameters: List[ModelParams], config
+    ) -> List[Tuple[ModelParams, int, Dict]]:
+        """
+        Fit several clients at once, each starting from its own parameters.
+
+        Args:
+            client_ids: ids of the clients to train.
+            parameters: parameters to start from, one per client in client_ids.
+            config: train config (unused, for parity with Client.fit).
+
+        Returns:
+            list: (new parameters, number of train batches, metrics) per client, as
+            returned by Client.fit.
+        """
+        assert len(client_ids) == len(parameters)
+
+        # Only parameters are trained. Buffers such as batch norm running stats
+        # can't be tracked under vmap, so they are returned unchanged.
+        names = [name for name, _ in parameters[0]]
+        stacked = {
+            name: torch.stack([params[i][1].detach() for params in parameters]).to(
+                self.device
+            )
+            for i, name in enumerate(names)
+            if name in self.param_names
+        }
+        buffers = {name: b.to(self.device) for name, b in self.net.named_buffers()}
+        iterators = [_cycle(self.clients[i].trainloader) for i in client_ids]
+
+        self.net.train()
+
+        total_count = 0
+        correct_count = torch.zeros(len(client_ids), device=self.device)
+        for _ in range(self.num_steps):
+            batches = [next(iterator) for iterator in iterators]
+            batch_size = min(labels.size(0) for _, labels in batches)
+            images = torch.stack([images[:batch_size] for images, _ in batches])
+            labels = torch.stack([labels[:batch_size] for _, labels in batches])
+            images = images.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+
+            grads, (losses, outputs) = self._grad_fn(stacked, buffers, images, labels)
+
+            # Plain SGD step on every client's parameters at once.
+            with torch.no_grad():
+                for name in stacked:
+                    stacked[name].sub_(grads[name], alpha=self.lr)
+
+                total_count += batch_size
+                correct_count += (torch.argmax(outputs, -1) == labels).sum(-1)
+
+        return [
+            (
+                [
+                    (name, stacked[name][k] if name in stacked else tensor)
+                    for name, tensor in parameters[k]
+                ],
+                len(self.clients[client_id].trainloader),
+                {
+                    "avg_loss": float(losses[k]),
+                    "avg_accuracy": float(correct_count[k] / total_count),
+                },
+            )
+            for k, client_id in enumerate(client_ids)
+        ]
+
+    def evaluate(self, client_id: int, parameters: ModelParams, config):
+        """
+        Evaluate the given parameters on a client's validation set.
+        """
+        return self.clients[client_id].evaluate(parameters, config)
@@ -1,12 +1,21 @@
 import torch
 from torch.profiler import ProfilerActivity, profile, record_function
 
-from afl_bench.agents.common import get_parameters, set_parameters
+from afl_bench.agents.common import flatten_module_, get_parameters, set_parameters
+from afl_bench.agents.compiled import compiled_forward_loss, forward_loss
 
 
 class Client:
     def __init__(
-        self, net, trainloader, valloader, num_steps=10, lr=0.001, device="cpu"
+        self,
+        net,
+        trainloader,
+        valloader,
+        num_steps=10,
+        lr=0.001,
+        device="cpu",
+        compiled=False,
+        flat_storage=False,
     ):
         self.net = net
         self.trainloader = trainloader
@@ -14,13 +23,22 @@ class Client:
         self.num_steps = num_steps
         self.lr = lr
         self.device = device
+        # Whether to train with the forward and backward pass compiled by
+        # torch.compile, shared between clients with the same architecture.
+        self.compiled = compiled
+        # Whether the model's state lives in one flat buffer, so pulls and pushes
+        # are a single copy. Gradients are then kept in place rather than freed.
+        self.flat_storage = flat_storage
+        if flat_storage:
+            flatten_module_(net)
         self.optimizer = torch.optim.SGD(net.parameters(), lr=lr)
 
     def get_parameters(self, config):
         return get_parameters(self.net)
 
     def fit(self, parameters, config):
-        set_parameters(self.net, parameters)
+        # Training zeroes the gradients before the first step.
+        set_parameters(self.net, parameters, zero_grad=False)
         avg_epoch_loss, avg_epoch_acc = _train(
             self.net,
             self.trainloader,
@@ -28,6 +46,10 @@ class Client:
             self.num_steps,
             device=self.device,
             lr=self.lr,
+            forward_loss=(
+                compiled_forward_loss(self.net) if self.compiled else forward_loss
+            ),
+            set_to_none=not self.flat_storage,
         )
         return (
             get_parameters(self.net),
@@ -40,17 +62,24 @@ class Client:
         )
 
     def evaluate(self, parameters, config):
-        set_parameters(self.net, parameters)
+        set_parameters(self.net, parameters, zero_grad=False)
         loss, accuracy = _test(self.net, self.valloader, device=self.device)
         return float(loss), len(self.valloader), {"accuracy": float(accuracy)}
 
 
-def _train(net, trainloader, optimizer, num_steps: int, device="cpu", lr=0.001):
+def _train(
+    net,
+    trainloader,
+    optimizer,
+    num_steps: int,
+    device="cpu",
+    lr=0.001,
+    forward_loss=forward_loss,
+    set_to_none=True,
+):
     """Train the network on the training set."""
 
-    criterion = torch.nn.CrossEntropyLoss()
-
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=set_to_none)
     net.train()
 
     step_count = 0
@@ -68,9 +97,8 @@ def _train(net, trainloader, optimizer, num_steps: int, device="cpu", lr=0.001):
             images = images.to(device, non_blocking=True)
             labels = labels.to(device, non_blocking=True)
 
-            optimizer.zero_grad()
-            outputs = net(images)
-            loss = criterion(outputs, labels)
+            optimizer.zero_grad(set_to_none=set_to_none)
+            outputs, loss = forward_loss(net, images, labels)
             loss.backward()
             optimizer.step()
 
@@ -1,16 +1,233 @@
-from typing import List, Tuple
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
 import torch
 
+from afl_bench.params import FlatParams, ParamLayout
+from afl_bench.types import ModelParams
 
-def get_parameters(net) -> List[torch.Tensor]:
-    return [(name, val) for name, val in net.named_parameters()]
 
+class _ModelState:
+    def __init__(self, net: torch.nn.Module) -> None:
+        """
+        Index of a model's state built once per model instance: the names and
+        layout of its state_dict, and the module dict each tensor lives in. Tensors
+        are looked up in those dicts on every use rather than cached, so the index
+        keeps up with tensors reassigned e.g. by .to(), but modules must not gain
+        or lose parameters or buffers afterwards.
+        """
+        containers: Dict[str, Tuple[dict, str]] = {}
+        for prefix, module in net.named_modules(remove_duplicate=False):
+            prefix = prefix + "." if prefix else ""
+            for key in module._parameters:
+                containers[prefix + key] = (module._parameters, key)
+            for key in module._buffers:
+                containers[prefix + key] = (module._buffers, key)
 
-def set_parameters(net, parameters: List[Tuple[str, torch.Tensor]]):
-    for p, (_, new_p) in zip(net.parameters(), parameters):
-        if p.grad is not None:
-            p.grad.detach()
-            p.grad.zero_()
-        # Update the parameter.
-        p.data.copy_(new_p)
+        self.names = list(net.state_dict(keep_vars=True).keys())
+        self.entries = [containers[name] for name in self.names]
+        self.layout = ParamLayout.from_module(net)
+
+        # Set by flatten_module_: the flat state and gradients the model's tensors
+        # are views of. Non floating point tensors are views of a separate flat
+        # buffer, and are copied to and from their positions in the state.
+        self.flat: Optional[FlatParams] = None
+        self.grad_flat: Optional[torch.Tensor] = None
+        self.others_flat: Optional[torch.Tensor] = None
+        self.others_index: Optional[torch.Tensor] = None
+        # Index of a floating point tensor, and where it and its gradient live in
+        # the flat buffers, to check they have not been moved out of them.
+        self.flat_check = 0
+        self.flat_check_ptr = 0
+        self.grad_check_ptr = 0
+
+    def tensors(self) -> List[torch.Tensor]:
+        return [container[key] for container, key in self.entries]
+
+    def is_flat(self) -> bool:
+        """
+        Whether the model's state still lives in the flat buffer, which moving
+        the model to another device undoes.
+        """
+        if self.flat is None:
+            return False
+        container, key = self.entries[self.flat_check]
+        return container[key].data_ptr() == self.flat_check_ptr
+
+    def grads_are_flat(self) -> bool:
+        container, key = self.entries[self.flat_check]
+        grad = container[key].grad
+        return grad is not None and grad.data_ptr() == self.grad_check_ptr
+
+    def others_to_flat(self):
+        if self.others_flat is not None:
+            self.flat.flat[self.others_index] = self.others_flat.to(self.flat.flat)
+
+    def others_from_flat(self):
+        if self.others_flat is not None:
+            self.others_flat.copy_(self.flat.flat[self.others_index])
+
+
+_model_states: "WeakKeyDictionary[torch.nn.Module, _ModelState]" = WeakKeyDictionary()
+_model_states_lock = Lock()
+
+
+def _model_state(net: torch.nn.Module) -> _ModelState:
+    with _model_states_lock:
+        state = _model_states.get(net)
+        if state is None:
+            state = _model_states[net] = _ModelState(net)
+        return state
+
+
+def get_parameters(net, flat=False) -> ModelParams:
+    """
+    Get the named state of a model, its parameters and persistent buffers such as
+    batch norm running statistics, in state_dict order.
+
+    Args:
+        net: model to get the state of.
+        flat (bool, optional): whether to copy the state into a single FlatParams
+            buffer, laid out with the aggregation role of each tensor, rather than
+            returning references to it. Defaults to False. References to the
+            state of a model flattened with flatten_module_ are a FlatParams.
+    """
+    state = _model_state(net)
+    if state.is_flat():
+        with torch.no_grad():
+            state.others_to_flat()
+        return state.flat.clone() if flat else state.flat
+
+    params = list(zip(state.names, state.tensors()))
+    if flat:
+        return FlatParams.from_params(params, layout=state.layout)
+    return params
+
+
+def set_parameters(net, parameters: ModelParams, zero_grad=True):
+    """
+    Copy a named state (in list or FlatParams form) into a model, as returned by
+    get_parameters, with one multi-tensor copy, or one copy of the flat buffer
+    for a FlatParams state and a model flattened with flatten_module_.
+
+    Args:
+        net: model to copy the state into.
+        parameters: state to copy, in the model's state_dict order.
+        zero_grad (bool, optional): whether to zero the model's gradients. Can be
+            skipped when an optimizer will zero them before they are used.
+            Defaults to True.
+    """
+    state = _model_state(net)
+    if state.is_flat() and isinstance(parameters, FlatParams):
+        assert parameters.layout.numel == state.layout.numel, "State does not match."
+        with torch.no_grad():
+            if zero_grad and state.grads_are_flat():
+                state.grad_flat.zero_()
+            elif zero_grad:
+                _zero_grads(state.tensors())
+            state.flat.flat.copy_(parameters.flat)
+            state.others_from_flat()
+        return
+
+    tensors = state.tensors()
+    sources = [tensor for _, tensor in parameters]
+    assert len(sources) == len(tensors), "State does not match the model."
+
+    with torch.no_grad():
+        if zero_grad:
+            _zero_grads(tensors)
+        try:
+            torch._foreach_copy_(tensors, sources)
+        except RuntimeError:
+            # Combinations of devices the multi-tensor kernel does not support.
+            for tensor, source in zip(tensors, sources):
+                tensor.copy_(source)
+
+
+def _zero_grads(tensors: List[torch.Tensor]):
+    grads = [tensor.grad for tensor in tensors if tensor.grad is not None]
+    if len(grads) > 0:
+        torch._foreach_zero_(grads)
+
+
+def flatten_module_(net) -> FlatParams:
+    """
+    Re-home a model's parameters and floating point buffers onto views of one
+    contiguous flat buffer, and its gradients onto views of another, so that
+    get_parameters and set_parameters move the whole model with a single copy.
+    Named access to the model is unchanged, and optimizers holding its
+    parameters keep working.
+
+    Must be called after moving the model to its device, since moving it
+    allocates new tensors. Optimizers should zero gradients with
+    set_to_none=False to keep them in the flat gradient buffer.
+
+    Args:
+        net: model to flatten in place. Its floating point tensors must share a
+            dtype and device.
+
+    Returns:
+        FlatParams: the model's state, aliasing the model.
+    """
+    state = _model_state(net)
+    tensors = state.tensors()
+    floating = [i for i, tensor in enumerate(tensors) if tensor.is_floating_point()]
+    assert len(floating) > 0, "Model has no floating point state."
+    first = tensors[floating[0]]
+    assert all(
+        tensors[i].dtype == first.dtype and tensors[i].device == first.device
+        for i in floating
+    ), "Floating point state must share a dtype and device."
+    assert len({id(tensor) for tensor in tensors}) == len(
+        tensors
+    ), "Models with tied tensors cannot be flattened."
+
+    others = [i for i, tensor in enumerate(tensors) if not tensor.is_floating_point()]
+    assert all(
+        tensors[i].dtype == tensors[others[0]].dtype for i in others
+    ), "Non floating point state must share a dtype."
+
+    flat = FlatParams.from_params(zip(state.names, tensors), layout=state.layout)
+    grad_flat = torch.zeros_like(flat.flat)
+    grad_views = state.layout.views(grad_flat)
+
+    if len(others) > 0:
+        others_flat = torch.cat([tensors[i].reshape(-1) for i in others])
+        others_views = others_flat.split([state.layout.numels[i] for i in others])
+        for i, view in zip(others, others_views):
+            container, key = state.entries[i]
+            container[key] = view.view(state.layout.shapes[i])
+        state.others_flat = others_flat
+        state.others_index = torch.cat(
+            [
+                torch.arange(
+                    state.layout.offsets[i],
+                    state.layout.offsets[i] + state.layout.numels[i],
+                    device=flat.flat.device,
+                )
+                for i in others
+            ]
+        )
+
+    with torch.no_grad():
+        for (container, key), tensor, (_, view), (_, grad_view) in zip(
+            state.entries, tensors, flat, grad_views
+        ):
+            if not tensor.is_floating_point():
+                continue
+            if isinstance(tensor, torch.nn.Parameter):
+                if tensor.grad is not None:
+                    grad_view.copy_(tensor.grad)
+                tensor.data = view
+                if tensor.requires_grad:
+                    tensor.grad = grad_view
+            else:
+                container[key] = view
+
+    state.flat = flat
+    state.grad_flat = grad_flat
+    state.flat_check = floating[0]
+    state.flat_check_ptr = flat[floating[0]][1].data_ptr()
+    state.grad_check_ptr = grad_views[floating[0]][1].data_ptr()
+    return flat
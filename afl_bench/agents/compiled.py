@@ -0,0 +1,72 @@
+import logging
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from afl_bench.params import ParamLayout
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledFunction:
+    def __init__(self, fn: Callable, name: str, dynamic: Optional[bool] = None) -> None:
+        """
+        Function compiled with torch.compile on first call, which falls back to
+        running eagerly for good if compilation fails, e.g. on unsupported ops or
+        platforms.
+
+        Args:
+            fn: function to compile.
+            name: name of the function for logging.
+            dynamic (bool, optional): whether to compile for dynamic shapes up
+                front, rather than recompiling for the first few distinct shapes.
+                Defaults to torch.compile's default.
+        """
+        self.fn = fn
+        self.name = name
+        self.compiled = (
+            torch.compile(fn, dynamic=dynamic) if hasattr(torch, "compile") else None
+        )
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as e:
+                logger.warning(
+                    "Failed to compile %s, running it eagerly: %s", self.name, e
+                )
+                self.compiled = None
+        return self.fn(*args)
+
+
+def forward_loss(
+    net: torch.nn.Module, images: torch.Tensor, labels: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the outputs of the network and their cross entropy loss.
+    """
+    outputs = net(images)
+    return outputs, F.cross_entropy(outputs, labels)
+
+
+_train_steps: Dict[Tuple[type, ParamLayout], CompiledFunction] = {}
+_train_steps_lock = Lock()
+
+
+def compiled_forward_loss(net: torch.nn.Module) -> CompiledFunction:
+    """
+    Get forward_loss compiled for the architecture of the given network. The
+    compiled function takes the network as an argument, so it is shared by, and
+    only compiled once for, every client with the same architecture. Gradients
+    are computed by the compiled backward when the loss is backpropagated.
+    """
+    key = (type(net), ParamLayout.from_params(net.named_parameters()))
+    with _train_steps_lock:
+        if key not in _train_steps:
+            _train_steps[key] = CompiledFunction(
+                forward_loss, f"train step of {type(net).__name__}"
+            )
+        return _train_steps[key]
@@ -0,0 +1,238 @@
+import heapq
+import logging
+import time
+from itertools import count
+from threading import Condition, Thread
+from typing import List, Optional, Tuple
+
+import torch
+from torch.utils.data import DataLoader
+
+from afl_bench.agents.client_thread import run_local_round
+from afl_bench.agents.clients import Client
+from afl_bench.agents.runtime_model import RuntimeModel
+from afl_bench.agents.server import ServerInterface, StaleUpdateError
+from afl_bench.compression import Codec
+from afl_bench.types import ModelParams
+from afl_bench.updates import compute_delta
+
+logger = logging.getLogger(__name__)
+
+
+class LogicalClient:
+    def __init__(
+        self,
+        client_id: int,
+        trainloader: DataLoader,
+        valloader: DataLoader,
+        runtime_model: RuntimeModel,
+        seed: int,
+        codec: Optional[Codec] = None,
+    ) -> None:
+        """
+        State of a client which is not bound to a model instance or thread, and is
+        only swapped into a worker when it is scheduled to train.
+
+        Args:
+            client_id (int): id of the client.
+            trainloader (DataLoader): client's local training data.
+            valloader (DataLoader): client's local validation data.
+            runtime_model (RuntimeModel): runtime model used to simulate the client.
+            seed (int): seed for the client's private torch RNG state.
+            codec (Codec, optional): codec compressing the client's deltas, which
+                may keep per-client state. Defaults to sending them uncompressed.
+        """
+        self.client_id = client_id
+        self.trainloader = trainloader
+        self.valloader = valloader
+        self.runtime_model = runtime_model
+        self.rng_state = torch.Generator().manual_seed(seed).get_state()
+        self.codec = codec
+
+        # Global version last trained on, and time the current round's runtime
+        # elapses.
+        self.prev_version = None
+        self.ready_at = 0.0
+        # Global model and version pulled when the current round started, whose
+        # snapshot reference is handed over to the server with the update.
+        self.pulled: Optional[Tuple[ModelParams, int]] = None
+
+
+class ClientScheduler:
+    def __init__(
+        self,
+        server: ServerInterface,
+        workers: List[Client],
+        logical_clients: List[LogicalClient],
+    ) -> None:
+        """
+        Multiplexes many logical clients onto a small, fixed pool of workers, each
+        owning one model instance and running on one thread. Memory and thread
+        count therefore scale with the number of workers, not clients.
+
+        Logical clients pull the global model when their round starts, as in the
+        threaded backend, then wait in a ready queue ordered by the time their
+        simulated runtime elapses. The next free worker then swaps in their data
+        and RNG state, trains on the pulled model and pushes the update, so
+        updates are as stale as the client's runtime makes them. A client that
+        has already trained on the current global version is parked until the
+        server publishes a new one, without holding a worker.
+
+        Note that clients run concurrently on different workers share torch's
+        global RNG, so per-client RNG state is only exactly reproducible with a
+        single worker.
+
+        Args:
+            server: server to pull global models from and push updates to.
+            workers: clients whose model and optimizer are reused by every logical
+                client they serve. Their data loaders are swapped out per round.
+            logical_clients: logical clients to schedule, indexed by client id.
+        """
+        self.server = server
+        self.workers = workers
+        self.logical_clients = logical_clients
+
+        self.ready = []
+        self.parked = []
+        self.sequence = count()
+        self.latest_version = None
+
+        self.cv = Condition()
+        self.is_running = False
+        self.threads = []
+        self.watcher_thread = None
+
+    def _schedule(self, logical_client: LogicalClient):
+        """
+        Queue a logical client for its next round, or park it if it has already
+        trained on the latest global version. Must hold self.cv.
+        """
+        if logical_client.prev_version == self.latest_version:
+            self.parked.append(logical_client)
+            return
+
+        logical_client.pulled = self.server.get_current_model()
+        logical_client.ready_at = (
+            time.monotonic() + logical_client.runtime_model.sample_runtime()
+        )
+        heapq.heappush(
+            self.ready,
+            (logical_client.ready_at, next(self.sequence), logical_client),
+        )
+        self.cv.notify()
+
+    def run(self, train_config={}, eval_config={}):
+        def watch_impl():
+            # Track new global versions and release parked logical clients.
+            version = None
+            while self.is_running:
+                _, version = self.server.get_current_model(prev_version=version)
+                self.server.release_model(version)
+                with self.cv:
+                    self.latest_version = version
+                    released = self.parked
+                    self.parked = []
+                    for logical_client in released:
+                        self._schedule(logical_client)
+
+        def worker_impl(client: Client):
+            while True:
+                with self.cv:
+                    # Wait for the next logical client whose runtime has elapsed.
+                    while self.is_running and (
+                        len(self.ready) == 0 or self.ready[0][0] > time.monotonic()
+                    ):
+                        timeout = (
+                            self.ready[0][0] - time.monotonic()
+                            if len(self.ready) > 0
+                            else None
+                        )
+                        self.cv.wait(timeout)
+
+                    if not self.is_running:
+                        return
+                    _, _, logical_client = heapq.heappop(self.ready)
+
+                # Swap logical client state into this worker.
+                client.trainloader = logical_client.trainloader
+                client.valloader = logical_client.valloader
+                torch.random.set_rng_state(logical_client.rng_state)
+
+                global_params, version = logical_client.pulled
+                logical_client.pulled = None
+                logger.info(
+                    "Worker running local training of client %d on model version %d",
+                    logical_client.client_id,
+                    version,
+                )
+                new_params = run_local_round(
+                    client,
+                    logical_client.client_id,
+                    global_params,
+                    version,
+                    train_config,
+                    eval_config,
+                )
+
+                # The delta is computed into new tensors, so the worker's model can be
+                # reused next round.
+                delta = compute_delta(global_params, new_params)
+                if logical_client.codec is not None:
+                    delta = logical_client.codec(delta)
+                logical_client.rng_state = torch.random.get_rng_state()
+                logical_client.prev_version = version
+
+                try:
+                    server_running = self.server.broadcast_update_delta(
+                        logical_client.client_id, delta, version
+                    )
+                except StaleUpdateError as e:
+                    logger.info(
+                        "Update of client %d rejected: %s", logical_client.client_id, e
+                    )
+                    server_running = True
+
+                with self.cv:
+                    if not server_running:
+                        self.is_running = False
+                        self.cv.notify_all()
+                        return
+                    self._schedule(logical_client)
+
+        # Initialize threads once only
+        if len(self.threads) > 0:
+            raise RuntimeError("Client scheduler already running!")
+
+        self.is_running = True
+        with self.cv:
+            _, self.latest_version = self.server.get_current_model()
+            self.server.release_model(self.latest_version)
+            for logical_client in self.logical_clients:
+                self._schedule(logical_client)
+
+        self.watcher_thread = Thread(target=watch_impl, daemon=True)
+        self.watcher_thread.start()
+        for client in self.workers:
+            thread = Thread(target=worker_impl, args=(client,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop all worker threads. The version watcher is a daemon thread and exits
+        with the server.
+        """
+        with self.cv:
+            self.is_running = False
+            self.cv.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        # Release the models pulled by logical clients that never trained on them.
+        for _, _, logical_client in self.ready:
+            if logical_client.pulled is not None:
+                self.server.release_model(logical_client.pulled[1])
+                logical_client.pulled = None
+        self.ready = []
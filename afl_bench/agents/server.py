@@ -2,21 +2,52 @@ import copy
 import logging
 import time
 from abc import abstractmethod
-from itertools import count
 from threading import Condition, Lock, Thread
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
+import torch
 from torch.utils.data import DataLoader
 
 import wandb
-from afl_bench.agents.buffer import Buffer
+from afl_bench.agents.aggregation import as_param_mask
+from afl_bench.agents.buffer import (
+    Buffer,
+    PriorityBuffer,
+    RingBuffer,
+    StreamingBuffer,
+)
 from afl_bench.agents.clients.simple import _test
-from afl_bench.agents.common import get_parameters, set_parameters
-from afl_bench.agents.strategies import ModelParams, Strategy
+from afl_bench.agents.common import flatten_module_, get_parameters, set_parameters
+from afl_bench.agents.strategies import Strategy
+from afl_bench.agents.version_history import VersionHistory
+from afl_bench.agents.version_store import VersionStore
+from afl_bench.compression import CompressedDelta, get_delta_nbytes
+from afl_bench.params import FlatParams
+from afl_bench.types import ClientUpdate, ModelParams
+from afl_bench.updates import DeltaUpdate, StreamedUpdate
 
 logger = logging.getLogger(__name__)
 
 
+class StaleUpdateError(Exception):
+    """
+    Raised when the server rejects a client update because the global model it
+    was trained on is more than the strategy's max_staleness versions old. The
+    update is discarded, and the client should pull the latest global model.
+    """
+
+    def __init__(self, version_number: int, current_version: int):
+        super().__init__(version_number, current_version)
+        self.version_number = version_number
+        self.current_version = current_version
+
+    def __str__(self) -> str:
+        return (
+            f"Update from global model version {self.version_number} is too stale "
+            f"at version {self.current_version}."
+        )
+
+
 class ServerInterface:
     @abstractmethod
     def get_current_model(
@@ -44,6 +75,39 @@ class ServerInterface:
             old_params: model parameters prior to local training (i.e. the old global model)
             new_params: model parameters after training (i.e. the new global model)
             version_number: the version number of the old global model used.
+
+        Raises:
+            StaleUpdateError: if the update was rejected for being too stale.
+        """
+
+    @abstractmethod
+    def broadcast_update_delta(
+        self,
+        client_id: int,
+        delta: ModelParams,
+        version_number: int,
+    ):
+        """
+        Alternative to broadcast_updated_model where the client sends only the
+        change made by local training (new parameters minus the pulled global
+        model), and the server recovers the old model from the version number.
+
+        Args:
+            client_id: the client id that trained the model.
+            delta: new model parameters minus the old global model parameters.
+            version_number: the version number of the old global model used.
+
+        Raises:
+            StaleUpdateError: if the update was rejected for being too stale.
+        """
+
+    def release_model(self, version_number: int):
+        """
+        Signal that a model pulled with get_current_model will not be sent back
+        as the old_params of an update, so the server may free it.
+
+        Args:
+            version_number: the version number of the pulled global model.
         """
 
 
@@ -60,14 +124,37 @@ class Server(ServerInterface):
 
         self.version_number = 0
 
+        # Immutable snapshots of the global model shared by clients that pulled them.
+        self.versions = VersionStore()
+        self.versions.publish(
+            get_parameters(self.model, flat=True), self.version_number, adopt=True
+        )
+
         self.strategy = strategy
         self.num_aggregations = num_aggregations
 
-        self.buffer = Buffer(
-            wait_for_full=strategy.wait_for_full,
-            n=strategy.buffer_size,
-            ms_to_wait=strategy.ms_to_wait,
-        )
+        assert strategy.fedasync_mixing is None or (
+            strategy.streaming_log_weight is None
+            and strategy.server_optimizer is None
+            and strategy.history_versions is None
+        ), "FedAsync mixing bypasses aggregation, server optimizers and history."
+        self.buffer = self._make_buffer(strategy)
+        self.streaming_mask = as_param_mask(strategy.streaming_include_param)
+        self.skipped_mask = as_param_mask(None)
+        # Serializes updates mixed in on arrival in FedAsync mode.
+        self.mix_mutex = Lock()
+
+        # Recent global versions for strategies which look them up.
+        self.history = None
+        if strategy.history_versions is not None:
+            self.history = VersionHistory(
+                strategy.history_versions,
+                (
+                    int(strategy.history_max_mb * 2**20)
+                    if strategy.history_max_mb is not None
+                    else None
+                ),
+            )
 
         self.model_mutex = Lock()
         self.model_cv = Condition(self.model_mutex)
@@ -75,23 +162,97 @@ class Server(ServerInterface):
 
         self.is_running = False
         self.thread = None
+        self.collect_thread = None
         self.acc_thread = None
+        self.num_rejected = 0
+        # Size of the updates received from clients, as sent.
+        self.bytes_received = 0
+
+        # Batch of updates collected from the buffer, waiting to be aggregated.
+        self.pending: Optional[List[ClientUpdate]] = None
+        self.pending_cv = Condition()
 
         self.test_dataloader = test_dataloader
         self.device = device
 
+    def _make_buffer(self, strategy: Strategy) -> Buffer:
+        """
+        Create the buffer type the strategy asks for. Streaming, bounded and
+        prioritized buffers are mutually exclusive.
+        """
+        buffer_args = dict(
+            wait_for_full=strategy.wait_for_full,
+            n=strategy.buffer_size,
+            ms_to_wait=strategy.ms_to_wait,
+            on_discard=lambda update: self.versions.release(update[3]),
+        )
+        streaming = strategy.streaming_log_weight is not None
+        bounded = strategy.buffer_capacity is not None
+        prioritized = (
+            strategy.buffer_priority is not None or strategy.update_weight is not None
+        )
+        assert (
+            streaming + bounded + prioritized <= 1
+        ), "Streaming, bounded and prioritized buffers cannot be combined."
+
+        if streaming:
+            return StreamingBuffer(strategy.streaming_log_weight, **buffer_args)
+        if bounded:
+            return RingBuffer(
+                strategy.buffer_capacity, strategy.overflow_policy, **buffer_args
+            )
+        if prioritized:
+            return PriorityBuffer(
+                order=strategy.buffer_priority or "freshest",
+                key=strategy.priority_key,
+                weight_fn=strategy.update_weight,
+                min_weight=strategy.min_update_weight,
+                version_fn=lambda: self.version_number,
+                **buffer_args,
+            )
+        return Buffer(**buffer_args)
+
     def get_current_model(
         self, prev_version: Optional[int] = None
     ) -> Tuple[ModelParams, int]:
+        # Snapshots are immutable and published by swapping the latest reference, so
+        # pulls only take the version store's reference count lock, never the model
+        # lock held by the aggregation thread.
+        snapshot = self.versions.acquire()
+        if prev_version is None or snapshot.version != prev_version:
+            return snapshot.params, snapshot.version
+
+        # Already trained on the latest version, so drop the reference and wait.
+        self.versions.release(snapshot.version)
         with self.model_mutex:
-            while (prev_version is not None) and (prev_version == self.version_number):
+            while self.is_running and prev_version == self.version_number:
                 # Wait until the model has been updated before letting agent pull.
                 logger.info(
                     "Waiting for global model update from version %d...", prev_version
                 )
                 self.model_cv.wait()
 
-            return get_parameters(self.model), self.version_number
+        snapshot = self.versions.acquire()
+        return snapshot.params, snapshot.version
+
+    def _admit(self, version_number: int):
+        """
+        Reject an update trained on a global model more than max_staleness versions
+        old, releasing the snapshot the client pulled.
+        """
+        max_staleness = self.strategy.max_staleness
+        current_version = self.version_number
+        if max_staleness is None or current_version - version_number <= max_staleness:
+            return
+
+        logger.info(
+            "Rejecting update from global model version %d at version %d.",
+            version_number,
+            current_version,
+        )
+        self.num_rejected += 1
+        self.versions.release(version_number)
+        raise StaleUpdateError(version_number, current_version)
 
     def broadcast_updated_model(
         self,
@@ -104,12 +265,277 @@ class Server(ServerInterface):
             "Received an update from a client from global model version %d.",
             version_number,
         )
+        self.bytes_received += get_delta_nbytes(new_params)
+        self._admit(version_number)
+        if self.strategy.fedasync_mixing is not None:
+            self.mix_update((client_id, old_params, new_params, version_number))
+            return self.thread is not None
+
+        if self.strategy.flat_params:
+            # Copy into flat buffers on the server's device, which also detaches the
+            # update from the client's live parameters. The old model is normally
+            # the shared snapshot the client pulled, which needs no copy.
+            if not isinstance(old_params, FlatParams):
+                old_params = FlatParams.from_params(old_params, device=self.device)
+            new_params = FlatParams.from_params(new_params, device=self.device)
+
+        # The snapshot reference taken at pull time is now held by the buffered update.
         self.buffer.add((client_id, old_params, new_params, version_number))
         return self.thread is not None
 
+    def broadcast_update_delta(
+        self,
+        client_id: int,
+        delta: ModelParams,
+        version_number: int,
+    ):
+        logger.info(
+            "Received a delta update from a client from global model version %d.",
+            version_number,
+        )
+        self.bytes_received += get_delta_nbytes(delta)
+        self._admit(version_number)
+        if isinstance(delta, CompressedDelta):
+            # Kept compressed until aggregation.
+            delta = delta.to(self.device)
+        elif self.strategy.flat_params and not isinstance(delta, FlatParams):
+            delta = FlatParams.from_params(delta, device=self.device)
+
+        if self.strategy.fedasync_mixing is not None:
+            old_params = self.versions.get(version_number).params
+            self.mix_update(DeltaUpdate(client_id, old_params, delta, version_number))
+            return self.thread is not None
+
+        # The client still holds the reference to its snapshot taken at pull time,
+        # which is handed over to the buffered update.
+        old_params = self.versions.get(version_number).params
+        self.buffer.add(DeltaUpdate(client_id, old_params, delta, version_number))
+        return self.thread is not None
+
+    def release_model(self, version_number: int):
+        self.versions.release(version_number)
+
+    def mix_update(self, update: ClientUpdate):
+        """
+        Mix a client update straight into the global model as in FedAsync, with
+        new global = (1 - alpha) * global + alpha * client model and alpha given
+        by the strategy for the update's staleness, then publish the result.
+
+        The result is written with fused ops into a buffer recycled from a freed
+        snapshot, so there is no buffer round trip or allocation per update.
+
+        Args:
+            update: client update, holding the reference to the snapshot the
+                client pulled.
+        """
+        # Index rather than unpack, which would rebuild a delta update's new params.
+        old_params, version_number = update[1], update[3]
+        with self.mix_mutex:
+            if self.version_number >= self.num_aggregations:
+                self.versions.release(version_number)
+                return
+
+            global_params = self.versions.latest.params
+            alpha = self.strategy.fedasync_mixing(self.version_number - version_number)
+            new_model = self.versions.take_buffer()
+
+            with torch.no_grad():
+                if isinstance(update, DeltaUpdate):
+                    # The client model is old params + delta, so lerp towards the old
+                    # params, a no-op for a fresh update, and add the scaled delta.
+                    fresh = old_params is global_params
+                    if fresh and isinstance(update.delta, FlatParams):
+                        torch.add(
+                            global_params.flat,
+                            update.delta.flat,
+                            alpha=alpha,
+                            out=new_model.flat,
+                        )
+                    else:
+                        if fresh:
+                            new_model.flat.copy_(global_params.flat)
+                        else:
+                            _lerp_into(new_model, global_params, old_params, alpha)
+                        _add_into(new_model, update.delta, alpha)
+                else:
+                    _lerp_into(new_model, global_params, update[2], alpha)
+            self.skipped_mask.restore(new_model, global_params)
+
+            self.versions.publish(new_model, self.version_number + 1, adopt=True)
+            with self.model_mutex:
+                self.version_number += 1
+                self.model_cv.notify_all()
+            self.versions.release(version_number)
+
+            if self.version_number >= self.num_aggregations:
+                logger.info("Mixed in the final update, terminating...")
+                self._shutdown()
+
+        # Notify the accuracy thread to test the new model.
+        with self.accuracy_cv:
+            self.accuracy_cv.notify_all()
+
+    def apply_streamed_update(self, streamed: StreamedUpdate) -> ModelParams:
+        """
+        Add the averaged delta dispensed by a streaming buffer to the global model.
+
+        Args:
+            streamed: weighted average of the folded client updates.
+        """
+        global_params = self.versions.latest.params
+        if streamed.delta is None:
+            return global_params
+
+        if isinstance(streamed.delta, FlatParams):
+            new_model = FlatParams(
+                global_params.flat + streamed.delta.flat.to(global_params.flat.device),
+                global_params.layout,
+            )
+        else:
+            new_model = global_params.clone()
+            with torch.no_grad():
+                _add_into(
+                    new_model,
+                    [
+                        (name, delta.to(global_params.flat.device))
+                        for name, delta in streamed.delta
+                    ],
+                    1.0,
+                )
+        self.streaming_mask.restore(new_model, global_params)
+        return new_model
+
+    def _release_updates(self, updates: List[ClientUpdate]):
+        """
+        Release the snapshots referenced by updates dispensed from the buffer.
+        """
+        for update in updates:
+            # Folded updates already released their snapshots when consumed.
+            if not isinstance(update, StreamedUpdate):
+                self.versions.release(update[3])
+
+    def sync_model(self) -> int:
+        """
+        Copy the latest global snapshot into self.model, which is not updated by
+        aggregation, e.g. to evaluate it or once the server has stopped.
+
+        Returns:
+            int: version of the global model copied.
+        """
+        snapshot = self.versions.acquire()
+        set_parameters(self.model, snapshot.params)
+        self.versions.release(snapshot.version)
+        return snapshot.version
+
+    def apply_updates(self, aggregated_updates: List[ClientUpdate]):
+        """
+        Aggregate a batch of client updates into the global model and publish
+        the new version, notifying any clients waiting on it.
+
+        Args:
+            aggregated_updates: client updates dispensed by the buffer.
+        """
+        logger.info(
+            "Server thread running aggregation for new version %d with %d updates.",
+            self.version_number + 1,
+            len(aggregated_updates),
+        )
+
+        # Aggregate and update model.
+        start_time = time.process_time()
+
+        if self.strategy.streaming_log_weight is not None:
+            (streamed,) = aggregated_updates
+            new_model = self.apply_streamed_update(streamed)
+        elif self.history is not None:
+            new_model = self.strategy.aggregate(
+                (self.versions.latest.params, self.version_number),
+                aggregated_updates,
+                history=self.history,
+            )
+        else:
+            new_model = self.strategy.aggregate(
+                (self.versions.latest.params, self.version_number),
+                aggregated_updates,
+            )
+        if self.strategy.server_optimizer is not None:
+            new_model = self.strategy.server_optimizer(
+                self.versions.latest.params, new_model
+            )
+
+        logger.info(
+            "Aggregation loop took %f seconds.",
+            time.process_time() - start_time,
+        )
+
+        if self.history is not None:
+            if not isinstance(new_model, FlatParams):
+                # Flattened here rather than copied when published.
+                new_model = FlatParams.from_params(new_model)
+            self.history.push(
+                self.versions.latest.params, new_model, self.version_number
+            )
+
+        # Publish the new snapshot by swapping the latest reference, which makes it
+        # immediately visible to pulls. A flat aggregation result becomes the
+        # snapshot without a copy; otherwise it is copied into a recycled buffer.
+        # Then take the model lock only to bump the version and notify waiters.
+        self.versions.publish(new_model, self.version_number + 1, adopt=True)
+        with self.model_mutex:
+            self.version_number += 1
+            self.model_cv.notify_all()
+
+        # Aggregated updates no longer need the snapshots they were trained on.
+        self._release_updates(aggregated_updates)
+
+        if isinstance(self.buffer, RingBuffer):
+            wandb.log(
+                {
+                    "buffer": {
+                        "occupancy": self.buffer.occupancy,
+                        "dropped": self.buffer.num_dropped,
+                        "global_version": self.version_number,
+                    }
+                },
+            )
+
+        # Notify the accuracy thread to test the new model.
+        with self.accuracy_cv:
+            self.accuracy_cv.notify_all()
+
+    def log_test_accuracy(self, model, version: int):
+        """
+        Evaluate the given copy of the global model on the test set and log it.
+
+        Args:
+            model: model holding the global parameters to evaluate.
+            version: global model version the parameters correspond to.
+        """
+        _, accuracy = _test(model, self.test_dataloader, device=self.device)
+        logger.info("Server test set accuracy: %s", accuracy)
+        wandb.log(
+            {
+                "server": {
+                    **{
+                        "accuracy": accuracy,
+                        "version": version,
+                        "bytes_received": self.bytes_received,
+                    },
+                    **(
+                        {"num_discarded": self.buffer.num_discarded}
+                        if isinstance(self.buffer, PriorityBuffer)
+                        else {}
+                    ),
+                    "global_version": version,
+                }
+            },
+        )
+
     def run(self):
         """
-        Start the server thread.
+        Start the server threads. Aggregation is pipelined: a collector thread
+        waits on the buffer for the next batch of updates while the aggregation
+        thread aggregates and publishes the previous one.
         """
 
         def run_acc_impl():
@@ -117,8 +543,9 @@ class Server(ServerInterface):
             previous_version = None
 
             # Create a copy of the model to test on.
-            with self.model_mutex:
-                temp_model = copy.deepcopy(self.model)
+            # Flat, so copying each snapshot into it is a single copy.
+            temp_model = copy.deepcopy(self.model)
+            flatten_module_(temp_model)
 
             while True:
                 if not self.is_running or self.version_number >= self.num_aggregations:
@@ -132,35 +559,17 @@ class Server(ServerInterface):
                     ):
                         self.accuracy_cv.wait()
 
-                # Copy over the current global model to the temp model.
-                version = None
-                with self.model_mutex:
-                    set_parameters(temp_model, self.model.named_parameters())
-                    version = self.version_number
+                # Copy over the latest global snapshot to the temp model.
+                snapshot = self.versions.acquire()
+                set_parameters(temp_model, snapshot.params)
+                version = snapshot.version
+                self.versions.release(version)
 
-                _, accuracy = _test(
-                    temp_model, self.test_dataloader, device=self.device
-                )
-                logger.info("Server test set accuracy: %s", accuracy)
-                wandb.log(
-                    {
-                        "server": {
-                            **{
-                                "accuracy": accuracy,
-                                "version": version,
-                            },
-                            "global_version": version,
-                        }
-                    },
-                )
+                self.log_test_accuracy(temp_model, version)
                 previous_version = version
 
-        def run_impl():
-            for _ in count():
-                if not self.is_running or self.version_number >= self.num_aggregations:
-                    logger.info("Aggregation loop terminating...")
-                    break
-
+        def run_collect_impl():
+            while self.is_running:
                 # Waits until aggregation buffer is ready to dispense items when called.
                 aggregated_updates = self.buffer.get_items()
 
@@ -168,57 +577,78 @@ class Server(ServerInterface):
                     logger.info("No updates in buffer to aggregate, skipping.")
                     continue
 
-                logger.info(
-                    "Server thread running aggregation for new version %d with %d updates.",
-                    self.version_number + 1,
-                    len(aggregated_updates),
-                )
+                # Hand the batch over once the previous one has been taken.
+                with self.pending_cv:
+                    while self.pending is not None and self.is_running:
+                        self.pending_cv.wait()
 
-                # Aggregate and update model.
-                start_time = time.process_time()
+                    if not self.is_running:
+                        self._release_updates(aggregated_updates)
+                        break
+                    self.pending = aggregated_updates
+                    self.pending_cv.notify_all()
 
-                new_model = self.strategy.aggregate(
-                    (self.model.named_parameters(), self.version_number),
-                    aggregated_updates,
-                )
+        def run_impl():
+            while self.is_running and self.version_number < self.num_aggregations:
+                with self.pending_cv:
+                    while self.pending is None and self.is_running:
+                        self.pending_cv.wait()
 
-                logger.info(
-                    "Aggregation loop took %f seconds.",
-                    time.process_time() - start_time,
-                )
+                    if self.pending is None:
+                        break
+                    aggregated_updates = self.pending
+                    self.pending = None
+                    self.pending_cv.notify_all()
 
-                # Acquire model lock and update current global model. Notify any waiting threads.
-                with self.model_mutex:
-                    set_parameters(self.model, new_model)
-                    self.version_number += 1
-                    self.model_cv.notify_all()
+                self.apply_updates(aggregated_updates)
 
-                # Notify the accuracy thread to test the new model.
-                with self.accuracy_cv:
-                    self.accuracy_cv.notify_all()
+            logger.info("Aggregation loop terminating...")
+            self._shutdown()
 
         # Initialize thread once only
         if self.thread is None:
             self.is_running = True
             self.thread = Thread(target=run_impl, daemon=True)
+            self.collect_thread = Thread(target=run_collect_impl, daemon=True)
             self.acc_thread = Thread(target=run_acc_impl, daemon=True)
 
             self.thread.start()
+            self.collect_thread.start()
             self.acc_thread.start()
         else:
             raise RuntimeError("Server thread already running!")
 
+    def _shutdown(self):
+        """
+        Stop the server loops, waking any clients blocked waiting for buffer space
+        or a new model, and release the snapshots of updates never aggregated.
+        """
+        with self.model_mutex:
+            self.is_running = False
+            self.model_cv.notify_all()
+
+        self.buffer.close()
+        with self.pending_cv:
+            if self.pending is not None:
+                self._release_updates(self.pending)
+                self.pending = None
+            self.pending_cv.notify_all()
+
     def stop(self):
         """
         Stop the server thread.
         """
         if self.thread is not None or self.acc_thread is not None:
-            self.is_running = False
+            self._shutdown()
             self.thread.join()
             self.thread = None
 
+            self.collect_thread.join()
+            self.collect_thread = None
+
             self.acc_thread.join()
             self.acc_thread = None
+            self.sync_model()
 
     def join(self):
         """
@@ -228,9 +658,44 @@ class Server(ServerInterface):
             self.thread.join()
             self.thread = None
 
+            self.collect_thread.join()
+            self.collect_thread = None
+
             # Notify the accuracy thread in case it is waiting.
             with self.accuracy_cv:
                 self.accuracy_cv.notify_all()
             self.acc_thread.join()
 
             self.acc_thread = None
+            self.sync_model()
+
+
+def _lerp_into(out: FlatParams, start: FlatParams, end: ModelParams, weight: float):
+    """
+    Write start + weight * (end - start) into out without allocating.
+    """
+    if isinstance(end, FlatParams):
+        torch.lerp(start.flat, end.flat.to(start.flat.device), weight, out=out.flat)
+    else:
+        out.flat.copy_(start.flat)
+        torch._foreach_lerp_(
+            [view for _, view in out],
+            [tensor.detach().to(start.flat.device) for _, tensor in end],
+            weight,
+        )
+
+
+def _add_into(out: FlatParams, params: ModelParams, alpha: float):
+    """
+    Add alpha * params to out in place.
+    """
+    if isinstance(params, CompressedDelta):
+        params.add_to(out.flat, alpha=alpha)
+    elif isinstance(params, FlatParams):
+        out.flat.add_(params.flat, alpha=alpha)
+    else:
+        torch._foreach_add_(
+            [view for _, view in out],
+            [tensor for _, tensor in params],
+            alpha=alpha,
+        )
@@ -0,0 +1,141 @@
+from typing import Optional
+
+import torch
+
+from afl_bench.params import SYNCED, FlatParams
+from afl_bench.types import ModelParams
+
+
+class ServerOptimizer:
+    """
+    Server-side optimizer which treats the change a strategy makes to the global
+    model as a pseudo-gradient, and takes its own step along it instead.
+
+    State is kept in flat buffers laid out like the model, allocated on the
+    first step, and updated with fused in-place ops. The result is written into
+    the strategy's new model, so a step allocates nothing. Tensors the model's
+    layout marks as synced, such as batch norm statistics, are not gradients and
+    keep the strategy's value.
+    """
+
+    def __init__(self, lr: float) -> None:
+        self.lr = lr
+        self.scratch: Optional[torch.Tensor] = None
+
+    def __call__(self, global_model: FlatParams, new_model: ModelParams) -> FlatParams:
+        """
+        Step from the global model along the change made by the strategy.
+
+        Args:
+            global_model: current global model parameters. Not modified.
+            new_model: global model computed by the strategy, which may be
+                overwritten with the result.
+
+        Returns:
+            FlatParams: the new global model.
+        """
+        if not isinstance(new_model, FlatParams):
+            new_model = FlatParams.from_params(new_model)
+        elif new_model.flat.data_ptr() == global_model.flat.data_ptr():
+            new_model = new_model.clone()
+
+        if self.scratch is None:
+            self.init_state(global_model.flat)
+
+        synced = global_model.layout.role_ranges[SYNCED]
+        with torch.no_grad():
+            synced_values = [
+                new_model.flat[synced_slice].clone() for synced_slice in synced
+            ]
+            # Turn the new model into the pseudo-gradient in place.
+            pseudo_grad = new_model.flat.sub_(global_model.flat)
+            self.step(global_model.flat, pseudo_grad)
+            for synced_slice, value in zip(synced, synced_values):
+                new_model.flat[synced_slice] = value
+        return new_model
+
+    def init_state(self, flat: torch.Tensor):
+        self.scratch = torch.empty_like(flat)
+
+    def step(self, global_flat: torch.Tensor, out: torch.Tensor):
+        """
+        Write the new global model into out, which holds the pseudo-gradient.
+        """
+        raise NotImplementedError
+
+
+class ServerSGD(ServerOptimizer):
+    def __init__(self, lr=1.0, momentum=0.0) -> None:
+        """
+        SGD with heavy-ball momentum on the pseudo-gradient. With the defaults it
+        applies the strategy's result unchanged, and with momentum it is FedAvgM.
+
+        Args:
+            lr (float, optional): server learning rate. Defaults to 1.0.
+            momentum (float, optional): momentum factor. Defaults to 0.0.
+        """
+        super().__init__(lr)
+        self.momentum = momentum
+        self.momentum_buffer: Optional[torch.Tensor] = None
+
+    def init_state(self, flat: torch.Tensor):
+        super().init_state(flat)
+        self.momentum_buffer = torch.zeros_like(flat)
+
+    def step(self, global_flat: torch.Tensor, out: torch.Tensor):
+        direction = out
+        if self.momentum != 0:
+            self.momentum_buffer.mul_(self.momentum).add_(out)
+            direction = self.momentum_buffer
+        torch.add(global_flat, direction, alpha=self.lr, out=out)
+
+
+class FedAdam(ServerOptimizer):
+    def __init__(self, lr=0.01, beta1=0.9, beta2=0.99, tau=1e-3) -> None:
+        """
+        Adam on the pseudo-gradient, as in FedAdam (Reddi et al., Adaptive
+        Federated Optimization), without bias correction.
+
+        Args:
+            lr (float, optional): server learning rate. Defaults to 0.01.
+            beta1 (float, optional): first moment decay. Defaults to 0.9.
+            beta2 (float, optional): second moment decay. Defaults to 0.99.
+            tau (float, optional): adaptivity, added to the root of the second
+                moment. Defaults to 1e-3.
+        """
+        super().__init__(lr)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.tau = tau
+        self.exp_avg: Optional[torch.Tensor] = None
+        self.exp_avg_sq: Optional[torch.Tensor] = None
+
+    def init_state(self, flat: torch.Tensor):
+        super().init_state(flat)
+        self.exp_avg = torch.zeros_like(flat)
+        self.exp_avg_sq = torch.full_like(flat, self.tau**2)
+
+    def update_second_moment(self, pseudo_grad: torch.Tensor):
+        self.exp_avg_sq.mul_(self.beta2).addcmul_(
+            pseudo_grad, pseudo_grad, value=1 - self.beta2
+        )
+
+    def step(self, global_flat: torch.Tensor, out: torch.Tensor):
+        self.exp_avg.mul_(self.beta1).add_(out, alpha=1 - self.beta1)
+        self.update_second_moment(out)
+
+        denom = torch.sqrt(self.exp_avg_sq, out=self.scratch).add_(self.tau)
+        torch.addcdiv(global_flat, self.exp_avg, denom, value=self.lr, out=out)
+
+
+class FedYogi(FedAdam):
+    """
+    Yogi on the pseudo-gradient, as in FedYogi. The second moment moves towards
+    the squared pseudo-gradient additively, so it grows more slowly than Adam's.
+    """
+
+    def update_second_moment(self, pseudo_grad: torch.Tensor):
+        grad_sq = torch.mul(pseudo_grad, pseudo_grad, out=self.scratch)
+        # The pseudo-gradient is no longer needed, so reuse it for the sign.
+        sign = torch.sub(self.exp_avg_sq, grad_sq, out=pseudo_grad).sign_()
+        self.exp_avg_sq.sub_(grad_sq.mul_(sign), alpha=1 - self.beta2)
@@ -0,0 +1,320 @@
+import heapq
+import logging
+import random
+from itertools import count
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import wandb
+from afl_bench.agents.buffer import RingBuffer
+from afl_bench.agents.client_thread import run_local_round
+from afl_bench.agents.clients import Client
+from afl_bench.agents.clients.batched import BatchedClient
+from afl_bench.agents.runtime_model import RuntimeModel
+from afl_bench.agents.server import Server, StaleUpdateError
+from afl_bench.compression import Codec
+from afl_bench.types import ModelParams
+from afl_bench.updates import compute_delta
+
+logger = logging.getLogger(__name__)
+
+
+class Simulation:
+    def __init__(
+        self,
+        server: Server,
+        clients: List[Client],
+        runtime_models: List[RuntimeModel],
+        start_seed=42,
+        eval_every=1,
+        batch_clients=False,
+        codecs: Optional[List[Codec]] = None,
+    ) -> None:
+        """
+        Initializes a discrete-event simulation which drives a server and its
+        clients on a virtual clock rather than sleeping for each client's runtime.
+
+        Clients pull the global model, sample a runtime and are scheduled to
+        complete at that point in virtual time. Completions are processed in
+        virtual time order, so updates reach the buffer in the same order as
+        they would in the threaded mode, but a run only takes as long as the
+        actual training and aggregation compute.
+
+        Args:
+            server (Server): server owning the global model, buffer and strategy.
+                The server should not be started, the simulation drives it.
+            clients (List[Client]): clients, indexed by client id.
+            runtime_models (List[RuntimeModel]): runtime model for each client, in
+                seconds of virtual time.
+            start_seed (int, optional): seed for all random number generators.
+                Defaults to 42.
+            eval_every (int, optional): number of global versions between server test
+                set evaluations. Defaults to 1.
+            batch_clients (bool, optional): whether clients are trained together
+                with a BatchedClient. Training is deferred until the first of the
+                clients which started a round since the last batch completes, then
+                all of them are trained at once, each on the global model it
+                pulled, and send their updates after their own runtimes. Defaults
+                to False.
+            codecs (List[Codec], optional): codec compressing the deltas of each
+                client. Defaults to sending them uncompressed.
+        """
+        assert len(clients) == len(
+            runtime_models
+        ), "Must specify a runtime model for each client."
+        assert codecs is None or len(codecs) == len(
+            clients
+        ), "Must specify a codec for each client."
+        # Nothing can take items from a full buffer while the only thread is blocked
+        # adding to it, unless the buffer is flushed as soon as it holds n items.
+        assert not (
+            isinstance(server.buffer, RingBuffer)
+            and server.buffer.overflow_policy == "block"
+            and not server.buffer.wait_for_full
+        ), "Simulation cannot block on a full buffer without wait_for_full."
+
+        self.server = server
+        self.clients = clients
+        self.runtime_models = runtime_models
+        self.start_seed = start_seed
+        self.eval_every = eval_every
+        self.batched_client = BatchedClient(clients) if batch_clients else None
+        self.codecs = codecs
+
+        # Current virtual time in seconds.
+        self.clock = 0.0
+
+    def run(self, train_config={}, eval_config={}):
+        """
+        Run the simulation until the server has performed its configured number
+        of aggregations, or until no further progress can be made.
+        """
+        random.seed(self.start_seed)
+        torch.random.manual_seed(self.start_seed)
+        np.random.seed(self.start_seed)
+
+        server = self.server
+        buffer = server.buffer
+        flush_interval = (
+            buffer.ms_to_wait / 1000 if buffer.ms_to_wait is not None else None
+        )
+
+        # Heap of (virtual time, sequence number, client id) events, where a client
+        # id of None denotes a timed buffer flush. Sequence numbers break ties in
+        # scheduling order.
+        events = []
+        sequence = count()
+
+        # Global model and version pulled by each client currently training, and
+        # clients waiting for a newer global model than the one they trained on.
+        pulled = {}
+        parked = []
+        # When batching, clients which started a round but have yet to be trained,
+        # and the trained parameters of each client waiting for its round to
+        # complete.
+        starting = []
+        trained = {}
+
+        def start_round(client_id, prev_version=None):
+            # Mirror ServerInterface.get_current_model blocking on prev_version.
+            if prev_version is not None and prev_version == server.version_number:
+                parked.append(client_id)
+                return
+
+            pulled[client_id] = server.get_current_model()
+            runtime = self.runtime_models[client_id].sample_runtime()
+            heapq.heappush(events, (self.clock + runtime, next(sequence), client_id))
+            if self.batched_client is not None:
+                starting.append(client_id)
+
+        def train_started():
+            # Train every client which started a round since the last batch
+            # together. Each is trained on the model it pulled, so the result does
+            # not depend on when it is trained, and its update is sent once its
+            # own runtime has elapsed.
+            client_ids = starting[:]
+            starting.clear()
+            if len(client_ids) > 1:
+                new_params = self._run_batched_round(
+                    client_ids,
+                    [pulled[client_id] for client_id in client_ids],
+                    train_config,
+                    eval_config,
+                )
+            else:
+                new_params = [
+                    run_local_round(
+                        self.clients[client_id],
+                        client_id,
+                        *pulled[client_id],
+                        train_config,
+                        eval_config,
+                    )
+                    for client_id in client_ids
+                ]
+            trained.update(zip(client_ids, new_params))
+
+        def publish(updates):
+            # Like the server's collector thread, skip batches left empty because
+            # the update was rejected or discarded, rather than publishing a new
+            # version without any updates in it.
+            if len(updates) == 0:
+                logger.info("No updates in buffer to aggregate, skipping.")
+                return
+            server.apply_updates(updates)
+            on_published()
+
+        def on_published():
+            version = server.version_number
+
+            wandb.log(
+                {
+                    "simulation": {
+                        "virtual_time": self.clock,
+                        "global_version": version,
+                    }
+                },
+            )
+            if version % self.eval_every == 0:
+                server.sync_model()
+                server.log_test_accuracy(server.model, version)
+
+            # Release clients that were waiting for a new global model.
+            released = parked[:]
+            parked.clear()
+            for client_id in released:
+                start_round(client_id)
+
+        # Virtual time of the pending timed flush. A flush triggered by the buffer
+        # filling up restarts the timer, making any already queued flush stale.
+        next_flush = None
+
+        def schedule_flush():
+            nonlocal next_flush
+            next_flush = self.clock + flush_interval
+            heapq.heappush(events, (next_flush, next(sequence), None))
+
+        for client_id in range(len(self.clients)):
+            start_round(client_id)
+        if flush_interval is not None:
+            schedule_flush()
+
+        while server.version_number < server.num_aggregations:
+            # Defer training until a client's update is due, so as many clients as
+            # possible are trained in each batch.
+            if len(events) > 0 and events[0][2] in starting:
+                train_started()
+            if len(events) == 0:
+                logger.warning(
+                    "Simulation has no pending events at version %d, stopping.",
+                    server.version_number,
+                )
+                break
+
+            self.clock, _, client_id = heapq.heappop(events)
+
+            if client_id is None:
+                if self.clock != next_flush:
+                    continue
+
+                # Timed flush of whatever is currently in the buffer.
+                updates = buffer.get_items(block=False)
+                if len(updates) > 0:
+                    publish(updates)
+                elif len(events) == 0:
+                    continue
+                schedule_flush()
+                continue
+
+            global_params, version = pulled.pop(client_id)
+            if self.batched_client is not None:
+                client_params = trained.pop(client_id)
+            else:
+                client_params = run_local_round(
+                    self.clients[client_id],
+                    client_id,
+                    global_params,
+                    version,
+                    train_config,
+                    eval_config,
+                )
+
+            version_before = server.version_number
+            delta = compute_delta(global_params, client_params)
+            if self.codecs is not None:
+                delta = self.codecs[client_id](delta)
+            try:
+                server.broadcast_update_delta(client_id, delta, version)
+            except StaleUpdateError as e:
+                logger.info("Update of client %d rejected: %s", client_id, e)
+
+            if server.strategy.fedasync_mixing is not None:
+                # The update was mixed in on arrival, unless it was rejected.
+                if server.version_number > version_before:
+                    on_published()
+            elif buffer.wait_for_full:
+                while (
+                    len(buffer) >= buffer.n
+                    and server.version_number < server.num_aggregations
+                ):
+                    publish(buffer.get_items(block=False))
+                    if flush_interval is not None:
+                        schedule_flush()
+            elif flush_interval is None:
+                publish(buffer.get_items(block=False))
+
+            start_round(client_id, prev_version=version)
+
+        logger.info(
+            "Simulation finished at version %d after %f seconds of virtual time.",
+            server.version_number,
+            self.clock,
+        )
+
+    def _run_batched_round(
+        self,
+        client_ids: List[int],
+        pulled_models: List[Tuple[ModelParams, int]],
+        train_config,
+        eval_config,
+    ) -> List[ModelParams]:
+        """
+        Batched equivalent of run_local_round for several clients at once.
+        """
+        results = self.batched_client.fit(
+            client_ids,
+            [global_params for global_params, _ in pulled_models],
+            train_config,
+        )
+
+        new_params = []
+        for client_id, (_, version), (client_params, _, new_metrics) in zip(
+            client_ids, pulled_models, results
+        ):
+            wandb.log(
+                {
+                    f"client.{client_id}": {
+                        **new_metrics,
+                        "global_version": version,
+                    }
+                },
+            )
+
+            _, _, metrics = self.batched_client.evaluate(
+                client_id, client_params, eval_config
+            )
+            logger.info("Client thread %d metrics: %s", client_id, metrics)
+
+            wandb.log(
+                {
+                    f"client.{client_id}": {
+                        **metrics,
+                        "global_version": version,
+                    }
+                },
+            )
+            new_params.append(client_params)
+
+        return new_params
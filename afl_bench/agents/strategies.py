@@ -1,7 +1,8 @@
-from typing import Callable, List, Optional, Tuple
+from typing import Callable, List, Literal, Optional, Tuple
 
 from pydantic import BaseModel
 
+from afl_bench.agents.buffer import OverflowPolicy
 from afl_bench.types import ClientUpdate, ModelParams
 
 
@@ -16,8 +17,49 @@ class Strategy(BaseModel):
     wait_for_full: bool
     # Size of aggregation buffer.
     buffer_size: Optional[int] = None
-    # Whether to wait for buffer to be full or wait a number of ms for buffer.
+    # Whether to wait for buffer to be full or wait a number of ms for buffer. If
+    # wait_for_full is also set, aggregate once full or after this many ms.
     ms_to_wait: Optional[int] = None
+    # If set, updates trained on a global model more than this many versions older than
+    # the current one are rejected on arrival rather than buffered.
+    max_staleness: Optional[int] = None
+    # If set, the buffer holds at most this many updates, and overflow_policy decides
+    # whether producers block, the oldest or stalest update is dropped, or the arriving
+    # update is coalesced into the newest one. Ignored for streaming aggregation.
+    buffer_capacity: Optional[int] = None
+    overflow_policy: OverflowPolicy = "block"
+    # If set, the buffer dispenses the freshest or stalest updates first by priority_key
+    # (by default the global version an update was trained on), instead of in arrival order.
+    buffer_priority: Optional[Literal["freshest", "stalest"]] = None
+    priority_key: Optional[Callable[[ClientUpdate], float]] = None
+    # Unnormalized weight of an update given the current global version. If set, updates
+    # weighing less than min_update_weight are discarded without being aggregated, and
+    # the buffer dispenses the freshest updates first unless buffer_priority says otherwise.
+    update_weight: Optional[Callable[[ClientUpdate, int], float]] = None
+    min_update_weight: Optional[float] = None
+    # Whether the aggregation function receives the global model and client models
+    # as FlatParams, so it can operate on whole models as single flat tensors.
+    flat_params: bool = False
+    # If set, updates are folded into a running weighted average as they arrive rather
+    # than buffered, and aggregate is not called. Maps a client update to the log of its
+    # unnormalized weight; weights are normalized when the buffer is flushed.
+    streaming_log_weight: Optional[Callable[[ClientUpdate], float]] = None
+    # With streaming aggregation, whether the averaged update is applied to the named
+    # parameter. Parameters for which this returns False keep their global value.
+    streaming_include_param: Optional[Callable[[str], bool]] = None
+    # If set, each update is mixed into the global model as soon as it arrives, as in
+    # FedAsync (i.e. a buffer of size 1), bypassing the buffer and aggregate. Maps the
+    # staleness of an update to its mixing weight in [0, 1].
+    fedasync_mixing: Optional[Callable[[int], float]] = None
+    # If set, a server optimizer (see server_optimizers) called with the current global
+    # model and the one computed by aggregation, which treats their difference as a
+    # pseudo-gradient and returns the new global model to publish instead.
+    server_optimizer: Optional[Callable[[ModelParams, ModelParams], ModelParams]] = None
+    # If set, the server keeps the global models of up to this many versions before the
+    # current one, within history_max_mb of memory if set, and passes them to aggregate
+    # as a VersionHistory in a history keyword argument.
+    history_versions: Optional[int] = None
+    history_max_mb: Optional[float] = None
     # Aggregation function with following args in order, returning a new set of model params:
     # - List of parameters for current global model to be updated in place.
     # - List of tuples of three elements (where each element is communicated update from a client):
@@ -0,0 +1,112 @@
+import logging
+from typing import Optional
+
+import torch
+
+from afl_bench.params import FlatParams
+
+logger = logging.getLogger(__name__)
+
+
+class VersionHistory:
+    def __init__(self, max_versions: int, max_bytes: Optional[int] = None) -> None:
+        """
+        Bounded ring of recent global model versions for staleness-aware
+        strategies, stored as one stacked (capacity, numel) tensor whose row for
+        version v holds the current global model minus the one at version v.
+
+        Rows are kept up to date as new versions are published, with one fused
+        add of the latest step per contiguous run of rows, so looking up the drift
+        since a version is a view rather than a reconstruction.
+
+        Args:
+            max_versions (int): number of versions before the current one to keep.
+            max_bytes (int, optional): memory budget for the ring, which may lower
+                the number of versions kept. Defaults to no budget.
+        """
+        assert max_versions >= 1
+        self.max_versions = max_versions
+        self.max_bytes = max_bytes
+
+        self.deltas: Optional[torch.Tensor] = None
+        self.layout = None
+        self.capacity = 0
+        # Current global version, and how many versions before it are held.
+        self.version: Optional[int] = None
+        self.count = 0
+
+    def _allocate(self, params: FlatParams):
+        self.layout = params.layout
+        row_bytes = params.layout.numel * params.flat.element_size()
+        self.capacity = self.max_versions
+        if self.max_bytes is not None:
+            self.capacity = min(self.capacity, self.max_bytes // row_bytes)
+            if self.capacity < self.max_versions:
+                logger.info(
+                    "Memory budget of %d bytes limits version history to %d versions.",
+                    self.max_bytes,
+                    self.capacity,
+                )
+        self.deltas = torch.empty(
+            (self.capacity, params.layout.numel),
+            dtype=params.flat.dtype,
+            device=params.flat.device,
+        )
+
+    def push(self, current: FlatParams, new: FlatParams, version: int):
+        """
+        Record that the global model moves from current, at the given version, to
+        new at the next version. Neither is retained.
+
+        Args:
+            current: global model at the given version.
+            new: global model at the next version.
+            version: version of the current global model.
+        """
+        if self.deltas is None:
+            self._allocate(current)
+        self.version = version + 1
+        if self.capacity == 0:
+            return
+
+        # The slot of the oldest version is overwritten with the latest step, then
+        # the step is added to every other row. Rows past count hold no version, so
+        # updating them is harmless.
+        slot = version % self.capacity
+        with torch.no_grad():
+            step = torch.sub(new.flat, current.flat, out=self.deltas[slot])
+            if slot > 0:
+                self.deltas[:slot].add_(step)
+            if slot + 1 < self.capacity:
+                self.deltas[slot + 1 :].add_(step)
+        self.count = min(self.count + 1, self.capacity)
+
+    def __contains__(self, version: int) -> bool:
+        return self.version is not None and (
+            self.version - self.count <= version < self.version
+        )
+
+    def delta(self, version: int) -> FlatParams:
+        """
+        Get the current global model minus the one at the given version, as a view
+        into the ring which is only valid until the next version is pushed.
+
+        Args:
+            version: an older global version held in the history.
+        """
+        if version not in self:
+            raise KeyError(f"Version {version} is not in the history.")
+        return FlatParams(self.deltas[version % self.capacity], self.layout)
+
+    def get(self, version: int, current: FlatParams) -> FlatParams:
+        """
+        Reconstruct the global model at the given version into a new buffer.
+
+        Args:
+            version: an older global version held in the history, or the current
+                version.
+            current: the current global model.
+        """
+        if version == self.version:
+            return current.clone()
+        return FlatParams(current.flat - self.delta(version).flat, self.layout)
@@ -0,0 +1,185 @@
+import logging
+from threading import Lock
+from typing import Dict, List, Optional
+
+import torch
+
+from afl_bench.params import FlatParams
+from afl_bench.types import ModelParams
+
+logger = logging.getLogger(__name__)
+
+
+class ModelSnapshot:
+    def __init__(self, version: int, params: FlatParams) -> None:
+        """
+        Copy of the global model at one version, shared read-only by every client
+        that pulled that version and every buffered update trained on it.
+
+        Args:
+            version (int): global model version.
+            params (FlatParams): global model parameters. Must not be modified.
+        """
+        self.version = version
+        self.params = params
+        self.refcount = 0
+
+
+class VersionStore:
+    def __init__(self) -> None:
+        """
+        Thread safe store of immutable global model snapshots, one per version.
+
+        The latest snapshot is always kept. Older snapshots are reference counted
+        and freed once no client that pulled them or update trained on them still
+        needs them. The flat buffers of freed snapshots are kept for reuse by
+        later versions, up to max_free of them.
+        """
+        self.snapshots: Dict[int, ModelSnapshot] = {}
+        self.latest: Optional[ModelSnapshot] = None
+        self.lock = Lock()
+
+        self.free: List[torch.Tensor] = []
+        self.max_free = 2
+
+    def _free(self, snapshot: ModelSnapshot):
+        # Must hold self.lock.
+        del self.snapshots[snapshot.version]
+        if len(self.free) < self.max_free:
+            self.free.append(snapshot.params.flat)
+
+    def _take_free(self, numel: int, dtype, device) -> Optional[torch.Tensor]:
+        # Must hold self.lock.
+        for i, flat in enumerate(self.free):
+            if flat.numel() == numel and flat.dtype == dtype and flat.device == device:
+                return self.free.pop(i)
+        return None
+
+    def _is_snapshot_storage(self, tensor: torch.Tensor) -> bool:
+        # Must hold self.lock.
+        data_ptr = tensor.untyped_storage().data_ptr()
+        return any(
+            snapshot.params.flat.untyped_storage().data_ptr() == data_ptr
+            for snapshot in self.snapshots.values()
+        ) or any(flat.untyped_storage().data_ptr() == data_ptr for flat in self.free)
+
+    def publish(self, params: ModelParams, version: int, adopt=False) -> ModelSnapshot:
+        """
+        Publish the given parameters as the latest global version. Pulls see the
+        new version as soon as the latest reference is swapped.
+
+        Args:
+            params: global model parameters for the new version.
+            version: version number of the new global model.
+            adopt (bool, optional): whether the store may take ownership of params
+                without copying if they are FlatParams, in which case the caller
+                must not modify them afterwards. They are still copied if they
+                share memory with another snapshot. Defaults to False.
+
+        Returns:
+            ModelSnapshot: the published snapshot.
+        """
+        with self.lock:
+            flat = None
+            if adopt and isinstance(params, FlatParams):
+                if not self._is_snapshot_storage(params.flat):
+                    flat = params
+            if flat is None and self.latest is not None:
+                layout = self.latest.params.layout
+                back = self._take_free(
+                    layout.numel,
+                    self.latest.params.flat.dtype,
+                    self.latest.params.flat.device,
+                )
+            else:
+                back = None
+
+        if flat is None:
+            if back is not None:
+                # Copy into a recycled buffer rather than allocating a new one.
+                flat = FlatParams(back, self.latest.params.layout)
+                with torch.no_grad():
+                    if isinstance(params, FlatParams):
+                        back.copy_(params.flat)
+                    else:
+                        torch.cat(
+                            [param.detach().reshape(-1) for _, param in params],
+                            out=back,
+                        )
+            else:
+                flat = FlatParams.from_params(params)
+
+        # Versions keep the layout of the first, which carries the model's roles.
+        if self.latest is not None and flat.layout is not self.latest.params.layout:
+            flat = FlatParams(flat.flat, self.latest.params.layout)
+        snapshot = ModelSnapshot(version, flat)
+
+        with self.lock:
+            previous = self.latest
+            self.snapshots[version] = snapshot
+            self.latest = snapshot
+
+            if previous is not None and previous.refcount == 0:
+                self._free(previous)
+
+        return snapshot
+
+    def take_buffer(self) -> FlatParams:
+        """
+        Get a buffer laid out like the latest snapshot for the caller to write the
+        next version into and publish with adopt=True, recycled from a freed
+        snapshot if possible.
+        """
+        with self.lock:
+            params = self.latest.params
+            back = self._take_free(
+                params.layout.numel, params.flat.dtype, params.flat.device
+            )
+        if back is None:
+            back = torch.empty_like(params.flat)
+        return FlatParams(back, params.layout)
+
+    def acquire(self, version: Optional[int] = None) -> ModelSnapshot:
+        """
+        Take a reference to a snapshot, which must later be released.
+
+        Args:
+            version (int, optional): version to acquire. Defaults to the latest.
+        """
+        with self.lock:
+            snapshot = self.latest if version is None else self.snapshots[version]
+            snapshot.refcount += 1
+            return snapshot
+
+    def get(self, version: int) -> ModelSnapshot:
+        """
+        Look up a snapshot the caller already holds a reference to.
+
+        Args:
+            version: version of the snapshot to look up.
+        """
+        with self.lock:
+            return self.snapshots[version]
+
+    def release(self, version: int):
+        """
+        Drop a reference to a snapshot, freeing it if it is no longer needed.
+
+        Args:
+            version: version of the snapshot to release.
+        """
+        with self.lock:
+            snapshot = self.snapshots[version]
+            snapshot.refcount -= 1
+            assert snapshot.refcount >= 0, f"Version {version} over-released."
+
+            if snapshot.refcount == 0 and snapshot is not self.latest:
+                self._free(snapshot)
+                logger.debug("Freed global model snapshot for version %d.", version)
+
+    def __len__(self) -> int:
+        """
+        Get the number of snapshots currently held.
+        """
+        with self.lock:
+            return len(self.snapshots)
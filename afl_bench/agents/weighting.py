@@ -0,0 +1,273 @@
+import logging
+import math
+import time
+from collections import defaultdict
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from afl_bench.agents.aggregation import ParamMask, apply_weighted_deltas
+from afl_bench.agents.strategies import Strategy
+from afl_bench.types import ClientUpdate, ModelParams
+
+logger = logging.getLogger(__name__)
+
+
+class WeightFunction:
+    """
+    Unnormalized aggregation weights of a batch of client updates, given the
+    current global version. Weight functions compose by multiplication, e.g.
+    StalenessExponential(0.5) * RateBased(num_clients).
+    """
+
+    def __call__(self, client_updates: List[ClientUpdate], version: int) -> List[float]:
+        raise NotImplementedError
+
+    def __mul__(self, other: "WeightFunction") -> "WeightFunction":
+        if isinstance(self, UpdateWeight) and isinstance(other, UpdateWeight):
+            return UpdateWeightProduct(self, other)
+        return WeightProduct(self, other)
+
+
+class UpdateWeight(WeightFunction):
+    """
+    Weight function under which each update's weight depends only on the update
+    itself and the current global version, not on the rest of the batch. Only
+    these can be used for streaming aggregation or to discard updates early.
+    """
+
+    def weight(self, update: ClientUpdate, version: int) -> float:
+        raise NotImplementedError
+
+    def log_weight(self, update: ClientUpdate) -> float:
+        """
+        Log of the weight of an update, up to a term which only depends on the
+        global version and so cancels when the weights are normalized.
+        """
+        raise NotImplementedError
+
+    def __call__(self, client_updates: List[ClientUpdate], version: int) -> List[float]:
+        return [self.weight(update, version) for update in client_updates]
+
+
+class Uniform(UpdateWeight):
+    """
+    Equal weight for every update, as in FedAvg.
+    """
+
+    def weight(self, update: ClientUpdate, version: int) -> float:
+        return 1.0
+
+    def log_weight(self, update: ClientUpdate) -> float:
+        return 0.0
+
+
+class StalenessExponential(UpdateWeight):
+    def __init__(self, base: float) -> None:
+        """
+        Weight base ** staleness, so with base < 1 updates trained on older
+        global versions are weighted less.
+
+        Args:
+            base (float): weight decay per version of staleness, in (0, 1).
+        """
+        assert 0.0 < base < 1.0
+        self.base = base
+
+    def weight(self, update: ClientUpdate, version: int) -> float:
+        return self.base ** (version - update[3])
+
+    def log_weight(self, update: ClientUpdate) -> float:
+        return -update[3] * math.log(self.base)
+
+
+class ReverseExponential(StalenessExponential):
+    def __init__(self, base: float) -> None:
+        """
+        Weight base ** staleness with base > 1, so updates trained on older global
+        versions are weighted more.
+
+        Args:
+            base (float): weight growth per version of staleness, above 1.
+        """
+        assert base > 1.0
+        self.base = base
+
+
+class WeightProduct(WeightFunction):
+    def __init__(self, *factors: WeightFunction) -> None:
+        """
+        Elementwise product of several weight functions.
+        """
+        self.factors = factors
+
+    def __call__(self, client_updates: List[ClientUpdate], version: int) -> List[float]:
+        weights = [1.0] * len(client_updates)
+        for factor in self.factors:
+            weights = [w * f for w, f in zip(weights, factor(client_updates, version))]
+        return weights
+
+
+class UpdateWeightProduct(WeightProduct, UpdateWeight):
+    """
+    Elementwise product of several per-update weight functions, which is itself
+    a per-update weight function.
+    """
+
+    def weight(self, update: ClientUpdate, version: int) -> float:
+        return math.prod(factor.weight(update, version) for factor in self.factors)
+
+    def log_weight(self, update: ClientUpdate) -> float:
+        return sum(factor.log_weight(update) for factor in self.factors)
+
+
+class RateBased(WeightFunction):
+    def __init__(self, num_clients: int, window_size=5) -> None:
+        """
+        Weight 1 / num_clients for clients whose update rate is known, and 0 for
+        clients that have not yet reported at least twice. Update times are
+        tracked over a window of each client's recent reports.
+
+        Args:
+            num_clients (int): number of clients in the federation.
+            window_size (int, optional): number of reports tracked per client.
+                Defaults to 5.
+        """
+        self.num_clients = num_clients
+        self.window_size = window_size
+        self.client_update = defaultdict(list)
+
+    def track_update(self, client_id: int):
+        # Pop oldest update if window size is reached.
+        if len(self.client_update[client_id]) >= self.window_size:
+            self.client_update[client_id].pop()
+        self.client_update[client_id].append(time.time())
+
+    def get_rate(self, client_id: int):
+        if len(self.client_update[client_id]) < 2:
+            return 0.0
+        return len(self.client_update[client_id]) / (
+            self.client_update[client_id][-1] - self.client_update[client_id][0]
+        )
+
+    def get_rate_total(self):
+        return sum(
+            [self.get_rate(client_id) for client_id in self.client_update.keys()]
+        )
+
+    def __call__(self, client_updates: List[ClientUpdate], version: int) -> List[float]:
+        client_ids = [update[0] for update in client_updates]
+
+        rate_total = self.get_rate_total()
+        rate_ratios = [
+            self.get_rate(client_id) / rate_total if rate_total > 0 else 0
+            for client_id in client_ids
+        ]
+        weights = [1.0 / self.num_clients if ratio > 0 else 0 for ratio in rate_ratios]
+
+        # Track which clients reported and timestamp.
+        for client_id in client_ids:
+            self.track_update(client_id)
+        return weights
+
+
+class ExpectedStaleness(WeightFunction):
+    def __init__(self, buffer_size: int, num_clients: int, window_size=5) -> None:
+        """
+        Weight each update by its client's average staleness over a window of
+        recent reports, scaled by the fraction of clients in each aggregation.
+
+        Args:
+            buffer_size (int): number of updates per aggregation.
+            num_clients (int): number of clients in the federation.
+            window_size (int, optional): number of reports tracked per client.
+                Defaults to 5.
+        """
+        self.buffer_size = buffer_size
+        self.num_clients = num_clients
+        self.window_size = window_size
+        self.client_update = defaultdict(list)
+
+    def track_update(self, client_id: int, staleness: int):
+        # Pop oldest update if window size is reached.
+        if len(self.client_update[client_id]) >= self.window_size:
+            self.client_update[client_id].pop()
+        self.client_update[client_id].append(staleness)
+
+    def get_avg_staleness(self, client_id: int):
+        if len(self.client_update[client_id]) == 0:
+            return 0.0
+        return sum(self.client_update[client_id]) / len(self.client_update[client_id])
+
+    def __call__(self, client_updates: List[ClientUpdate], version: int) -> List[float]:
+        client_ids = [update[0] for update in client_updates]
+        for update in client_updates:
+            self.track_update(update[0], version - update[3])
+
+        return [
+            self.get_avg_staleness(client_id) * self.buffer_size / self.num_clients
+            for client_id in client_ids
+        ]
+
+
+def normalize(weights: Sequence[float]) -> List[float]:
+    """
+    Scale weights to sum to one, or to all zeros if they sum to zero.
+    """
+    total = sum(weights)
+    return [weight / total if total > 0 else 0 for weight in weights]
+
+
+def weighted_strategy(
+    name: str,
+    weighting: WeightFunction,
+    include_param: Optional[Callable[[str], bool]] = None,
+    streaming=False,
+    min_update_weight: Optional[float] = None,
+    **kwargs,
+) -> Strategy:
+    """
+    Build a strategy which adds the normalized weighted average of the update
+    deltas to the global model.
+
+    Args:
+        name: name of the strategy.
+        weighting: unnormalized weights of the updates in each aggregation.
+        include_param (callable, optional): whether the averaged update is applied
+            to the named parameter. Resolved once per model layout. Defaults to
+            all parameters. Tensors the layout marks as skipped are never updated.
+        streaming (bool, optional): whether to fold updates into a running
+            average as they arrive. Requires a per-update weighting. Defaults to
+            False.
+        min_update_weight (float, optional): if set, discard updates whose
+            unnormalized weight is below this without aggregating them. Requires a
+            per-update weighting. Defaults to None.
+        **kwargs: other Strategy fields, e.g. buffer configuration.
+    """
+    if streaming or min_update_weight is not None:
+        assert isinstance(
+            weighting, UpdateWeight
+        ), "Streaming and discarding updates require a per-update weighting."
+    mask = ParamMask(include_param) if include_param is not None else None
+
+    def aggregate(
+        global_model_and_version: Tuple[ModelParams, int],
+        client_updates: List[ClientUpdate],
+    ):
+        global_model, version = global_model_and_version
+        weights = normalize(weighting(client_updates, version))
+
+        logger.info("Aggregation clients: %s", [update[0] for update in client_updates])
+        logger.info("Aggregation weights: %s", weights)
+
+        return apply_weighted_deltas(
+            global_model, client_updates, weights, include_param=mask
+        )
+
+    return Strategy(
+        name=name,
+        aggregate=aggregate,
+        streaming_log_weight=weighting.log_weight if streaming else None,
+        streaming_include_param=mask,
+        update_weight=weighting.weight if min_update_weight is not None else None,
+        min_update_weight=min_update_weight,
+        **kwargs,
+    )
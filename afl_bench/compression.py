@@ -0,0 +1,238 @@
+from typing import Iterable, Optional, Tuple
+
+import torch
+
+from afl_bench.params import FlatParams
+
+
+class CompressedDelta:
+    """
+    Client update delta in a compressed form, as produced by a Codec. It is
+    buffered and moved between processes compressed, and aggregation adds it to
+    the global model straight from that form where possible.
+    """
+
+    def __init__(self, layout) -> None:
+        self.layout = layout
+
+    def add_to(self, out: torch.Tensor, alpha: float = 1.0):
+        """
+        Add alpha times the decoded delta to a flat tensor in place.
+        """
+        raise NotImplementedError
+
+    def decode(self) -> FlatParams:
+        """
+        Decompress into a new flat delta.
+        """
+        flat = torch.zeros(self.layout.numel, device=self.device)
+        self.add_to(flat)
+        return FlatParams(flat, self.layout)
+
+    def to(self, device) -> "CompressedDelta":
+        raise NotImplementedError
+
+    @property
+    def device(self) -> torch.device:
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the compressed payload in bytes.
+        """
+        raise NotImplementedError
+
+
+class HalfDelta(CompressedDelta):
+    def __init__(self, values: torch.Tensor, layout) -> None:
+        """
+        Delta cast to a 16-bit floating point type.
+        """
+        super().__init__(layout)
+        self.values = values
+
+    def add_to(self, out: torch.Tensor, alpha: float = 1.0):
+        out.add_(self.values, alpha=alpha)
+
+    def to(self, device) -> "HalfDelta":
+        return HalfDelta(self.values.to(device), self.layout)
+
+    @property
+    def device(self) -> torch.device:
+        return self.values.device
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.numel() * self.values.element_size()
+
+
+class Int8Delta(CompressedDelta):
+    def __init__(self, values: torch.Tensor, scales: torch.Tensor, layout) -> None:
+        """
+        Delta quantized to int8 in fixed-size blocks, each with its own scale.
+
+        Args:
+            values (torch.Tensor): (num blocks, block size) quantized values, with
+                the last block zero padded.
+            scales (torch.Tensor): (num blocks, 1) scale of each block.
+            layout: layout of the delta.
+        """
+        super().__init__(layout)
+        self.values = values
+        self.scales = scales
+
+    def add_to(self, out: torch.Tensor, alpha: float = 1.0):
+        block_size = self.values.shape[1]
+        num_full = out.numel() // block_size
+        main = out[: num_full * block_size].view(num_full, block_size)
+        main.addcmul_(self.values[:num_full], self.scales[:num_full], value=alpha)
+
+        tail = out.numel() - num_full * block_size
+        if tail > 0:
+            out[num_full * block_size :].addcmul_(
+                self.values[num_full, :tail], self.scales[num_full], value=alpha
+            )
+
+    def to(self, device) -> "Int8Delta":
+        return Int8Delta(self.values.to(device), self.scales.to(device), self.layout)
+
+    @property
+    def device(self) -> torch.device:
+        return self.values.device
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.numel() + self.scales.numel() * self.scales.element_size()
+
+
+class SparseDelta(CompressedDelta):
+    def __init__(self, indices: torch.Tensor, values: torch.Tensor, layout) -> None:
+        """
+        Delta holding only selected entries of the flat buffer, all others zero.
+
+        Args:
+            indices (torch.Tensor): int32 flat indices of the kept entries.
+            values (torch.Tensor): values of the kept entries.
+            layout: layout of the delta.
+        """
+        super().__init__(layout)
+        self.indices = indices
+        self.values = values
+
+    def add_to(self, out: torch.Tensor, alpha: float = 1.0):
+        out.index_add_(0, self.indices, self.values, alpha=alpha)
+
+    def to(self, device) -> "SparseDelta":
+        return SparseDelta(self.indices.to(device), self.values.to(device), self.layout)
+
+    @property
+    def device(self) -> torch.device:
+        return self.values.device
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.indices.numel() * self.indices.element_size()
+            + self.values.numel() * self.values.element_size()
+        )
+
+
+class Codec:
+    """
+    Client-side compression of update deltas. Codecs may keep per-client state,
+    so each client needs its own instance.
+    """
+
+    def encode(self, delta: FlatParams) -> CompressedDelta:
+        raise NotImplementedError
+
+    def __call__(self, delta: Iterable[Tuple[str, torch.Tensor]]) -> CompressedDelta:
+        if not isinstance(delta, FlatParams):
+            delta = FlatParams.from_params(delta)
+        with torch.no_grad():
+            return self.encode(delta)
+
+
+class HalfCodec(Codec):
+    def __init__(self, dtype=torch.float16) -> None:
+        """
+        Cast deltas to half precision, halving their size.
+
+        Args:
+            dtype (torch.dtype, optional): torch.float16 or torch.bfloat16.
+                Defaults to torch.float16.
+        """
+        assert dtype in (torch.float16, torch.bfloat16)
+        self.dtype = dtype
+
+    def encode(self, delta: FlatParams) -> HalfDelta:
+        return HalfDelta(delta.flat.to(self.dtype), delta.layout)
+
+
+class Int8Codec(Codec):
+    def __init__(self, block_size=2048) -> None:
+        """
+        Quantize deltas to int8 with stochastic rounding, so the quantized delta
+        is unbiased, in blocks which each have their own scale. Cuts their size
+        by nearly 4x.
+
+        Args:
+            block_size (int, optional): number of elements sharing a scale.
+                Defaults to 2048.
+        """
+        self.block_size = block_size
+
+    def encode(self, delta: FlatParams) -> Int8Delta:
+        numel = delta.flat.numel()
+        num_blocks = -(-numel // self.block_size)
+        blocks = torch.zeros((num_blocks, self.block_size), device=delta.flat.device)
+        blocks.view(-1)[:numel] = delta.flat
+
+        scales = blocks.abs().amax(dim=1, keepdim=True).div_(127.0)
+        scaled = blocks.div_(scales.clamp(min=torch.finfo(torch.float32).tiny))
+        values = scaled.add_(torch.rand_like(scaled)).floor_().clamp_(-127, 127)
+        return Int8Delta(values.to(torch.int8), scales, delta.layout)
+
+
+class TopKCodec(Codec):
+    def __init__(self, ratio=0.01, error_feedback=True) -> None:
+        """
+        Keep only the largest entries of each delta by magnitude. With error
+        feedback, the entries left out are accumulated in a residual and added
+        to the next delta, so every change is eventually sent.
+
+        Args:
+            ratio (float, optional): fraction of entries kept. Defaults to 0.01.
+            error_feedback (bool, optional): whether to carry the dropped entries
+                over to the next delta. Defaults to True.
+        """
+        assert 0.0 < ratio <= 1.0
+        self.ratio = ratio
+        self.error_feedback = error_feedback
+        self.residual: Optional[torch.Tensor] = None
+
+    def encode(self, delta: FlatParams) -> SparseDelta:
+        flat = delta.flat
+        if self.error_feedback:
+            if self.residual is None:
+                self.residual = torch.zeros_like(flat)
+            flat = self.residual.add_(flat)
+
+        k = max(1, int(flat.numel() * self.ratio))
+        _, indices = flat.abs().topk(k, sorted=False)
+        values = flat[indices]
+        if self.error_feedback:
+            flat[indices] = 0
+        return SparseDelta(indices.to(torch.int32), values, delta.layout)
+
+
+def get_delta_nbytes(delta) -> int:
+    """
+    Get the size in bytes of an update delta in any form.
+    """
+    if isinstance(delta, CompressedDelta):
+        return delta.nbytes
+    if isinstance(delta, FlatParams):
+        return delta.flat.numel() * delta.flat.element_size()
+    return sum(tensor.numel() * tensor.element_size() for _, tensor in delta)
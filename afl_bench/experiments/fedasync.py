@@ -0,0 +1,47 @@
+import logging
+import random
+
+import numpy as np
+import torch
+
+from afl_bench.agents.weighting import Uniform, weighted_strategy
+from afl_bench.experiments.utils import (
+    get_cmd_line_parser,
+    run_experiment,
+    strategy_args,
+)
+
+# Set random seed for reproducibility.
+SEED = 42
+random.seed(SEED)
+torch.random.manual_seed(SEED)
+np.random.seed(SEED)
+
+# Set logging level to DEBUG to see more detailed logs.
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Run parameters.
+args = get_cmd_line_parser()
+
+
+def mixing_weight(staleness: int):
+    """
+    FedAsync mixing weight with polynomial staleness decay.
+    """
+    return args["mixing_alpha"] * (staleness + 1) ** -args["mixing_exponent"]
+
+
+# Define FedAsync strategy, mixing each update into the global model on arrival.
+strategy = weighted_strategy(
+    name="FedAsync",
+    weighting=Uniform(),
+    fedasync_mixing=mixing_weight,
+    **strategy_args(args),
+)
+
+
+if __name__ == "__main__":
+    run_experiment(strategy=strategy, args=args, model_info=args["model_info"])
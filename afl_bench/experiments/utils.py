@@ -6,6 +6,8 @@ from typing import Any, Dict, Tuple
 import torch
 
 import wandb
+from afl_bench.agents import aggregation
+from afl_bench.agents.client_process import ClientProcess
 from afl_bench.agents.client_thread import ClientThread
 from afl_bench.agents.clients.simple import Client
 from afl_bench.agents.runtime_model import (
@@ -13,8 +15,12 @@ from afl_bench.agents.runtime_model import (
     InstantRuntime,
     UniformRuntime,
 )
+from afl_bench.agents.scheduler import ClientScheduler, LogicalClient
 from afl_bench.agents.server import Server
+from afl_bench.agents.server_optimizers import FedAdam, FedYogi, ServerSGD
+from afl_bench.agents.simulation import Simulation
 from afl_bench.agents.strategies import Strategy
+from afl_bench.compression import HalfCodec, Int8Codec, TopKCodec
 from afl_bench.datasets.cifar10 import (
     load_cifar10_iid,
     load_cifar10_one_class_per_client,
@@ -60,6 +66,19 @@ def get_cmd_line_parser() -> Dict[str, Any]:
         help="Expontential weighting",
         type=float,
     )
+    parser.add_argument(
+        "--mixing-alpha",
+        help="FedAsync mixing weight of a fresh update",
+        default=0.6,
+        type=float,
+    )
+    parser.add_argument(
+        "--mixing-exponent",
+        help="FedAsync polynomial staleness exponent, scaling the mixing weight by "
+        "(staleness + 1) ** -exponent",
+        default=0.5,
+        type=float,
+    )
 
     # Dataset parameters.
     parser.add_argument(
@@ -131,6 +150,90 @@ def get_cmd_line_parser() -> Dict[str, Any]:
     parser.add_argument(
         "-ms", "--ms-to-wait", help="Milliseconds to wait", required=False, type=int
     )
+    parser.add_argument(
+        "--max-staleness",
+        help="Reject updates trained on a global model more than this many versions "
+        "old",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--buffer-capacity",
+        help="Maximum number of updates held in the buffer (unbounded by default)",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        help="What to do with an update arriving at a full buffer",
+        default="block",
+        choices=["block", "drop_oldest", "drop_stalest", "coalesce"],
+    )
+    parser.add_argument(
+        "--buffer-priority",
+        help="Dispense the freshest or stalest buffered updates first",
+        required=False,
+        choices=["freshest", "stalest"],
+    )
+    parser.add_argument(
+        "--min-update-weight",
+        help="For strategies that support it, discard updates whose unnormalized "
+        "weight falls below this threshold",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--server-optimizer",
+        help="Server optimizer stepping along the aggregated update as a "
+        "pseudo-gradient, instead of applying it directly",
+        choices=["sgd", "adam", "yogi"],
+    )
+    parser.add_argument(
+        "--server-lr",
+        help="Learning rate of the server optimizer",
+        default=1.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--server-momentum",
+        help="Momentum of the server optimizer (beta1 for adam and yogi)",
+        default=0.9,
+        type=float,
+    )
+    parser.add_argument(
+        "--server-beta2",
+        help="Second moment decay of the adam and yogi server optimizers",
+        default=0.99,
+        type=float,
+    )
+    parser.add_argument(
+        "--server-tau",
+        help="Adaptivity of the adam and yogi server optimizers",
+        default=1e-3,
+        type=float,
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compress the deltas clients send to the server",
+        choices=["fp16", "bf16", "int8", "topk"],
+    )
+    parser.add_argument(
+        "--topk-ratio",
+        help="With topk compression, fraction of delta entries each client sends",
+        default=0.01,
+        type=float,
+    )
+    parser.add_argument(
+        "--flat-params",
+        help="Pass models to the aggregation function as flat contiguous buffers",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--streaming",
+        help="Fold updates into a running weighted average as they arrive, for "
+        "strategies that support it",
+        action="store_true",
+    )
     parser.add_argument(
         "--num-aggregations",
         help="Number of server aggregations",
@@ -138,6 +241,46 @@ def get_cmd_line_parser() -> Dict[str, Any]:
         type=int,
     )
 
+    # Execution parameters.
+    parser.add_argument(
+        "--backend",
+        help="How to execute clients: real-time threads, worker processes, logical "
+        "clients scheduled on a worker pool or a virtual-clock simulation",
+        default="thread",
+        choices=["thread", "process", "scheduler", "simulation"],
+    )
+    parser.add_argument(
+        "--num-workers",
+        help="With the scheduler backend, number of worker threads (and models)",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--aggregation-threads",
+        help="Number of threads the server aggregates large models over, each "
+        "handling a contiguous shard of the flattened parameters",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--compile",
+        help="Compile the client forward and backward pass and the server "
+        "aggregation kernel with torch.compile, falling back to eager on failure",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--flat-storage",
+        help="Keep each client model's parameters and gradients in one contiguous "
+        "buffer, so pulling and pushing a model is a single copy",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-clients",
+        help="With the simulation backend, train clients which start rounds "
+        "between completions together as one vectorized batch",
+        action="store_true",
+    )
+
     arguments = vars(parser.parse_args())
 
     # Parse subpopulation parameters.
@@ -217,6 +360,158 @@ def get_cmd_line_parser() -> Dict[str, Any]:
     return arguments
 
 
+def get_server_optimizer(args: Dict[str, Any]):
+    """
+    Get the server optimizer configured on the command line, if any.
+    """
+    if args["server_optimizer"] is None:
+        return None
+    if args["server_optimizer"] == "sgd":
+        return ServerSGD(lr=args["server_lr"], momentum=args["server_momentum"])
+
+    optimizer_class = FedAdam if args["server_optimizer"] == "adam" else FedYogi
+    return optimizer_class(
+        lr=args["server_lr"],
+        beta1=args["server_momentum"],
+        beta2=args["server_beta2"],
+        tau=args["server_tau"],
+    )
+
+
+def make_codec(args: Dict[str, Any]):
+    """
+    Get a new codec for one client as configured on the command line, if any.
+    Codecs may keep per-client state, so each client needs its own.
+    """
+    if args["compression"] is None:
+        return None
+    if args["compression"] == "fp16":
+        return HalfCodec(torch.float16)
+    if args["compression"] == "bf16":
+        return HalfCodec(torch.bfloat16)
+    if args["compression"] == "int8":
+        return Int8Codec()
+    return TopKCodec(ratio=args["topk_ratio"])
+
+
+def strategy_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the Strategy fields configured on the command line, shared by every
+    experiment script.
+    """
+    return {
+        "wait_for_full": args["wait_for_full"],
+        "buffer_size": args["buffer_size"],
+        "ms_to_wait": args["ms_to_wait"],
+        "max_staleness": args["max_staleness"],
+        "buffer_capacity": args["buffer_capacity"],
+        "overflow_policy": args["overflow_policy"],
+        "buffer_priority": args["buffer_priority"],
+        "flat_params": args["flat_params"],
+        "server_optimizer": get_server_optimizer(args),
+    }
+
+
+def make_client(config, model_generator: callable, trainloader, testloader) -> Client:
+    """
+    Create a client with a new model as configured for the run.
+    """
+    return Client(
+        model_generator().to(config["device"]),
+        trainloader,
+        testloader,
+        num_steps=config["client_num_steps"],
+        lr=config["client_lr"],
+        device=config["device"],
+        compiled=config["compile"],
+        flat_storage=config["flat_storage"],
+    )
+
+
+def run_clients(
+    server: Server,
+    args: Dict[str, Any],
+    config,
+    model_generator: callable,
+    trainloaders,
+    testloaders,
+):
+    """
+    Create the clients of a run and train them against the server on the
+    backend configured on the command line, until the server has performed
+    its configured number of aggregations. The server must not be started yet.
+    """
+    # Scheduled runs share a small pool of worker models between logical clients.
+    if config["backend"] == "scheduler":
+        workers = [
+            make_client(config, model_generator, None, None)
+            for _ in range(config["num_workers"])
+        ]
+        logical_clients = [
+            LogicalClient(
+                i,
+                trainloaders[i],
+                testloaders[i],
+                runtime_model,
+                seed=42 + i,
+                codec=make_codec(args),
+            )
+            for i, runtime_model in enumerate(args["client_runtimes"])
+        ]
+        scheduler = ClientScheduler(server, workers, logical_clients)
+
+        server.run()
+        scheduler.run()
+
+        server.join()
+        scheduler.stop()
+        return
+
+    # Create clients with models.
+    clients = [
+        make_client(config, model_generator, trainloaders[i], testloaders[i])
+        for i in range(config["num_clients"])
+    ]
+
+    # Simulated runs drive the server and clients on a virtual clock instead.
+    if config["backend"] == "simulation":
+        Simulation(
+            server,
+            clients,
+            args["client_runtimes"],
+            batch_clients=config["batch_clients"],
+            codecs=(
+                [make_codec(args) for _ in clients]
+                if args["compression"] is not None
+                else None
+            ),
+        ).run()
+        return
+
+    # Wrap clients in threads (or processes) which simulate their runtime in real time.
+    client_runner = ClientProcess if config["backend"] == "process" else ClientThread
+    client_threads = []
+    for i, (client, runtime_model) in enumerate(zip(clients, args["client_runtimes"])):
+        client_thread = client_runner(
+            client,
+            server,
+            runtime_model=runtime_model,
+            client_id=i,
+            codec=make_codec(args),
+        )
+        client_threads.append(client_thread)
+
+    # Start up server and start up all client threads.
+    server.run()
+    for client_thread in client_threads:
+        client_thread.run()
+
+    # Kill client threads once server stops.
+    server.join()
+    for client_thread in client_threads:
+        client_thread.stop()
+
+
 def run_experiment(
     strategy: Strategy, args: Dict[str, Any], model_info: Tuple[str, callable]
 ):
@@ -238,6 +533,20 @@ def run_experiment(
             "wait_for_full": args["wait_for_full"],
             "buffer_size": args["buffer_size"],
             "ms_to_wait": args["ms_to_wait"],
+            "max_staleness": args["max_staleness"],
+            "buffer_capacity": args["buffer_capacity"],
+            "overflow_policy": args["overflow_policy"],
+            "buffer_priority": args["buffer_priority"],
+            "min_update_weight": args["min_update_weight"],
+            "server_optimizer": args["server_optimizer"],
+            "server_lr": args["server_lr"],
+            "server_momentum": args["server_momentum"],
+            "server_beta2": args["server_beta2"],
+            "server_tau": args["server_tau"],
+            "compression": args["compression"],
+            "topk_ratio": args["topk_ratio"],
+            "flat_params": args["flat_params"],
+            "streaming": args["streaming"],
             "num_clients": len(args["client_runtimes"]),
             "client_runtimes": args["client_runtimes"],
             "client_lr": args["client_lr"],
@@ -245,6 +554,14 @@ def run_experiment(
             "num_aggregations": args["num_aggregations"],
             "batch_size": args["batch_size"],
             "exp_weighting": args["exp_weighting"],
+            "mixing_alpha": args["mixing_alpha"],
+            "mixing_exponent": args["mixing_exponent"],
+            "backend": args["backend"],
+            "batch_clients": args["batch_clients"],
+            "aggregation_threads": args["aggregation_threads"],
+            "compile": args["compile"],
+            "flat_storage": args["flat_storage"],
+            "num_workers": args["num_workers"],
             "device": DEVICE,
         },
     )
@@ -253,6 +570,10 @@ def run_experiment(
         run.config["num_clients"], batch_size=run.config["batch_size"]
     )
 
+    # Aggregate large models in parallel shards of the flattened parameters.
+    aggregation.set_num_threads(args["aggregation_threads"])
+    aggregation.set_compiled(args["compile"])
+
     #########################################################################################
     # NOTE: NOTHING BELOW THIS LINE SHOULD BE CHANGED.                                      #
     #########################################################################################
@@ -266,31 +587,7 @@ def run_experiment(
         device=run.config["device"],
     )
 
-    # Create client threads with models. Note runtime is instant
-    # (meaning no simulated training delay).
-    client_threads = []
-    for i, runtime_model in enumerate(args["client_runtimes"]):
-        client = Client(
-            model_generator().to(run.config["device"]),
-            trainloaders[i],
-            testloaders[i],
-            num_steps=run.config["client_num_steps"],
-            lr=run.config["client_lr"],
-            device=run.config["device"],
-        )
-        client_thread = ClientThread(
-            client, server, runtime_model=runtime_model, client_id=i
-        )
-        client_threads.append(client_thread)
-
-    # Start up server and start up all client threads.
-    server.run()
-    for client_thread in client_threads:
-        client_thread.run()
-
-    # Kill client threads once server stops.
-    server.join()
-    for client_thread in client_threads:
-        client_thread.stop()
+    # Train clients on the configured backend until the server stops.
+    run_clients(server, args, run.config, model_generator, trainloaders, testloaders)
 
     wandb.finish()
@@ -0,0 +1,222 @@
+from itertools import accumulate
+from math import prod
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+
+# Aggregation roles of the tensors in a model's state. Averaged tensors are
+# trained parameters, combined by the strategy and stepped by server optimizers.
+# Synced tensors are state such as batch norm running statistics, combined by
+# the strategy but taken as is rather than treated as a pseudo-gradient. Skipped
+# tensors, such as batch counters, always keep their global value.
+AVERAGED = "averaged"
+SYNCED = "synced"
+SKIPPED = "skipped"
+ROLES = (AVERAGED, SYNCED, SKIPPED)
+
+
+class ParamLayout:
+    def __init__(
+        self,
+        names: Sequence[str],
+        shapes: Sequence[torch.Size],
+        roles: Optional[Sequence[str]] = None,
+    ) -> None:
+        """
+        Index of where each named tensor of a model's state lives inside a flat
+        1-D tensor, and of the aggregation role of each.
+
+        Layouts are immutable and should be obtained through ParamLayout.get, which
+        caches one instance per distinct set of names, shapes and roles so it can
+        be shared by every model of the same architecture.
+
+        Args:
+            names (Sequence[str]): tensor names, in model order.
+            shapes (Sequence[torch.Size]): shape of each tensor.
+            roles (Sequence[str], optional): aggregation role of each tensor, one
+                of ROLES. Defaults to all averaged.
+        """
+        assert len(names) == len(shapes)
+        assert roles is None or len(roles) == len(names)
+
+        self.names = tuple(names)
+        self.shapes = tuple(torch.Size(shape) for shape in shapes)
+        self.roles = tuple(roles) if roles is not None else (AVERAGED,) * len(names)
+        assert all(role in ROLES for role in self.roles)
+        self.numels = tuple(prod(shape) for shape in self.shapes)
+        self.offsets = tuple(accumulate(self.numels, initial=0))[:-1]
+        self.numel = sum(self.numels)
+        self.indices = {name: i for i, name in enumerate(self.names)}
+
+        # Ranges of the flat tensor holding each role, merging adjacent tensors.
+        self.role_ranges: Dict[str, Tuple[slice, ...]] = {}
+        for role in ROLES:
+            ranges = []
+            for offset, numel, tensor_role in zip(
+                self.offsets, self.numels, self.roles
+            ):
+                if tensor_role != role:
+                    continue
+                if len(ranges) > 0 and ranges[-1].stop == offset:
+                    ranges[-1] = slice(ranges[-1].start, offset + numel)
+                else:
+                    ranges.append(slice(offset, offset + numel))
+            self.role_ranges[role] = tuple(ranges)
+
+    _cache: Dict[Tuple, "ParamLayout"] = {}
+    _cache_lock = Lock()
+
+    @classmethod
+    def get(
+        cls,
+        names: Sequence[str],
+        shapes: Sequence[torch.Size],
+        roles: Optional[Sequence[str]] = None,
+    ) -> "ParamLayout":
+        """
+        Get the shared layout for the given tensor names, shapes and roles.
+        """
+        roles = tuple(roles) if roles is not None else (AVERAGED,) * len(names)
+        key = (tuple(names), tuple(tuple(shape) for shape in shapes), roles)
+        with cls._cache_lock:
+            if key not in cls._cache:
+                cls._cache[key] = cls(names, shapes, roles)
+            return cls._cache[key]
+
+    def __reduce__(self):
+        # Unpickle to the shared layout of the receiving process.
+        return (ParamLayout.get, (self.names, self.shapes, self.roles))
+
+    @classmethod
+    def from_params(cls, params: Iterable[Tuple[str, torch.Tensor]]) -> "ParamLayout":
+        """
+        Get the shared layout of a list of named parameters.
+        """
+        if isinstance(params, FlatParams):
+            return params.layout
+
+        names, shapes = [], []
+        for name, param in params:
+            names.append(name)
+            shapes.append(param.shape)
+        return cls.get(names, shapes)
+
+    @classmethod
+    def from_module(cls, net: torch.nn.Module) -> "ParamLayout":
+        """
+        Get the shared layout of a model's state, its parameters and persistent
+        buffers in state_dict order. Parameters are averaged, floating point
+        buffers synced and other buffers skipped.
+        """
+        parameters = {id(param) for param in net.parameters()}
+        names, shapes, roles = [], [], []
+        for name, tensor in net.state_dict(keep_vars=True).items():
+            names.append(name)
+            shapes.append(tensor.shape)
+            if id(tensor) in parameters:
+                roles.append(AVERAGED)
+            elif tensor.is_floating_point():
+                roles.append(SYNCED)
+            else:
+                roles.append(SKIPPED)
+        return cls.get(names, shapes, roles)
+
+    def slice(self, name: str) -> slice:
+        """
+        Get the range of the flat tensor holding the given parameter.
+        """
+        i = self.indices[name]
+        return slice(self.offsets[i], self.offsets[i] + self.numels[i])
+
+    def views(self, flat: torch.Tensor) -> List[Tuple[str, torch.Tensor]]:
+        """
+        Split a flat tensor into named per-parameter views without copying.
+        """
+        assert flat.dim() == 1 and flat.numel() == self.numel
+        return [
+            (name, chunk.view(shape))
+            for name, chunk, shape in zip(
+                self.names, flat.split(self.numels), self.shapes
+            )
+        ]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+class FlatParams:
+    def __init__(self, flat: torch.Tensor, layout: ParamLayout) -> None:
+        """
+        Model parameters stored as a single contiguous 1-D tensor plus a layout.
+
+        Iterating or indexing yields (name, tensor) pairs like the list form of
+        ModelParams, where each tensor is a view into the flat buffer, so existing
+        per-parameter code keeps working. Code that wants to operate on the whole
+        model at once can use .flat directly.
+
+        Args:
+            flat (torch.Tensor): 1-D tensor holding all parameters.
+            layout (ParamLayout): where each named parameter lives in flat.
+        """
+        assert flat.dim() == 1 and flat.numel() == layout.numel
+        self.flat = flat
+        self.layout = layout
+        self._views = None
+
+    @classmethod
+    def from_params(
+        cls,
+        params: Iterable[Tuple[str, torch.Tensor]],
+        device: Optional[torch.device] = None,
+        layout: Optional[ParamLayout] = None,
+    ) -> "FlatParams":
+        """
+        Copy a list of named parameters into a new flat buffer.
+
+        Args:
+            params: named parameters, e.g. from get_parameters or named_parameters.
+            device (torch.device, optional): device of the flat buffer. Defaults to
+                the device of the parameters.
+            layout (ParamLayout, optional): layout of the parameters, e.g. to keep
+                their roles. Defaults to the shared layout of their names and
+                shapes.
+        """
+        if isinstance(params, FlatParams):
+            return params.clone() if device is None else params.to(device, copy=True)
+
+        params = list(params)
+        if layout is None:
+            layout = ParamLayout.from_params(params)
+        with torch.no_grad():
+            # Non floating point buffers are promoted to the parameters' dtype.
+            flat = torch.cat([param.detach().reshape(-1) for _, param in params])
+        if device is not None:
+            flat = flat.to(device)
+        return cls(flat, layout)
+
+    def views(self) -> List[Tuple[str, torch.Tensor]]:
+        """
+        Get named per-parameter views into the flat buffer.
+        """
+        if self._views is None:
+            self._views = self.layout.views(self.flat)
+        return self._views
+
+    def clone(self) -> "FlatParams":
+        return FlatParams(self.flat.clone(), self.layout)
+
+    def to(self, device, copy=False) -> "FlatParams":
+        return FlatParams(self.flat.to(device, copy=copy), self.layout)
+
+    def __iter__(self):
+        return iter(self.views())
+
+    def __getitem__(self, i):
+        return self.views()[i]
+
+    def __len__(self) -> int:
+        return len(self.layout)
+
+    def __repr__(self) -> str:
+        return f"FlatParams(numel={self.layout.numel}, num_params={len(self)})"
@@ -0,0 +1,223 @@
+import unittest
+from unittest import mock
+
+import torch
+from torch._dynamo.testing import CompileCounter
+
+from afl_bench.agents import aggregation
+from afl_bench.agents.aggregation import (
+    apply_weighted_deltas,
+    apply_weighted_stacked,
+    stack_deltas,
+)
+from afl_bench.agents.common import get_parameters
+from afl_bench.params import FlatParams
+from afl_bench.updates import DeltaUpdate
+
+
+class TestAggregation(unittest.TestCase):
+    def setUp(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+        self.global_model = [(n, p.detach().clone()) for n, p in net.named_parameters()]
+        self.updates = [
+            (
+                i,
+                self.global_model,
+                [(n, p + torch.randn_like(p)) for n, p in self.global_model],
+                0,
+            )
+            for i in range(3)
+        ]
+        self.weights = [0.5, 0.3, 0.2]
+
+        def include_param(name):
+            return not name.startswith("1.")
+
+        self.include_param = include_param
+
+        # Reference implementation, parameter by parameter.
+        self.expected = []
+        for i, (name, param) in enumerate(self.global_model):
+            update = sum(
+                w * (new[i][1] - old[i][1])
+                for w, (_, old, new, _) in zip(self.weights, self.updates)
+            )
+            self.expected.append(param + update if include_param(name) else param)
+
+    def assert_expected(self, new_model):
+        self.assertIsInstance(new_model, FlatParams)
+        for (name, param), expected in zip(new_model, self.expected):
+            self.assertTrue(torch.allclose(param, expected, atol=1e-6), name)
+
+    def test_list_updates(self):
+        self.assert_expected(
+            apply_weighted_deltas(
+                self.global_model, self.updates, self.weights, self.include_param
+            )
+        )
+
+    def test_flat_delta_updates(self):
+        global_model = FlatParams.from_params(self.global_model)
+        updates = [
+            DeltaUpdate(
+                i,
+                global_model,
+                FlatParams(
+                    FlatParams.from_params(new).flat - global_model.flat,
+                    global_model.layout,
+                ),
+                version,
+            )
+            for i, _, new, version in self.updates
+        ]
+        new_model = apply_weighted_deltas(
+            global_model, updates, self.weights, self.include_param
+        )
+        self.assert_expected(new_model)
+
+        # The global model is not modified in place.
+        self.assertTrue(
+            torch.equal(
+                global_model.flat, FlatParams.from_params(self.global_model).flat
+            )
+        )
+
+    def test_stacked(self):
+        global_model = FlatParams.from_params(self.global_model)
+        stacked = stack_deltas(self.updates, global_model.layout)
+        self.assertEqual(stacked.shape, (3, global_model.layout.numel))
+        self.assert_expected(
+            apply_weighted_stacked(
+                global_model, stacked, self.weights, self.include_param
+            )
+        )
+
+    def test_stacked_kernel(self):
+        # With a compiled kernel set, uncompressed deltas are stacked and summed
+        # by it. The eager kernel stands in for the compiled one.
+        with mock.patch.object(
+            aggregation, "_compiled_weighted_sum", aggregation._weighted_sum_
+        ), mock.patch.object(
+            aggregation, "stack_deltas", wraps=aggregation.stack_deltas
+        ) as stack_deltas_mock:
+            self.assert_expected(
+                apply_weighted_deltas(
+                    self.global_model, self.updates, self.weights, self.include_param
+                )
+            )
+        stack_deltas_mock.assert_called_once()
+
+    def test_compiled_batch_sizes(self):
+        counter = CompileCounter()
+        compile_fn = torch.compile
+        torch._dynamo.reset()
+        with mock.patch.object(
+            torch,
+            "compile",
+            lambda fn, **kwargs: compile_fn(fn, backend=counter, **kwargs),
+        ):
+            aggregation.set_compiled(True)
+
+        try:
+            global_model = FlatParams.from_params(self.global_model)
+            layout = global_model.layout
+            frame_counts = []
+            for k in range(1, 13):
+                updates = [
+                    DeltaUpdate(
+                        i,
+                        global_model,
+                        FlatParams(torch.randn(layout.numel), layout),
+                        0,
+                    )
+                    for i in range(k)
+                ]
+                new_model = apply_weighted_deltas(global_model, updates, [1 / k] * k)
+                expected = global_model.flat + sum(u.delta.flat for u in updates) / k
+                self.assertTrue(torch.allclose(new_model.flat, expected, atol=1e-6))
+                frame_counts.append(counter.frame_count)
+
+            # Past a single update, one dynamic graph serves every number of
+            # updates, rather than recompiling for each until the recompile limit
+            # silently falls back to eager.
+            self.assertEqual(frame_counts[2:], [frame_counts[1]] * 10)
+            self.assertLessEqual(frame_counts[1], 2)
+            self.assertIsNotNone(aggregation._compiled_weighted_sum.compiled)
+        finally:
+            aggregation.set_compiled(False)
+
+    def test_sharded(self):
+        global_model = FlatParams.from_params(self.global_model)
+        flat_updates = [
+            DeltaUpdate(
+                i,
+                global_model,
+                FlatParams(
+                    FlatParams.from_params(new).flat - global_model.flat,
+                    global_model.layout,
+                ),
+                version,
+            )
+            for i, _, new, version in self.updates
+        ]
+
+        aggregation.set_num_threads(3)
+        try:
+            with mock.patch.object(aggregation, "MIN_SHARD_NUMEL", 4):
+                # Shards cover the flat buffer, and whole parameters if aligned.
+                for aligned in (False, True):
+                    shards = aggregation._shards(global_model.layout, aligned)
+                    self.assertEqual(len(shards), 3)
+                    self.assertEqual(shards[0][0].start, 0)
+                    self.assertEqual(shards[-1][0].stop, global_model.layout.numel)
+                    for (a, _), (b, _) in zip(shards, shards[1:]):
+                        self.assertEqual(a.stop, b.start)
+                    if aligned:
+                        for flat_slice, param_slice in shards:
+                            self.assertEqual(
+                                flat_slice.start,
+                                global_model.layout.offsets[param_slice.start],
+                            )
+
+                for updates in (self.updates, flat_updates):
+                    self.assert_expected(
+                        apply_weighted_deltas(
+                            global_model, updates, self.weights, self.include_param
+                        )
+                    )
+                stacked = stack_deltas(self.updates, global_model.layout)
+                self.assert_expected(
+                    apply_weighted_stacked(
+                        global_model, stacked, self.weights, self.include_param
+                    )
+                )
+        finally:
+            aggregation.set_num_threads(1)
+
+    def test_state_roles(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        global_model = get_parameters(net, flat=True)
+        client_models = []
+        for _ in range(2):
+            net.train()(torch.randn(8, 4))
+            client_models.append(get_parameters(net, flat=True))
+
+        new_model = dict(
+            apply_weighted_deltas(
+                global_model,
+                [(i, global_model, new, 0) for i, new in enumerate(client_models)],
+                [0.5, 0.5],
+            )
+        )
+
+        # Running stats are averaged, while the batch counter is skipped.
+        expected = (
+            dict(client_models[0])["1.running_mean"]
+            + dict(client_models[1])["1.running_mean"]
+        ) / 2
+        self.assertTrue(torch.allclose(new_model["1.running_mean"], expected))
+        self.assertEqual(new_model["1.num_batches_tracked"].item(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from afl_bench.agents.clients import Client
+from afl_bench.agents.clients.batched import BatchedClient
+
+
+def make_loader():
+    dataset = TensorDataset(torch.randn(12, 4), torch.randint(0, 2, (12,)))
+    return DataLoader(dataset, batch_size=4)
+
+
+class TestBatchedClient(unittest.TestCase):
+    def test_matches_sequential_fit(self):
+        clients = [
+            Client(
+                torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=4, lr=0.1
+            )
+            for _ in range(3)
+        ]
+        batched_client = BatchedClient(clients)
+
+        global_params = [
+            (name, param.detach().clone())
+            for name, param in torch.nn.Linear(4, 2).named_parameters()
+        ]
+        results = batched_client.fit([0, 1, 2], [global_params] * 3, {})
+
+        for client, (batched_params, _, batched_metrics) in zip(clients, results):
+            new_params, _, metrics = client.fit(global_params, {})
+            for (name, p), (batched_name, batched_p) in zip(new_params, batched_params):
+                self.assertEqual(name, batched_name)
+                self.assertTrue(torch.allclose(p, batched_p, atol=1e-6))
+            self.assertAlmostEqual(
+                metrics["avg_accuracy"], batched_metrics["avg_accuracy"]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,18 @@
+import time
 import unittest
 from threading import Thread
 
 import timeout_decorator
+import torch
 
-from afl_bench.agents.buffer import Buffer
+from afl_bench.agents.buffer import (
+    Buffer,
+    PriorityBuffer,
+    RingBuffer,
+    StreamingBuffer,
+)
+from afl_bench.params import FlatParams
+from afl_bench.updates import DeltaUpdate
 
 
 class TestBuffer(unittest.TestCase):
@@ -38,6 +47,263 @@ class TestBuffer(unittest.TestCase):
         # Background thread should have set result to [1].
         self.assertEqual(result[0], [1])
 
+    @timeout_decorator.timeout(1)
+    def test_no_wait_blocks_until_update(self):
+        # Without wait_for_full or ms_to_wait, get_items waits for any update
+        # rather than returning an empty list to a consumer looping on it.
+        buffer = Buffer(wait_for_full=False, n=2)
+
+        result = [None]
+
+        def set_result(result):
+            result[0] = buffer.get_items()
+
+        thread = Thread(target=set_result, args=(result,), daemon=True)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        buffer.add(1)
+        thread.join()
+        self.assertEqual(result[0], [1])
+
+        # Closing the buffer wakes a waiting consumer.
+        thread = Thread(target=set_result, args=(result,), daemon=True)
+        thread.start()
+        buffer.close()
+        thread.join()
+        self.assertEqual(result[0], [])
+
+    @timeout_decorator.timeout(1)
+    def test_timed_add_does_not_block(self):
+        buffer = Buffer(wait_for_full=False, n=2, ms_to_wait=300)
+
+        result = [None]
+
+        def set_result(result):
+            result[0] = buffer.get_items()
+
+        thread = Thread(target=set_result, args=(result,), daemon=True)
+        thread.start()
+        time.sleep(0.05)
+
+        # Adding while the background thread waits out its window should not
+        # have to wait for the window to end.
+        start = time.monotonic()
+        buffer.add(1)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertIsNone(result[0])
+
+        thread.join()
+        self.assertEqual(result[0], [1])
+
+    @timeout_decorator.timeout(1)
+    def test_hybrid_flushes_when_full(self):
+        buffer = Buffer(wait_for_full=True, n=2, ms_to_wait=10000)
+
+        result = [None]
+
+        def set_result(result):
+            result[0] = buffer.get_items()
+
+        thread = Thread(target=set_result, args=(result,), daemon=True)
+        thread.start()
+
+        buffer.add(1)
+        buffer.add(2)
+        thread.join()
+        self.assertEqual(result[0], [1, 2])
+
+    @timeout_decorator.timeout(1)
+    def test_hybrid_flushes_after_timeout(self):
+        buffer = Buffer(wait_for_full=True, n=2, ms_to_wait=50)
+        buffer.add(1)
+        self.assertEqual(buffer.get_items(), [1])
+
+
+class TestStreamingBuffer(unittest.TestCase):
+    def make_updates(self, flat=False):
+        old_params = [("w", torch.zeros(3, 2)), ("b", torch.zeros(2))]
+        if flat:
+            old_params = FlatParams.from_params(old_params)
+        updates = []
+        for i in range(4):
+            delta = [("w", torch.randn(3, 2)), ("b", torch.randn(2))]
+            if flat:
+                delta = FlatParams.from_params(delta)
+            updates.append(DeltaUpdate(i, old_params, delta, version_number=i))
+        return updates
+
+    def test_weighted_average(self):
+        for flat in (False, True):
+            discarded = []
+            # Large log weights would overflow if exponentiated directly.
+            buffer = StreamingBuffer(
+                lambda update: 1000.0 * update[3],
+                n=4,
+                on_discard=discarded.append,
+            )
+            updates = self.make_updates(flat)
+            for update in updates:
+                buffer.add(update)
+
+            self.assertEqual(discarded, updates)
+            self.assertEqual(len(buffer), 4)
+
+            (streamed,) = buffer.get_items()
+            self.assertEqual(streamed.client_ids, [0, 1, 2, 3])
+            self.assertEqual(streamed.version_numbers, [0, 1, 2, 3])
+            self.assertEqual(len(buffer), 0)
+
+            weights = torch.softmax(torch.tensor([0.0, 1000.0, 2000.0, 3000.0]), 0)
+            for i, (name, delta) in enumerate(streamed.delta):
+                expected = sum(
+                    w * update.delta[i][1] for w, update in zip(weights, updates)
+                )
+                self.assertEqual(name, updates[0].delta[i][0])
+                self.assertTrue(torch.allclose(delta, expected))
+
+            # The accumulator starts again from scratch after a flush.
+            self.assertEqual(buffer.get_items(block=False), [])
+
+    def test_zero_weight(self):
+        buffer = StreamingBuffer(lambda update: -float("inf"), n=1)
+        buffer.add(self.make_updates()[0])
+
+        (streamed,) = buffer.get_items()
+        self.assertIsNone(streamed.delta)
+        self.assertEqual(streamed.version_numbers, [0])
+
+
+class TestRingBuffer(unittest.TestCase):
+    def make_update(self, client_id, version):
+        return (client_id, None, None, version)
+
+    def test_drop_oldest(self):
+        discarded = []
+        buffer = RingBuffer(
+            2, "drop_oldest", wait_for_full=False, n=2, on_discard=discarded.append
+        )
+        for i in range(5):
+            buffer.add(self.make_update(i, 0))
+
+        self.assertEqual(buffer.occupancy, 1.0)
+        self.assertEqual(buffer.num_dropped, 3)
+        self.assertEqual([u[0] for u in discarded], [0, 1, 2])
+        self.assertEqual([u[0] for u in buffer.get_items()], [3, 4])
+        self.assertEqual(buffer.occupancy, 0.0)
+
+    def test_drop_stalest(self):
+        discarded = []
+        buffer = RingBuffer(
+            3, "drop_stalest", wait_for_full=False, n=3, on_discard=discarded.append
+        )
+        for client_id, version in [(0, 2), (1, 1), (2, 3), (3, 2), (4, 0)]:
+            buffer.add(self.make_update(client_id, version))
+
+        # Client 1 is evicted by client 3, then client 4 is older than everything.
+        self.assertEqual([u[0] for u in discarded], [1, 4])
+        self.assertEqual([u[0] for u in buffer.get_items()], [0, 2, 3])
+
+    def test_coalesce(self):
+        old_params = [("w", torch.zeros(2))]
+        updates = [
+            DeltaUpdate(i, old_params, [("w", torch.full((2,), float(i)))], i)
+            for i in range(4)
+        ]
+        discarded = []
+        buffer = RingBuffer(
+            2, "coalesce", wait_for_full=False, n=2, on_discard=discarded.append
+        )
+        for update in updates:
+            buffer.add(update)
+
+        first, merged = buffer.get_items()
+        self.assertIs(first, updates[0])
+        self.assertEqual(merged[0], 1)
+        self.assertEqual(merged[3], 1)
+        self.assertTrue(torch.allclose(merged.delta[0][1], torch.full((2,), 2.0)))
+        self.assertEqual(discarded, updates[2:])
+        self.assertEqual(buffer.num_dropped, 0)
+
+    @timeout_decorator.timeout(1)
+    def test_block(self):
+        buffer = RingBuffer(1, "block", wait_for_full=True, n=1)
+        buffer.add(self.make_update(0, 0))
+
+        thread = Thread(target=buffer.add, args=(self.make_update(1, 0),), daemon=True)
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+
+        # Taking an item frees space for the blocked producer.
+        self.assertEqual([u[0] for u in buffer.get_items()], [0])
+        thread.join()
+        self.assertEqual([u[0] for u in buffer.get_items()], [1])
+
+    @timeout_decorator.timeout(1)
+    def test_close_unblocks(self):
+        discarded = []
+        buffer = RingBuffer(
+            1, "block", wait_for_full=True, n=1, on_discard=discarded.append
+        )
+        buffer.add(self.make_update(0, 0))
+
+        thread = Thread(target=buffer.add, args=(self.make_update(1, 0),), daemon=True)
+        thread.start()
+        time.sleep(0.05)
+
+        buffer.close()
+        thread.join()
+        self.assertEqual([u[0] for u in discarded], [1])
+
+
+class TestPriorityBuffer(unittest.TestCase):
+    def make_update(self, client_id, version):
+        return (client_id, None, None, version)
+
+    def fill(self, buffer):
+        for client_id, version in [(0, 1), (1, 3), (2, 0), (3, 3), (4, 2)]:
+            buffer.add(self.make_update(client_id, version))
+
+    def test_freshest_first(self):
+        buffer = PriorityBuffer("freshest", wait_for_full=False, n=3)
+        self.fill(buffer)
+
+        # Equal versions are dispensed in arrival order.
+        self.assertEqual([u[0] for u in buffer.get_items()], [1, 3, 4])
+        self.assertEqual([u[0] for u in buffer.get_items()], [0, 2])
+
+    def test_stalest_first_with_key(self):
+        buffer = PriorityBuffer(
+            "stalest", key=lambda update: -update[0], wait_for_full=False, n=2
+        )
+        self.fill(buffer)
+        self.assertEqual([u[0] for u in buffer.get_items()], [4, 3])
+
+    def test_min_weight(self):
+        version = [3]
+        discarded = []
+        buffer = PriorityBuffer(
+            weight_fn=lambda update, v: 0.5 ** (v - update[3]),
+            min_weight=0.25,
+            version_fn=lambda: version[0],
+            wait_for_full=False,
+            n=5,
+            on_discard=discarded.append,
+        )
+
+        # The update from version 0 (weight 1/8) is dropped on arrival.
+        self.fill(buffer)
+        self.assertEqual([u[0] for u in discarded], [2])
+        self.assertEqual(len(buffer), 4)
+
+        # Version 1 (weight 1/8) expires once the global model moves on.
+        version[0] = 4
+        self.assertEqual([u[0] for u in buffer.get_items()], [1, 3, 4])
+        self.assertEqual([u[0] for u in discarded], [2, 0])
+        self.assertEqual(buffer.num_discarded, 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+from threading import Barrier
+from unittest import mock
+
+import timeout_decorator
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+import wandb
+from afl_bench.agents.client_process import ClientProcess
+from afl_bench.agents.clients import Client
+from afl_bench.agents.runtime_model import InstantRuntime
+from afl_bench.agents.server import Server
+from afl_bench.agents.strategies import Strategy
+from afl_bench.compression import HalfCodec
+from afl_bench.updates import get_update_delta
+
+# A fast client whose updates are accepted, and a slow one whose updates are
+# several versions old by the time they arrive and are rejected.
+RUNTIMES = [0.02, 0.2]
+NUM_AGGREGATIONS = 30
+
+
+def make_loader(seed):
+    generator = torch.Generator().manual_seed(seed)
+    dataset = TensorDataset(
+        torch.randn(8, 4, generator=generator),
+        torch.randint(0, 2, (8,), generator=generator),
+    )
+    return DataLoader(dataset, batch_size=4)
+
+
+def make_client(client_id):
+    return Client(
+        torch.nn.Linear(4, 2), make_loader(client_id), make_loader(client_id), lr=0.1
+    )
+
+
+class TestClientProcess(unittest.TestCase):
+    def setUp(self):
+        wandb.init(mode="disabled")
+
+    def tearDown(self):
+        wandb.finish()
+
+    def make_server(self):
+        self.updates = []
+
+        def aggregate(global_model_and_version, client_updates):
+            global_model, _ = global_model_and_version
+            deltas = []
+            for update in client_updates:
+                delta = [(name, p.clone()) for name, p in get_update_delta(update)]
+                old_params = [(name, p.clone()) for name, p in update[1]]
+                self.updates.append((update[0], old_params, delta))
+                deltas.append(delta)
+            return [
+                (name, param + sum(delta[i][1] for delta in deltas) / len(deltas))
+                for i, (name, param) in enumerate(global_model)
+            ]
+
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=1,
+            max_staleness=2,
+            aggregate=aggregate,
+        )
+        return Server(
+            torch.nn.Linear(4, 2),
+            strategy,
+            NUM_AGGREGATIONS,
+            make_loader(100),
+            device="cpu",
+        )
+
+    def run_processes(self, codec=None):
+        server = self.make_server()
+        processes = [
+            # Started from a fork server rather than forked, since autograd cannot
+            # run in a worker forked after other tests used it in this process.
+            ClientProcess(
+                make_client(i),
+                server,
+                InstantRuntime(runtime),
+                i,
+                start_method="forkserver",
+                codec=codec,
+            )
+            for i, runtime in enumerate(RUNTIMES)
+        ]
+
+        # Workers take a while to start, so hold each one's first pull until all
+        # have started, for the slow worker's updates to be reliably stale.
+        started = Barrier(len(processes))
+        get_current_model = server.get_current_model
+
+        def pull(prev_version=None):
+            if prev_version is None:
+                started.wait()
+            return get_current_model(prev_version)
+
+        logged = []
+        with mock.patch.object(
+            wandb, "log", side_effect=logged.append
+        ), mock.patch.object(server, "get_current_model", side_effect=pull):
+            server.run()
+            for process in processes:
+                process.run()
+            server.join()
+            for process in processes:
+                process.stop()
+        return server, logged
+
+    def assert_deltas_match_training(self, atol):
+        self.assertGreater(len(self.updates), 0)
+        for client_id, old_params, delta in self.updates:
+            # Training is deterministic, so retraining from the pulled model in
+            # this process reproduces the worker's result.
+            new_params, _, _ = make_client(client_id).fit(old_params, {})
+            for (_, old_p), (_, delta_p), (_, new_p) in zip(
+                old_params, delta, new_params
+            ):
+                self.assertTrue(torch.allclose(delta_p, new_p - old_p, atol=atol))
+
+    @timeout_decorator.timeout(60)
+    def test_run(self):
+        server, logged = self.run_processes()
+
+        self.assertGreaterEqual(server.version_number, NUM_AGGREGATIONS)
+        self.assert_deltas_match_training(atol=1e-6)
+
+        # The slow worker's updates are rejected, which raises StaleUpdateError in
+        # the worker, and it keeps pulling and pushing after each rejection.
+        rejections = [
+            data["client.1"]
+            for data in logged
+            if "rejected_staleness" in data.get("client.1", {})
+        ]
+        self.assertGreaterEqual(len(rejections), 2)
+        self.assertEqual(server.num_rejected, len(rejections))
+        self.assertTrue(all(r["rejected_staleness"] > 2 for r in rejections))
+        self.assertEqual({client_id for client_id, _, _ in self.updates}, {0})
+
+    @timeout_decorator.timeout(60)
+    def test_run_compressed(self):
+        server, _ = self.run_processes(codec=HalfCodec())
+
+        self.assertGreaterEqual(server.version_number, NUM_AGGREGATIONS)
+        self.assert_deltas_match_training(atol=1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
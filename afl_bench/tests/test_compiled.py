@@ -0,0 +1,30 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from afl_bench.agents.compiled import CompiledFunction, compiled_forward_loss
+
+
+class TestCompiled(unittest.TestCase):
+    def test_eager_fallback(self):
+        def unsupported(*args):
+            raise RuntimeError("unsupported op")
+
+        with mock.patch.object(torch, "compile", return_value=unsupported):
+            fn = CompiledFunction(lambda x: x + 1, "test")
+        self.assertEqual(fn(1), 2)
+
+        # Compilation is not retried once it has failed.
+        self.assertIsNone(fn.compiled)
+        self.assertEqual(fn(2), 3)
+
+    def test_shared_per_architecture(self):
+        self.assertIs(
+            compiled_forward_loss(torch.nn.Linear(2, 2)),
+            compiled_forward_loss(torch.nn.Linear(2, 2)),
+        )
+        self.assertIsNot(
+            compiled_forward_loss(torch.nn.Linear(2, 2)),
+            compiled_forward_loss(torch.nn.Linear(2, 3)),
+        )
@@ -0,0 +1,87 @@
+import unittest
+
+import torch
+
+from afl_bench.agents.aggregation import apply_weighted_deltas
+from afl_bench.compression import (
+    HalfCodec,
+    Int8Codec,
+    TopKCodec,
+    get_delta_nbytes,
+)
+from afl_bench.params import FlatParams, ParamLayout
+from afl_bench.updates import DeltaUpdate
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.layout = ParamLayout.get(["a", "b"], [(100, 50), (37,)])
+        self.delta = FlatParams(torch.randn(self.layout.numel), self.layout)
+
+    def test_roundtrip(self):
+        for codec, rtol in (
+            (HalfCodec(torch.float16), 1e-3),
+            (HalfCodec(torch.bfloat16), 1e-2),
+            (Int8Codec(block_size=256), 2e-2),
+        ):
+            decoded = codec(self.delta).decode()
+            self.assertIs(decoded.layout, self.layout)
+            error = (decoded.flat - self.delta.flat).abs().max()
+            self.assertLess(error, rtol * self.delta.flat.abs().max())
+
+    def test_int8_unbiased(self):
+        codec = Int8Codec(block_size=256)
+        mean = sum(codec(self.delta).decode().flat for _ in range(200)) / 200
+        # Rounding to nearest would be off by up to half a quantization step.
+        step = self.delta.flat.abs().max() / 127
+        self.assertLess((mean - self.delta.flat).abs().max(), 0.2 * step)
+
+    def test_nbytes(self):
+        full = get_delta_nbytes(self.delta)
+        self.assertEqual(full, get_delta_nbytes(list(self.delta)))
+        self.assertEqual(get_delta_nbytes(HalfCodec()(self.delta)), full // 2)
+        self.assertLess(get_delta_nbytes(Int8Codec()(self.delta)), full // 3)
+        topk = TopKCodec(ratio=0.01)(self.delta)
+        # 50 int32 indices and float32 values.
+        self.assertEqual(get_delta_nbytes(topk), 50 * 8)
+
+    def test_topk_error_feedback(self):
+        codec = TopKCodec(ratio=0.1)
+        sent = torch.zeros(self.layout.numel)
+        for _ in range(3):
+            sent += codec(self.delta).decode().flat
+
+        # Everything not yet sent is held in the residual.
+        self.assertTrue(
+            torch.allclose(sent + codec.residual, 3 * self.delta.flat, atol=1e-5)
+        )
+
+        sparse = TopKCodec(ratio=0.1, error_feedback=False)(self.delta)
+        kept = self.delta.flat.abs().topk(sparse.values.numel()).values
+        self.assertTrue(
+            torch.equal(sparse.values.abs().sort().values, kept.sort().values)
+        )
+
+    def test_aggregate_compressed(self):
+        global_model = FlatParams(torch.randn(self.layout.numel), self.layout)
+        codecs = [HalfCodec(), Int8Codec(), TopKCodec(ratio=0.05), None]
+        deltas = [
+            codec(self.delta) if codec is not None else self.delta for codec in codecs
+        ]
+        weights = [0.4, 0.3, 0.2, 0.1]
+
+        new_model = apply_weighted_deltas(
+            global_model,
+            [DeltaUpdate(i, global_model, d, 0) for i, d in enumerate(deltas)],
+            weights,
+            include_param=lambda name: name != "b",
+        )
+
+        expected = global_model.flat.clone()
+        for delta, weight in zip(deltas, weights):
+            if not isinstance(delta, FlatParams):
+                delta = delta.decode()
+            expected += weight * delta.flat
+        expected[5000:] = global_model.flat[5000:]
+        self.assertTrue(torch.allclose(new_model.flat, expected, atol=1e-6))
@@ -0,0 +1,105 @@
+import pickle
+import unittest
+
+import torch
+
+from afl_bench.agents.common import flatten_module_, get_parameters, set_parameters
+from afl_bench.params import AVERAGED, SKIPPED, SYNCED, FlatParams, ParamLayout
+
+
+class TestFlatParams(unittest.TestCase):
+    def test_round_trip(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.Linear(3, 2))
+        flat_params = get_parameters(net, flat=True)
+
+        self.assertEqual(flat_params.flat.shape, (4 * 3 + 3 + 3 * 2 + 2,))
+        for (name, param), (flat_name, view) in zip(
+            net.named_parameters(), flat_params
+        ):
+            self.assertEqual(name, flat_name)
+            self.assertTrue(torch.equal(param, view))
+
+        # Views alias the flat buffer.
+        flat_params.flat.zero_()
+        set_parameters(net, flat_params)
+        for _, param in net.named_parameters():
+            self.assertEqual(param.abs().sum().item(), 0.0)
+
+    def test_layout_shared(self):
+        layout = ParamLayout.from_params(get_parameters(torch.nn.Linear(4, 3)))
+        other = ParamLayout.from_params(get_parameters(torch.nn.Linear(4, 3)))
+
+        self.assertIs(layout, other)
+        self.assertEqual(layout.offsets, (0, 12))
+        self.assertEqual(layout.slice("bias"), slice(12, 15))
+
+        # Layouts sent between processes resolve to the shared instance.
+        self.assertIs(pickle.loads(pickle.dumps(layout)), layout)
+
+    def test_module_state(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        state = get_parameters(net, flat=True)
+
+        # Buffers are included, with roles in state_dict order.
+        self.assertEqual(state.layout.names, tuple(net.state_dict().keys()))
+        self.assertEqual(
+            state.layout.roles,
+            (AVERAGED, AVERAGED, AVERAGED, AVERAGED, SYNCED, SYNCED, SKIPPED),
+        )
+        self.assertEqual(state.layout.role_ranges[AVERAGED], (slice(0, 21),))
+        self.assertEqual(state.layout.role_ranges[SYNCED], (slice(21, 27),))
+        self.assertIs(state.layout, ParamLayout.from_module(net))
+
+        # Setting the state copies buffers too.
+        state.flat.fill_(2.0)
+        set_parameters(net, state)
+        self.assertTrue(torch.equal(net[1].running_var, torch.full((3,), 2.0)))
+        self.assertEqual(net[1].num_batches_tracked.item(), 2)
+
+    def test_set_parameters(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        state = get_parameters(net, flat=True)
+        state.flat.fill_(3.0)
+        for param in net.parameters():
+            param.grad = torch.ones_like(param)
+
+        set_parameters(net, state, zero_grad=False)
+        self.assertTrue(torch.equal(net[0].weight, torch.full((3, 4), 3.0)))
+        self.assertTrue(torch.equal(net[0].weight.grad, torch.ones(3, 4)))
+        set_parameters(net, state)
+        self.assertTrue(torch.equal(net[0].weight.grad, torch.zeros(3, 4)))
+
+        # Reassigned tensors are picked up.
+        net[1].running_mean = torch.zeros(3)
+        set_parameters(net, state)
+        self.assertTrue(torch.equal(net[1].running_mean, torch.full((3,), 3.0)))
+
+    def test_flatten_module(self):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        expected = get_parameters(net, flat=True)
+        state = flatten_module_(net)
+        self.assertTrue(torch.equal(state.flat, expected.flat))
+
+        # Named access aliases the flat buffers, for gradients too.
+        self.assertEqual(net[0].weight.data_ptr(), state.flat.data_ptr())
+        net(torch.randn(8, 4)).sum().backward()
+        self.assertEqual(
+            net[0].bias.grad.data_ptr(),
+            net[0].weight.grad.data_ptr() + 12 * net[0].weight.grad.element_size(),
+        )
+        self.assertIs(get_parameters(net), state)
+
+        # Setting and getting the state is a copy of the flat buffer, which also
+        # carries the batch counter.
+        set_parameters(net, expected)
+        self.assertTrue(torch.equal(state.flat, expected.flat))
+        self.assertEqual(net[1].num_batches_tracked.item(), 0)
+        self.assertTrue(torch.equal(net[0].weight.grad, torch.zeros(3, 4)))
+        net[1].num_batches_tracked += 5
+        self.assertEqual(
+            dict(get_parameters(net, flat=True))["1.num_batches_tracked"], 5
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
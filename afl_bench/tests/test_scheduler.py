@@ -0,0 +1,97 @@
+import unittest
+from collections import defaultdict
+
+import timeout_decorator
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+import wandb
+from afl_bench.agents.client_thread import ClientThread
+from afl_bench.agents.clients import Client
+from afl_bench.agents.runtime_model import InstantRuntime
+from afl_bench.agents.scheduler import ClientScheduler, LogicalClient
+from afl_bench.agents.server import Server
+from afl_bench.agents.strategies import Strategy
+
+RUNTIMES = [0.15, 0.02, 0.02, 0.02]
+
+
+def make_loader():
+    dataset = TensorDataset(torch.randn(8, 4), torch.randint(0, 2, (8,)))
+    return DataLoader(dataset, batch_size=4)
+
+
+def make_client():
+    return Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+
+
+class TestClientScheduler(unittest.TestCase):
+    def setUp(self):
+        wandb.init(mode="disabled")
+
+    def tearDown(self):
+        wandb.finish()
+
+    def make_server(self):
+        self.staleness = defaultdict(list)
+
+        def aggregate(global_model_and_version, client_updates):
+            global_model, version = global_model_and_version
+            for update in client_updates:
+                self.staleness[update[0]].append(version - update[3])
+            return [(name, param.clone()) for name, param in global_model]
+
+        strategy = Strategy(
+            name="Test", wait_for_full=True, buffer_size=1, aggregate=aggregate
+        )
+        return Server(torch.nn.Linear(4, 2), strategy, 40, make_loader(), device="cpu")
+
+    def run_threads(self):
+        server = self.make_server()
+        threads = [
+            ClientThread(make_client(), server, InstantRuntime(runtime), i)
+            for i, runtime in enumerate(RUNTIMES)
+        ]
+        server.run()
+        for thread in threads:
+            thread.run()
+        server.join()
+        for thread in threads:
+            thread.stop()
+        return self.staleness[0]
+
+    def run_scheduler(self):
+        server = self.make_server()
+        logical_clients = [
+            LogicalClient(
+                i, make_loader(), make_loader(), InstantRuntime(runtime), seed=i
+            )
+            for i, runtime in enumerate(RUNTIMES)
+        ]
+        scheduler = ClientScheduler(
+            server, [make_client() for _ in RUNTIMES], logical_clients
+        )
+        server.run()
+        scheduler.run()
+        server.join()
+        scheduler.stop()
+        return self.staleness[0]
+
+    @timeout_decorator.timeout(30)
+    def test_staleness_matches_threads(self):
+        threaded = self.run_threads()
+        scheduled = self.run_scheduler()
+
+        # The slow client trains on the model it pulled when its round started,
+        # so its updates are several versions stale under both backends.
+        self.assertGreater(len(scheduled), 0)
+        self.assertGreaterEqual(min(threaded), 3)
+        self.assertGreaterEqual(min(scheduled), 3)
+        self.assertLess(
+            abs(sum(scheduled) / len(scheduled) - sum(threaded) / len(threaded)),
+            sum(threaded) / len(threaded) / 2,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
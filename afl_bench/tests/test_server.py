@@ -0,0 +1,149 @@
+import unittest
+from threading import Thread
+
+import timeout_decorator
+import torch
+
+from afl_bench.agents.server import Server, StaleUpdateError
+from afl_bench.agents.strategies import Strategy
+from afl_bench.params import FlatParams
+
+
+def keep_global(global_model_and_version, client_updates):
+    return [(name, param.clone()) for name, param in global_model_and_version[0]]
+
+
+class TestServer(unittest.TestCase):
+    def test_reject_stale_update(self):
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=1,
+            max_staleness=1,
+            aggregate=keep_global,
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 10, None, device="cpu")
+
+        # A client pulls version 0, then two other updates are aggregated.
+        stale_params, stale_version = server.get_current_model()
+        for _ in range(2):
+            params, version = server.get_current_model()
+            server.broadcast_update_delta(0, [(n, p * 0) for n, p in params], version)
+            server.apply_updates(server.buffer.get_items())
+
+        with self.assertRaises(StaleUpdateError) as context:
+            server.broadcast_update_delta(
+                1, [(n, p * 0) for n, p in stale_params], stale_version
+            )
+        self.assertEqual(context.exception.version_number, 0)
+        self.assertEqual(context.exception.current_version, 2)
+
+        # The rejected update is not buffered and its snapshot is freed.
+        self.assertEqual(server.num_rejected, 1)
+        self.assertEqual(len(server.buffer), 0)
+        self.assertEqual(list(server.versions.snapshots), [2])
+
+        # Updates within the cutoff are still accepted.
+        params, version = server.get_current_model()
+        server.broadcast_update_delta(1, [(n, p * 0) for n, p in params], version)
+        self.assertEqual(len(server.buffer), 1)
+
+    @timeout_decorator.timeout(1)
+    def test_pull_does_not_take_model_lock(self):
+        strategy = Strategy(
+            name="Test", wait_for_full=True, buffer_size=1, aggregate=keep_global
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 10, None, device="cpu")
+
+        with server.model_mutex:
+            params, version = server.get_current_model()
+        self.assertEqual(version, 0)
+
+        # A client which already has the latest version waits for the next one.
+        result = [None]
+
+        def pull():
+            result[0] = server.get_current_model(prev_version=version)
+
+        server.is_running = True
+        thread = Thread(target=pull, daemon=True)
+        thread.start()
+
+        server.broadcast_update_delta(0, [(n, p * 0) for n, p in params], version)
+        server.apply_updates(server.buffer.get_items())
+        thread.join()
+        self.assertEqual(result[0][1], 1)
+        self.assertEqual(server.versions.latest.refcount, 1)
+
+    def test_fedasync_mixing(self):
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=1,
+            aggregate=keep_global,
+            fedasync_mixing=lambda staleness: 0.5 / (staleness + 1),
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 3, None, device="cpu")
+        x0 = [p.clone() for _, p in server.versions.latest.params]
+
+        # A fresh update is mixed in on arrival with weight 0.5, without buffering.
+        stale_params, stale_version = server.get_current_model()
+        params, version = server.get_current_model()
+        delta = [(n, torch.full_like(p, 2)) for n, p in params]
+        server.broadcast_update_delta(0, delta, version)
+        self.assertEqual(server.version_number, 1)
+        self.assertEqual(len(server.buffer), 0)
+        x1 = [p.clone() for _, p in server.versions.latest.params]
+        for p0, p1 in zip(x0, x1):
+            self.assertTrue(torch.allclose(p1, p0 + 1))
+
+        # A stale client model is mixed in with weight 0.25.
+        server.broadcast_updated_model(
+            1, stale_params, [(n, p + 4) for n, p in stale_params], stale_version
+        )
+        self.assertEqual(server.version_number, 2)
+        for p0, p1, p2 in zip(x0, x1, server.versions.latest.params):
+            self.assertTrue(torch.allclose(p2[1], 0.75 * p1 + 0.25 * (p0 + 4)))
+        self.assertEqual(list(server.versions.snapshots), [2])
+
+        # Updates stop being mixed in after the final aggregation.
+        for _ in range(2):
+            params, version = server.get_current_model()
+            server.broadcast_update_delta(0, [(n, p * 0) for n, p in params], version)
+        self.assertEqual(server.version_number, 3)
+        self.assertEqual(server.versions.latest.refcount, 0)
+
+    def test_version_history(self):
+        looked_up = []
+
+        def aggregate(global_model_and_version, client_updates, history):
+            global_model, version = global_model_and_version
+            if version > 0:
+                looked_up.append(history.get(version - 1, global_model))
+            return FlatParams(global_model.flat + 1, global_model.layout)
+
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=1,
+            aggregate=aggregate,
+            history_versions=1,
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 10, None, device="cpu")
+        x0 = server.versions.latest.params.flat.clone()
+
+        for _ in range(3):
+            params, version = server.get_current_model()
+            server.broadcast_update_delta(0, [(n, p * 0) for n, p in params], version)
+            server.apply_updates(server.buffer.get_items())
+
+        # Each aggregation could look up the previous version, which is not kept
+        # as a snapshot.
+        for i, model in enumerate(looked_up):
+            self.assertTrue(torch.allclose(model.flat, x0 + i))
+        self.assertEqual(list(server.versions.snapshots), [3])
+        self.assertNotIn(1, server.history)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import torch
+
+from afl_bench.agents.server_optimizers import FedAdam, FedYogi, ServerSGD
+from afl_bench.params import AVERAGED, SYNCED, FlatParams, ParamLayout
+
+
+class TestServerOptimizers(unittest.TestCase):
+    def setUp(self):
+        self.layout = ParamLayout.get(["a", "b"], [(3,), (2,)])
+        self.global_model = FlatParams(torch.randn(5), self.layout)
+        self.pseudo_grads = [torch.randn(5) for _ in range(3)]
+
+    def run_steps(self, optimizer):
+        global_model = self.global_model
+        for pseudo_grad in self.pseudo_grads:
+            before = global_model.flat.clone()
+            new_model = FlatParams(global_model.flat + pseudo_grad, self.layout)
+            global_model = optimizer(global_model, new_model)
+
+            # The result overwrites the new model, never the global model.
+            self.assertIs(global_model, new_model)
+        self.assertFalse(torch.equal(global_model.flat, before))
+        return global_model.flat
+
+    def test_sgd_identity(self):
+        expected = self.global_model.flat + sum(self.pseudo_grads)
+        self.assertTrue(torch.allclose(self.run_steps(ServerSGD()), expected))
+
+    def test_sgd_momentum(self):
+        x, m = self.global_model.flat.clone(), torch.zeros(5)
+        for g in self.pseudo_grads:
+            m = 0.9 * m + g
+            x = x + 0.5 * m
+        optimizer = ServerSGD(lr=0.5, momentum=0.9)
+        self.assertTrue(torch.allclose(self.run_steps(optimizer), x))
+
+    def test_adaptive(self):
+        for optimizer_class in (FedAdam, FedYogi):
+            x, m, v = (
+                self.global_model.flat.clone(),
+                torch.zeros(5),
+                torch.full((5,), 1e-6),
+            )
+            for g in self.pseudo_grads:
+                m = 0.9 * m + 0.1 * g
+                if optimizer_class is FedAdam:
+                    v = 0.99 * v + 0.01 * g * g
+                else:
+                    v = v - 0.01 * g * g * torch.sign(v - g * g)
+                x = x + 0.1 * m / (v.sqrt() + 1e-3)
+
+            optimizer = optimizer_class(lr=0.1)
+            self.assertTrue(torch.allclose(self.run_steps(optimizer), x, atol=1e-5))
+
+    def test_synced_state(self):
+        layout = ParamLayout.get(["a", "b"], [(3,), (2,)], [AVERAGED, SYNCED])
+        global_model = FlatParams(torch.zeros(5), layout)
+        new_model = FlatParams(torch.ones(5), layout)
+
+        # Synced state keeps the strategy's value rather than being stepped.
+        new_model = ServerSGD(lr=0.5)(global_model, new_model)
+        self.assertTrue(
+            torch.equal(new_model.flat, torch.tensor([0.5] * 3 + [1.0] * 2))
+        )
+
+    def test_unchanged_model(self):
+        # A strategy returning the global model itself must not have it modified.
+        before = self.global_model.flat.clone()
+        new_model = ServerSGD(momentum=0.9)(self.global_model, self.global_model)
+        self.assertTrue(torch.equal(self.global_model.flat, before))
+        self.assertTrue(torch.equal(new_model.flat, before))
@@ -0,0 +1,285 @@
+import unittest
+from unittest import mock
+
+import timeout_decorator
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+import wandb
+from afl_bench.agents.aggregation import apply_weighted_deltas
+from afl_bench.agents.buffer import PriorityBuffer
+from afl_bench.agents.clients import Client
+from afl_bench.agents.runtime_model import InstantRuntime, UniformRuntime
+from afl_bench.agents.server import Server
+from afl_bench.agents.simulation import Simulation
+from afl_bench.agents.strategies import Strategy
+from afl_bench.agents.weighting import StalenessExponential, weighted_strategy
+from afl_bench.compression import Int8Codec, SparseDelta, TopKCodec
+
+
+def make_loader():
+    dataset = TensorDataset(torch.randn(8, 4), torch.randint(0, 2, (8,)))
+    return DataLoader(dataset, batch_size=4)
+
+
+class TestSimulation(unittest.TestCase):
+    def setUp(self):
+        wandb.init(mode="disabled")
+
+    def tearDown(self):
+        wandb.finish()
+
+    @timeout_decorator.timeout(10)
+    def test_virtual_time_ordering(self):
+        aggregated_clients = []
+
+        def aggregate(global_model_and_version, client_updates):
+            aggregated_clients.append([update[0] for update in client_updates])
+            return [
+                (name, param.detach().clone())
+                for name, param in global_model_and_version[0]
+            ]
+
+        strategy = Strategy(
+            name="Test", wait_for_full=True, buffer_size=1, aggregate=aggregate
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 4, make_loader(), device="cpu")
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(2)
+        ]
+
+        # Client 0 takes 3 virtual seconds a round, client 1 takes 2 seconds.
+        simulation = Simulation(
+            server, clients, [InstantRuntime(3.0), InstantRuntime(2.0)]
+        )
+        simulation.run()
+
+        # Completions at t=2 (client 1), t=3 (client 0), t=4 (client 1), t=6 (both).
+        self.assertEqual(server.version_number, 4)
+        self.assertEqual(aggregated_clients, [[1], [0], [1], [0]])
+        self.assertEqual(simulation.clock, 6.0)
+
+    @timeout_decorator.timeout(10)
+    def test_compressed_updates(self):
+        received = []
+
+        def aggregate(global_model_and_version, client_updates):
+            received.extend(type(update.delta) for update in client_updates)
+            return apply_weighted_deltas(
+                global_model_and_version[0], client_updates, [1.0]
+            )
+
+        strategy = Strategy(
+            name="Test", wait_for_full=True, buffer_size=1, aggregate=aggregate
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 4, make_loader(), device="cpu")
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(2)
+        ]
+        simulation = Simulation(
+            server,
+            clients,
+            [InstantRuntime(3.0), InstantRuntime(2.0)],
+            codecs=[Int8Codec(block_size=16), TopKCodec(ratio=0.2)],
+        )
+        simulation.run()
+
+        # Client 1 sends 2 of its 10 entries, client 0 a padded block and its scale.
+        self.assertEqual(server.version_number, 4)
+        self.assertEqual(received[0], SparseDelta)
+        self.assertEqual(server.bytes_received, 2 * (2 * 8) + 2 * (16 + 4))
+
+    @timeout_decorator.timeout(10)
+    def test_fedasync_mixing(self):
+        staleness = []
+
+        def mixing(s):
+            staleness.append(s)
+            return 0.5
+
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=1,
+            aggregate=lambda *_: self.fail("FedAsync bypasses aggregation."),
+            fedasync_mixing=mixing,
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 4, make_loader(), device="cpu")
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(2)
+        ]
+        simulation = Simulation(
+            server, clients, [InstantRuntime(3.0), InstantRuntime(2.0)]
+        )
+        simulation.run()
+
+        # Same completions as above, each mixed in on arrival.
+        self.assertEqual(server.version_number, 4)
+        self.assertEqual(staleness, [0, 1, 1, 1])
+        self.assertEqual(simulation.clock, 6.0)
+
+    @timeout_decorator.timeout(10)
+    def test_hybrid_flush(self):
+        aggregated_clients = []
+
+        def aggregate(global_model_and_version, client_updates):
+            aggregated_clients.append([update[0] for update in client_updates])
+            return [
+                (name, param.detach().clone())
+                for name, param in global_model_and_version[0]
+            ]
+
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=True,
+            buffer_size=2,
+            ms_to_wait=2500,
+            aggregate=aggregate,
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 3, make_loader(), device="cpu")
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(2)
+        ]
+
+        simulation = Simulation(
+            server, clients, [InstantRuntime(3.0), InstantRuntime(2.0)]
+        )
+        simulation.run()
+
+        # Timed flush at t=2.5, then the buffer fills at t=4.5 and t=6.5, each
+        # restarting the flush timer.
+        self.assertEqual(aggregated_clients, [[1], [0, 1], [0, 1]])
+        self.assertEqual(simulation.clock, 6.5)
+
+    @timeout_decorator.timeout(10)
+    def test_rejected_update_not_published(self):
+        batch_sizes = []
+
+        def aggregate(global_model_and_version, client_updates):
+            batch_sizes.append(len(client_updates))
+            return [
+                (name, param.detach().clone())
+                for name, param in global_model_and_version[0]
+            ]
+
+        strategy = Strategy(
+            name="Test",
+            wait_for_full=False,
+            buffer_size=1,
+            max_staleness=1,
+            aggregate=aggregate,
+        )
+        server = Server(torch.nn.Linear(4, 2), strategy, 6, make_loader(), device="cpu")
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(2)
+        ]
+        simulation = Simulation(
+            server, clients, [InstantRuntime(1.0), InstantRuntime(2.5)]
+        )
+        simulation.run()
+
+        # Client 1 is two versions behind every time it completes, so each of its
+        # updates is rejected without publishing a version.
+        self.assertGreater(server.num_rejected, 0)
+        self.assertEqual(batch_sizes, [1] * 6)
+        self.assertEqual(server.version_number, 6)
+        self.assertEqual(simulation.clock, 6.0)
+
+    @timeout_decorator.timeout(10)
+    def test_discarded_update_not_published(self):
+        strategy = weighted_strategy(
+            "Test",
+            StalenessExponential(0.5),
+            wait_for_full=False,
+            buffer_size=1,
+            min_update_weight=0.3,
+        )
+        server = Server(
+            torch.nn.Linear(4, 2), strategy, 20, make_loader(), device="cpu"
+        )
+        self.assertIsInstance(server.buffer, PriorityBuffer)
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(3)
+        ]
+        simulation = Simulation(
+            server,
+            clients,
+            [InstantRuntime(1.0), InstantRuntime(1.1), InstantRuntime(5.0)],
+        )
+
+        logged = []
+        with mock.patch.object(
+            server, "apply_updates", wraps=server.apply_updates
+        ) as apply_updates, mock.patch.object(wandb, "log", side_effect=logged.append):
+            simulation.run()
+
+        # The slow client is several versions behind, so its updates weigh less
+        # than min_update_weight and are discarded without publishing a version.
+        self.assertGreater(server.buffer.num_discarded, 0)
+        batch_sizes = [len(call.args[0]) for call in apply_updates.call_args_list]
+        self.assertEqual(batch_sizes, [1] * 20)
+        self.assertEqual(server.version_number, 20)
+
+        server_logs = [data["server"] for data in logged if "server" in data]
+        self.assertEqual(server_logs[-1]["num_discarded"], server.buffer.num_discarded)
+
+    def run_uniform_runtimes(self, batch_clients):
+        aggregated_clients = []
+
+        def aggregate(global_model_and_version, client_updates):
+            aggregated_clients.append([update[0] for update in client_updates])
+            return [
+                (name, param.detach().clone())
+                for name, param in global_model_and_version[0]
+            ]
+
+        strategy = Strategy(
+            name="Test", wait_for_full=True, buffer_size=3, aggregate=aggregate
+        )
+        server = Server(
+            torch.nn.Linear(4, 2), strategy, 10, make_loader(), device="cpu"
+        )
+        clients = [
+            Client(torch.nn.Linear(4, 2), make_loader(), make_loader(), num_steps=1)
+            for _ in range(6)
+        ]
+        simulation = Simulation(
+            server,
+            clients,
+            [UniformRuntime(1.0, 3.0) for _ in clients],
+            batch_clients=batch_clients,
+        )
+        return simulation, aggregated_clients
+
+    @timeout_decorator.timeout(30)
+    def test_batched_clients(self):
+        simulation, aggregated_clients = self.run_uniform_runtimes(True)
+        with mock.patch.object(
+            simulation.batched_client, "fit", wraps=simulation.batched_client.fit
+        ) as fit:
+            simulation.run()
+
+        # Runtimes never tie, but the clients which started rounds since the last
+        # batch are trained together once the first of them completes.
+        self.assertEqual(simulation.server.version_number, 10)
+        batch_sizes = [len(call.args[0]) for call in fit.call_args_list]
+        self.assertEqual(batch_sizes[0], 6)
+        self.assertGreater(len(batch_sizes), 1)
+        self.assertTrue(all(size > 1 for size in batch_sizes))
+        self.assertGreaterEqual(sum(batch_sizes), 10 * 3)
+
+        # Updates arrive in the same virtual time order as without batching.
+        unbatched, unbatched_clients = self.run_uniform_runtimes(False)
+        unbatched.run()
+        self.assertEqual(aggregated_clients, unbatched_clients)
+        self.assertEqual(simulation.clock, unbatched.clock)
+
+
+if __name__ == "__main__":
+    unittest.main()
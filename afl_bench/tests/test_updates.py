@@ -0,0 +1,28 @@
+import unittest
+
+import torch
+
+from afl_bench.agents.common import get_parameters
+from afl_bench.updates import DeltaUpdate, compute_delta, get_update_delta
+
+
+class TestDeltaUpdate(unittest.TestCase):
+    def test_matches_tuple_update(self):
+        old_params = get_parameters(torch.nn.Linear(4, 2), flat=True)
+        new_params = get_parameters(torch.nn.Linear(4, 2))
+        update = DeltaUpdate(3, old_params, compute_delta(old_params, new_params), 7)
+
+        client_id, old, new, version = update
+        self.assertEqual((client_id, version), (3, 7))
+        self.assertIs(old, old_params)
+        for (name, p), (new_name, new_p) in zip(new_params, new):
+            self.assertEqual(name, new_name)
+            self.assertTrue(torch.allclose(p, new_p))
+
+        # Tuple updates give the same delta, computed on demand.
+        tuple_delta = get_update_delta((3, old_params, new_params, 7))
+        self.assertTrue(torch.allclose(tuple_delta.flat, update.delta.flat))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+
+from afl_bench.agents.version_history import VersionHistory
+from afl_bench.params import FlatParams, ParamLayout
+
+
+class TestVersionHistory(unittest.TestCase):
+    def setUp(self):
+        self.layout = ParamLayout.get(["a", "b"], [(2, 2), (3,)])
+        self.models = [FlatParams(torch.randn(7), self.layout) for _ in range(6)]
+
+    def test_ring(self):
+        history = VersionHistory(3)
+        for version, (current, new) in enumerate(zip(self.models, self.models[1:])):
+            history.push(current, new, version)
+
+            # Every held version is the current model minus a row of the ring.
+            held = [v for v in range(version + 1) if v in history]
+            self.assertEqual(held, list(range(max(0, version - 2), version + 1)))
+            for v in held:
+                self.assertTrue(
+                    torch.allclose(
+                        history.delta(v).flat, new.flat - self.models[v].flat, atol=1e-6
+                    )
+                )
+                self.assertTrue(
+                    torch.allclose(
+                        history.get(v, new).flat, self.models[v].flat, atol=1e-6
+                    )
+                )
+
+        with self.assertRaises(KeyError):
+            history.delta(1)
+        self.assertEqual(history.deltas.shape, (3, 7))
+
+    def test_memory_budget(self):
+        # Room for two rows of 7 float32 elements.
+        history = VersionHistory(5, max_bytes=2 * 7 * 4 + 1)
+        for version, (current, new) in enumerate(zip(self.models, self.models[1:])):
+            history.push(current, new, version)
+        self.assertEqual(history.capacity, 2)
+        self.assertEqual([v for v in range(5) if v in history], [3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import torch
+
+from afl_bench.agents.common import get_parameters
+from afl_bench.agents.version_store import VersionStore
+from afl_bench.params import FlatParams
+
+
+class TestVersionStore(unittest.TestCase):
+    def test_snapshots_freed_when_released(self):
+        net = torch.nn.Linear(4, 2)
+        store = VersionStore()
+        store.publish(get_parameters(net), 0)
+
+        # Two clients pull version 0, which is then superseded.
+        snapshot = store.acquire()
+        self.assertIs(store.acquire(), snapshot)
+        store.publish(get_parameters(net), 1)
+        self.assertEqual(len(store), 2)
+
+        store.release(0)
+        self.assertEqual(len(store), 2)
+        store.release(0)
+        self.assertEqual(len(store), 1)
+
+        # The latest version is kept even when unreferenced.
+        store.acquire()
+        store.release(1)
+        self.assertEqual(store.latest.version, 1)
+        self.assertEqual(len(store), 1)
+
+    def test_snapshot_is_a_copy(self):
+        net = torch.nn.Linear(4, 2)
+        store = VersionStore()
+        snapshot = store.publish(get_parameters(net), 0)
+
+        with torch.no_grad():
+            net.weight.add_(1.0)
+
+        self.assertFalse(torch.equal(snapshot.params[0][1], net.weight))
+
+    def test_freed_buffers_recycled(self):
+        net = torch.nn.Linear(4, 2)
+        store = VersionStore()
+        first = store.publish(get_parameters(net), 0)
+        store.publish(get_parameters(net), 1)
+
+        # Version 0 was unreferenced, so its buffer backs version 2.
+        with torch.no_grad():
+            net.weight.add_(1.0)
+        third = store.publish(get_parameters(net), 2)
+        self.assertEqual(third.params.flat.data_ptr(), first.params.flat.data_ptr())
+        self.assertTrue(torch.equal(third.params[0][1], net.weight))
+
+    def test_adopt(self):
+        net = torch.nn.Linear(4, 2)
+        store = VersionStore()
+        first = store.publish(get_parameters(net), 0)
+        store.acquire()
+
+        params = FlatParams.from_params(get_parameters(net))
+        self.assertIs(store.publish(params, 1, adopt=True).params, params)
+
+        # Parameters sharing memory with a snapshot are still copied.
+        aliased = FlatParams(first.params.flat, first.params.layout)
+        snapshot = store.publish(aliased, 2, adopt=True)
+        self.assertNotEqual(
+            snapshot.params.flat.data_ptr(), first.params.flat.data_ptr()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import math
+import unittest
+
+import torch
+
+from afl_bench.agents.aggregation import ParamMask
+from afl_bench.agents.weighting import (
+    ExpectedStaleness,
+    StalenessExponential,
+    Uniform,
+    normalize,
+    weighted_strategy,
+)
+from afl_bench.params import FlatParams, ParamLayout
+
+
+class TestWeighting(unittest.TestCase):
+    def setUp(self):
+        self.updates = [(i, None, None, v) for i, v in enumerate([3, 4, 5])]
+
+    def test_staleness_exponential(self):
+        weighting = StalenessExponential(0.5)
+        self.assertEqual(weighting(self.updates, 5), [0.25, 0.5, 1.0])
+
+        # Log weights differ from the weights by a per-version constant.
+        for update, weight in zip(self.updates, weighting(self.updates, 5)):
+            self.assertAlmostEqual(
+                weighting.log_weight(update) - math.log(weight), 5 * math.log(2)
+            )
+
+    def test_product(self):
+        weighting = Uniform() * StalenessExponential(0.5)
+        self.assertEqual(weighting(self.updates, 5), [0.25, 0.5, 1.0])
+        self.assertEqual(weighting.weight(self.updates[0], 5), 0.25)
+
+        weighting = StalenessExponential(0.5) * ExpectedStaleness(3, 3)
+        self.assertEqual(weighting(self.updates, 5), [0.5, 0.5, 0.0])
+
+    def test_normalize(self):
+        self.assertEqual(normalize([1.0, 3.0]), [0.25, 0.75])
+        self.assertEqual(normalize([0.0, 0.0]), [0, 0])
+
+    def test_param_mask(self):
+        layout = ParamLayout.get(["a", "bn.a", "bn.b", "c"], [(2,), (1,), (3,), (1,)])
+        mask = ParamMask(lambda name: "bn" not in name)
+        self.assertEqual(mask.excluded(layout), [slice(2, 6)])
+        self.assertIs(mask.excluded(layout), mask.excluded(layout))
+
+        global_model = FlatParams(torch.zeros(layout.numel), layout)
+        new_model = FlatParams(torch.ones(layout.numel), layout)
+        mask.restore(new_model, global_model)
+        self.assertEqual(new_model.flat.tolist(), [1, 1, 0, 0, 0, 0, 1])
+
+    def test_weighted_strategy(self):
+        net = torch.nn.Linear(2, 1)
+        global_model = [(n, p.detach().clone()) for n, p in net.named_parameters()]
+        updates = [
+            (i, global_model, [(n, p + i + 1) for n, p in global_model], v)
+            for i, v in enumerate([0, 1])
+        ]
+
+        strategy = weighted_strategy(
+            name="Test",
+            weighting=StalenessExponential(0.5),
+            include_param=lambda name: name != "bias",
+            wait_for_full=True,
+            buffer_size=2,
+        )
+        new_model = dict(list(strategy.aggregate((global_model, 1), updates)))
+
+        # Weights 1/3 and 2/3 on deltas of 1 and 2, bias left unchanged.
+        self.assertTrue(torch.allclose(new_model["weight"], global_model[0][1] + 5 / 3))
+        self.assertTrue(torch.equal(new_model["bias"], global_model[1][1]))
+
+    def test_streaming_requires_update_weight(self):
+        with self.assertRaises(AssertionError):
+            weighted_strategy(
+                name="Test",
+                weighting=ExpectedStaleness(2, 2),
+                streaming=True,
+                wait_for_full=True,
+                buffer_size=2,
+            )
@@ -1,6 +1,9 @@
-from typing import List, Tuple, TypeAlias
+from typing import List, Tuple, TypeAlias, Union
 
 import torch
 
-ModelParams: TypeAlias = List[Tuple[str, torch.Tensor]]
-ClientUpdate: TypeAlias = Tuple[int, ModelParams, ModelParams, int]
+from afl_bench.params import FlatParams
+from afl_bench.updates import DeltaUpdate
+
+ModelParams: TypeAlias = Union[List[Tuple[str, torch.Tensor]], FlatParams]
+ClientUpdate: TypeAlias = Union[Tuple[int, ModelParams, ModelParams, int], DeltaUpdate]
@@ -0,0 +1,152 @@
+from typing import Iterable, List, Optional, Tuple
+
+import torch
+
+from afl_bench.compression import CompressedDelta
+from afl_bench.params import FlatParams
+
+
+class DeltaUpdate:
+    def __init__(
+        self,
+        client_id: int,
+        old_params: Iterable[Tuple[str, torch.Tensor]],
+        delta: Iterable[Tuple[str, torch.Tensor]],
+        version_number: int,
+    ) -> None:
+        """
+        Client update carrying only the change made by local training, plus the
+        global model it was trained from (normally the shared snapshot for that
+        version, so holding it costs nothing extra).
+
+        Behaves like the (client id, old params, new params, version) tuple form of
+        ClientUpdate, reconstructing the new parameters on demand. Aggregation code
+        that only needs the delta should use get_update_delta instead.
+
+        Args:
+            client_id (int): the client id that trained the model.
+            old_params: model parameters prior to local training.
+            delta: new parameters minus old parameters, possibly compressed.
+            version_number (int): the version number of the old global model used.
+        """
+        self.client_id = client_id
+        self.old_params = old_params
+        self.delta = delta
+        self.version_number = version_number
+
+    @property
+    def new_params(self):
+        """
+        Reconstruct the client's parameters after local training.
+        """
+        delta = get_update_delta(self)
+        if isinstance(self.old_params, FlatParams) and isinstance(delta, FlatParams):
+            return FlatParams(self.old_params.flat + delta.flat, self.old_params.layout)
+        return [
+            (name, old_param + delta)
+            for (name, old_param), (_, delta) in zip(self.old_params, delta)
+        ]
+
+    def __getitem__(self, i):
+        if i in (2, -2):
+            return self.new_params
+        return (self.client_id, self.old_params, None, self.version_number)[i]
+
+    def __iter__(self):
+        yield self.client_id
+        yield self.old_params
+        yield self.new_params
+        yield self.version_number
+
+    def __len__(self) -> int:
+        return 4
+
+
+class StreamedUpdate:
+    def __init__(
+        self,
+        delta: Optional[Iterable[Tuple[str, torch.Tensor]]],
+        client_ids: List[int],
+        version_numbers: List[int],
+    ) -> None:
+        """
+        Normalized weighted average of the deltas of several client updates, as
+        dispensed by a StreamingBuffer in place of the updates themselves.
+
+        Args:
+            delta: weighted average of the update deltas, or None if every folded
+                update had zero weight.
+            client_ids (List[int]): ids of the clients whose updates were folded.
+            version_numbers (List[int]): global model versions the folded updates
+                were trained on.
+        """
+        self.delta = delta
+        self.client_ids = client_ids
+        self.version_numbers = version_numbers
+
+    def __len__(self) -> int:
+        return len(self.version_numbers)
+
+
+def compute_delta(old_params, new_params):
+    """
+    Compute new parameters minus old parameters, in flat form if old_params is.
+    """
+    with torch.no_grad():
+        if isinstance(old_params, FlatParams):
+            if isinstance(new_params, FlatParams):
+                return FlatParams(new_params.flat - old_params.flat, old_params.layout)
+
+            # Flattening already copies, so subtract in place.
+            flat = FlatParams.from_params(new_params, device=old_params.flat.device)
+            return FlatParams(flat.flat.sub_(old_params.flat), old_params.layout)
+
+        return [
+            (name, new_param.detach() - old_param)
+            for (name, new_param), (_, old_param) in zip(new_params, old_params)
+        ]
+
+
+def get_update_delta(update):
+    """
+    Get the change made by local training for a client update in either form,
+    decompressing it if needed.
+    """
+    if isinstance(update, DeltaUpdate):
+        if isinstance(update.delta, CompressedDelta):
+            return update.delta.decode()
+        return update.delta
+
+    _, old_params, new_params, _ = update
+    return compute_delta(old_params, new_params)
+
+
+def coalesce_updates(a, b, weight_a=1, weight_b=1):
+    """
+    Merge two client updates into one whose delta is their weighted average.
+
+    The merged update keeps the client id, base model and version of whichever
+    update was trained on the older global version, so its snapshot reference
+    carries over and the other update's reference must be released.
+
+    Returns:
+        Tuple of the merged DeltaUpdate and the update it no longer references.
+    """
+    delta_a, delta_b = get_update_delta(a), get_update_delta(b)
+    total = weight_a + weight_b
+    with torch.no_grad():
+        if isinstance(delta_a, FlatParams):
+            delta = FlatParams(
+                (delta_a.flat * weight_a)
+                .add_(delta_b.flat, alpha=weight_b)
+                .div_(total),
+                delta_a.layout,
+            )
+        else:
+            delta = [
+                (name, (tensor_a * weight_a).add_(tensor_b, alpha=weight_b).div_(total))
+                for (name, tensor_a), (_, tensor_b) in zip(delta_a, delta_b)
+            ]
+
+    older, newer = (a, b) if a[3] <= b[3] else (b, a)
+    return DeltaUpdate(older[0], older[1], delta, older[3]), newer